@@ -63,7 +63,13 @@ class MQTTClient(QtCore.QObject):
         """
         Callback for every MQTT message
         """
-        self.message.emit(msg.topic, msg.payload.decode("utf-8"))
+        try:
+            payload = msg.payload.decode("utf-8")
+        except UnicodeDecodeError:
+            # binary topics (such as vrc/apriltags/raw/bin) are shown as hex
+            payload = msg.payload.hex(" ")
+
+        self.message.emit(msg.topic, payload)
 
     def on_disconnect(
         self,
@@ -1,6 +1,9 @@
 #include <string.h> // for basename(3) that doesn't modify its argument
 #include <unistd.h> // for getopt
 #include <sstream>
+#include <cstdlib>
+#include <cstdint>
+#include <vector>
 
 #include "cam_properties.hpp"
 
@@ -20,6 +23,7 @@ json jsonify_tag(nvAprilTagsID_t detection)
     json j; 
 
     j["id"] = detection.id;
+    j["hamming"] = detection.hamming_error;
 
     j["pos"]["x"] = detection.translation[0];
     j["pos"]["y"] = detection.translation[1];
@@ -32,6 +36,38 @@ json jsonify_tag(nvAprilTagsID_t detection)
     return j;
 }
 
+// fixed size record for vrc/apriltags/raw/bin, see python/raw_tags.py for the layout
+#pragma pack(push, 1)
+struct raw_tag_record
+{
+    int32_t id;
+    uint32_t hamming; // bits corrected when decoding
+    float pos[3];
+    float rotation[9]; // row-major
+};
+#pragma pack(pop)
+
+static_assert(sizeof(raw_tag_record) == 56, "raw_tag_record must stay 56 bytes");
+
+void pack_tag(nvAprilTagsID_t detection, raw_tag_record &record)
+{
+    record.id = detection.id;
+    record.hamming = detection.hamming_error;
+
+    record.pos[0] = detection.translation[0];
+    record.pos[1] = detection.translation[1];
+    record.pos[2] = detection.translation[2];
+
+    // orientation is column-major, same transpose as jsonify_tag
+    for (int row = 0; row < 3; row++)
+    {
+        for (int col = 0; col < 3; col++)
+        {
+            record.rotation[row * 3 + col] = detection.orientation[col * 3 + row];
+        }
+    }
+}
+
 
 int main() {
     //############################################# SETUP MQTT ####################################################################################
@@ -39,6 +75,12 @@ int main() {
     const std::string CLIENT_ID { "nvapriltags" };
     const std::string TAG_TOPIC { "vrc/apriltags/raw" };
     const std::string FPS_TOPIC { "vrc/apriltags/fps" };
+    const std::string TAG_BIN_TOPIC { "vrc/apriltags/raw/bin" };
+
+    // the binary raw topic is opt-in, set APRILTAG_RAW_BINARY=1 to publish it alongside the json
+    const char *raw_binary_env = std::getenv("APRILTAG_RAW_BINARY");
+    const bool publish_binary = raw_binary_env != nullptr && std::string(raw_binary_env) == "1";
+    std::vector<raw_tag_record> records;
 
     const int QOS = 0;
     mqtt::client client(SERVER_ADDRESS, CLIENT_ID);
@@ -97,11 +139,17 @@ int main() {
             uint32_t num_detections = process_frame(img_rgba8, impl_);
 
             std::string payload = "[";
+            records.resize(num_detections);
             
             //handle the detections
             for (int i = 0; i < num_detections; i++) {
                 const nvAprilTagsID_t &detection = impl_->tags[i];
 
+                if (publish_binary)
+                {
+                    pack_tag(detection, records[i]);
+                }
+
                 json j = jsonify_tag(detection);
 
                 payload.append(j.dump());
@@ -120,6 +168,11 @@ int main() {
             {
                 const char * const_payload = payload.c_str();
                 client.publish(TAG_TOPIC, const_payload, strlen(const_payload));        
+
+                if (publish_binary)
+                {
+                    client.publish(TAG_BIN_TOPIC, records.data(), records.size() * sizeof(raw_tag_record));
+                }
             }
             
             
@@ -22,6 +22,10 @@ from typing import Dict, List, Union, Any
 
 import paho.mqtt.client as mqtt
 
+from publish_policy import PublishPolicy
+from raw_tags import decode_raw_binary
+from tag_map import TagMapIndex
+
 # find the file path to this file
 #__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
@@ -61,9 +65,72 @@ class VRCAprilTag(object):
                 "pos": [13, 0, 8.5],  # cm from FC forward, right, down
                 "rpy": [0, 0, -pi / 2,],  # cam x = body -y; cam y = body x, cam z = body z
             },
+            # extrinsics for any additional cameras, indexed from 1 ("cam" is camera 0). with
+            # the cpu detector each entry also names the camera to capture from, e.g.
+            # {"pos": [..], "rpy": [..], "protocol": "argus", "video_device": "/dev/video1"}
+            # with an optional "framerate"
+            "extra_cams": [],
             "tag_truth": {"0": {"rpy": [0, 0, 0], "xyz": [0, 0, 0]}},
             "AT_UPDATE_FREQ": 5,
             "AT_HEARTBEAT_THRESH": 0.25,
+            # "nvidia" runs the C++ GPU detector and listens on vrc/apriltags/raw,
+            # "cpu" runs AprilTagVPS in-process and hands it detections directly
+            "detector": "nvidia",
+            # when running the cpu detector, also publish the detections to vrc/apriltags/raw
+            "publish_raw": False,
+            # consume the binary vrc/apriltags/raw/bin topic instead of the json one, the
+            # same env var turns on publishing it in vrcapriltags
+            "raw_binary": os.environ.get("APRILTAG_RAW_BINARY") == "1",
+            # when enabled, detections failing any of these are dropped before any pose math
+            # is done. "decision_margin" is only checked when the detector provides it (the
+            # cpu detector does, vrcapriltags doesn't). the score is published either way
+            "quality_filter": {
+                "enabled": False,
+                "min_decision_margin": 20.0,
+                "max_hamming": 1,
+                "max_view_angle": 70,  # degrees between the camera ray and the tag normal
+                "good_decision_margin": 60.0,  # margin at or above which the margin term of the score is 1
+            },
+            "cpu_detector": {
+                "protocol": "argus",
+                "video_device": "/dev/video0",
+                "res": [1280, 720],
+                "camera_params": [784.0756786399139, 784.9009527658286, 677.124825443364, 385.33983488708003],
+                # fisheye k1..k4 for the camera above
+                "dist_coeffs": [-0.013826167055651659, -0.11999744016996756, 0.2825695466585381, -0.22616481734332383],
+                # None, "frame" to remap each frame before detection, or "corners" to
+                # only correct the detected corners before solving the pose
+                "undistort": None,
+                "tag_size": 0.174,
+                # skip frames too blurred or badly exposed to detect in, see BlurFilter
+                "blur_filter": {
+                    "enabled": False,
+                    "min_focus": 25.0,
+                    "min_contrast": 8.0,
+                    "brightness_range": [20, 235],
+                    "force_interval": 10,
+                },
+            },
+            # with the cpu detector, predict where the known tags should appear from the fused
+            # pose and have the workers search those regions before scanning the whole frame
+            "pose_prior": {
+                "enabled": False,
+                "max_range": 500.0,  # cm, tags further than this horizontally are not predicted
+                "roi_margin": 0.25,  # fraction of the projected tag size added on each side
+            },
+            # when to publish visible_tags and selected, see PublishPolicy. "max_rate" in Hz,
+            # "pos_threshold" in cm, "heading_threshold" in degrees, "heartbeat" in seconds
+            "publish_policy": {
+                "visible_tags": {
+                    "max_rate": 10.0,
+                    "on_set_change": True,
+                    "pos_threshold": 2.0,
+                    "heading_threshold": 2.0,
+                    "heartbeat": 1.0,
+                },
+                # fusion consumes selected, so by default every update goes out
+                "selected": {"max_rate": 0.0},
+            },
         }
 
         self.tm = dict()
@@ -72,6 +139,12 @@ class VRCAprilTag(object):
 
         self.pos_array = {"n": [], "e": [], "d": [], "heading": [], "time": []}
 
+        self.publish_policies = {
+            topic: PublishPolicy.from_config(cfg)
+            for topic, cfg in self.default_config["publish_policy"].items()  # type: ignore
+        }
+        self.last_policy_stats = time.time()
+
         self.mqtt_host = "mqtt"
         self.mqtt_port = 18830
 
@@ -87,16 +160,22 @@ class VRCAprilTag(object):
         self.mqtt_client.on_message = self.on_message
 
         self.topic_prefix = "vrc/apriltags"
-        self.topic_map = {
-            f"{self.topic_prefix}/raw":self.on_apriltag_message
-        }
+        self.topic_map = {}
+        # topics whose payloads are handed over as bytes rather than parsed as json
+        self.binary_topic_map = {}
+        if self.default_config["raw_binary"]:
+            self.binary_topic_map[f"{self.topic_prefix}/raw/bin"] = self.on_apriltag_binary
+        else:
+            self.topic_map[f"{self.topic_prefix}/raw"] = self.on_apriltag_message
 
     def on_message(
         self, client: mqtt.Client, userdata: Any, msg: mqtt.MQTTMessage
     ) -> None:
         try:
             #logger.debug(f"{msg.topic}: {str(msg.payload)}")
-            if msg.topic in self.topic_map:
+            if msg.topic in self.binary_topic_map:
+                self.binary_topic_map[msg.topic](msg.payload)
+            elif msg.topic in self.topic_map:
                 payload = json.loads(msg.payload)
                 self.topic_map[msg.topic](payload)
         except Exception as e:
@@ -110,7 +189,7 @@ class VRCAprilTag(object):
         properties: mqtt.Properties = None,
     ) -> None:
         logger.debug(f"Connected with result code {str(rc)}")
-        for topic in self.topic_map.keys():
+        for topic in list(self.topic_map.keys()) + list(self.binary_topic_map.keys()):
             logger.debug(f"Apriltag Module: Subscribed to: {topic}")
             client.subscribe(topic)
 
@@ -118,17 +197,27 @@ class VRCAprilTag(object):
         self.mqtt_client.connect(host=self.mqtt_host, port=self.mqtt_port, keepalive=60)
         self.mqtt_client.loop_forever()
 
-    def setup_transforms(self):
-        rmat = t3d.euler.euler2mat(
-            self.default_config["cam"]["rpy"][0],
-            self.default_config["cam"]["rpy"][1],
-            self.default_config["cam"]["rpy"][2],
-            axes="rxyz",
-        )  # type: ignore
-        H_cam_aeroBody = t3d.affines.compose(self.default_config["cam"]["pos"], rmat, [1, 1, 1])  # type: ignore
+    def cam_transform_name(self, cam_index: int = 0) -> str:
+        """
+        Name of the aeroBody <- camera transform for the given camera index
+        """
+        if cam_index == 0:
+            return "H_aeroBody_cam"
+        return f"H_aeroBody_cam{cam_index}"
 
-        H_aeroBody_cam = np.linalg.inv(H_cam_aeroBody)
-        self.tm["H_aeroBody_cam"] = H_aeroBody_cam
+    def setup_transforms(self):
+        cams = [self.default_config["cam"]] + self.default_config["extra_cams"]  # type: ignore
+        for cam_index, cam in enumerate(cams):
+            rmat = t3d.euler.euler2mat(
+                cam["rpy"][0],
+                cam["rpy"][1],
+                cam["rpy"][2],
+                axes="rxyz",
+            )  # type: ignore
+            H_cam_aeroBody = t3d.affines.compose(cam["pos"], rmat, [1, 1, 1])  # type: ignore
+
+            H_aeroBody_cam = np.linalg.inv(H_cam_aeroBody)
+            self.tm[self.cam_transform_name(cam_index)] = H_aeroBody_cam
 
         for tag in self.default_config["tag_truth"]:  # type: ignore
             name = "tag_" + tag
@@ -141,16 +230,78 @@ class VRCAprilTag(object):
             H_to_from = "H_" + name + "_cam"
             self.tm[H_to_from] = np.eye(4)
 
+    def score_tags(self, pos, rotation, margin=None, hamming=None):
+        """
+        Scores all the detections at once from their Nx3 positions and Nx3x3 rotations,
+        returning a boolean mask of the ones that pass the quality filter and a 0-1
+        quality score per detection.
+
+        The score is the product of the decision margin relative to "good_decision_margin",
+        1 / (1 + hamming) and the cosine of the viewing angle. 'margin' and 'hamming' are
+        per detection arrays, or None when the detector doesn't provide them, in which
+        case their checks and terms are left out. With the filter disabled every
+        detection is kept, but still scored.
+        """
+        cfg = self.default_config["quality_filter"]
+
+        # angle between the ray from the camera to the tag and the tag's normal (its z axis)
+        ray = pos / np.linalg.norm(pos, axis=1, keepdims=True)
+        cos_view = np.abs(np.einsum("ij,ij->i", ray, rotation[:, :, 2]))
+        keep = cos_view >= np.cos(np.deg2rad(cfg["max_view_angle"]))  # type: ignore
+        score = cos_view
+
+        if margin is not None:
+            keep &= ~(margin < cfg["min_decision_margin"])  # type: ignore # nan (no margin available) passes
+            score = score * np.where(np.isnan(margin), 1.0, np.clip(margin / cfg["good_decision_margin"], 0, 1))  # type: ignore
+
+        if hamming is not None:
+            keep &= hamming <= cfg["max_hamming"]  # type: ignore
+            score = score / (1 + hamming)
+
+        if not cfg["enabled"]:
+            keep = np.ones_like(keep)
+
+        return keep, score
+
     def on_apriltag_message(self, payload):
+        """
+        Callback for vrc/apriltags/raw, pulls the detections' fields into arrays once and
+        hands them to process_tags
+        """
+        num_tags = len(payload)
+        self.process_tags(
+            [tag["id"] for tag in payload],
+            np.array([[tag["pos"]["x"], tag["pos"]["y"], tag["pos"]["z"]] for tag in payload], dtype=np.float64).reshape(num_tags, 3),
+            np.array([tag["rotation"] for tag in payload], dtype=np.float64).reshape(num_tags, 3, 3),
+            cams=[tag.get("cam", 0) for tag in payload],
+            margin=np.array([tag.get("decision_margin", np.nan) for tag in payload], dtype=np.float64),
+            hamming=np.array([tag.get("hamming", 0) for tag in payload], dtype=np.float64),
+        )
+
+    def process_tags(self, ids, pos, rotation, cams=None, margin=None, hamming=None):
+        """
+        Scores the detections, works out the vehicle's position from the ones that pass
+        and publishes visible_tags and selected. 'pos' (Nx3, meters, camera frame) and
+        'rotation' (Nx3x3) are float64 arrays, 'cams' the index of the camera each
+        detection came from (all camera 0 if None), see score_tags for the rest.
+        """
         tag_list = []
 
         min_dist = 1000000
 
         closest_tag = None
 
-        for index, tag in enumerate(payload):
-            
-            id, horizontal_distance, vertical_distance, angle, pos_world, pos_rel, heading = self.handle_tag(tag)
+        if len(ids) == 0:
+            keep, scores = [], []
+        else:
+            keep, scores = self.score_tags(pos, rotation, margin, hamming)
+
+        for i, (passed, quality) in enumerate(zip(keep, scores)):
+            if not passed:
+                continue
+
+            cam_index = 0 if cams is None else cams[i]
+            id, horizontal_distance, vertical_distance, angle, pos_world, pos_rel, heading = self.handle_tag(ids[i], pos[i], rotation[i], cam_index)
 
             #weird special case (this shouldn't really happen though?)
             if id is None:
@@ -162,6 +313,7 @@ class VRCAprilTag(object):
                 "vertical_dist" : vertical_distance,
                 "angle_to_tag" : angle,
                 "heading" : heading,
+                "quality" : float(quality),
                 "pos_rel" : {
                     "x" : pos_rel[0],
                     "y" : pos_rel[1],
@@ -180,25 +332,103 @@ class VRCAprilTag(object):
                     }
                     if horizontal_distance < min_dist:
                         min_dist = horizontal_distance
-                        closest_tag = index
+                        closest_tag = len(tag_list)
             
             tag_list.append(tag) 
 
-        self.mqtt_client.publish(f"{self.topic_prefix}/visible_tags", json.dumps(tag_list))
+        self.publish_policies["visible_tags"].publish(
+            self.mqtt_client,
+            f"{self.topic_prefix}/visible_tags",
+            tuple(t["id"] for t in tag_list),
+            np.array([[t["pos_rel"]["x"], t["pos_rel"]["y"], t["pos_rel"]["z"]] for t in tag_list]),
+            np.array([t["heading"] for t in tag_list]),
+            lambda: tag_list,
+        )
 
         if closest_tag is not None:
+            selected = tag_list[closest_tag]
             apriltag_position = {
-                "tag_id": tag_list[closest_tag]["id"], #type: ignore
+                "tag_id": selected["id"], #type: ignore
                 "pos": {
-                    "n": tag_list[closest_tag]["pos_world"]["x"], #type: ignore
-                    "e": tag_list[closest_tag]["pos_world"]["y"], #type: ignore
-                    "d": tag_list[closest_tag]["pos_world"]["z"], #type: ignore
+                    "n": selected["pos_world"]["x"], #type: ignore
+                    "e": selected["pos_world"]["y"], #type: ignore
+                    "d": selected["pos_world"]["z"], #type: ignore
                 },
-                "heading": tag_list[closest_tag]["heading"] #type: ignore
+                "heading": selected["heading"], #type: ignore
+                "quality": selected["quality"] #type: ignore
             }
 
-            self.mqtt_client.publish(f"{self.topic_prefix}/selected", json.dumps(apriltag_position))
+            self.publish_policies["selected"].publish(
+                self.mqtt_client,
+                f"{self.topic_prefix}/selected",
+                (selected["id"],),
+                np.array([[apriltag_position["pos"]["n"], apriltag_position["pos"]["e"], apriltag_position["pos"]["d"]]]),
+                np.array([selected["heading"]]),
+                lambda: apriltag_position,
+            )
+
+        if time.time() - self.last_policy_stats > 1:
+            self.publish_policy_stats()
 
+    def publish_policy_stats(self):
+        """
+        Publishes how many visible_tags / selected updates were published, republished from
+        cache, suppressed, or held back and published late by their publish policies
+        """
+        stats = {topic: policy.stats() for topic, policy in self.publish_policies.items()}
+        self.mqtt_client.publish(
+            f"{self.topic_prefix}/publish_stats", json.dumps(stats), retain=False, qos=0
+        )
+        self.last_policy_stats = time.time()
+
+
+    def on_apriltag_binary(self, payload: bytes):
+        """
+        Callback for vrc/apriltags/raw/bin, decodes the whole payload at once and hands
+        its arrays straight to process_tags
+        """
+        tags = decode_raw_binary(payload)
+        self.process_tags(
+            tags["id"].tolist(),
+            tags["pos"].astype(np.float64),
+            tags["rotation"].astype(np.float64),
+            hamming=tags["hamming"].astype(np.float64),
+        )
+
+    def detection_to_raw(self, detection) -> dict:
+        """
+        Converts a pupil_apriltags detection into the same shape as a vrc/apriltags/raw entry
+        """
+        x, y, z = detection.pose_t.ravel()
+        return {
+            "id": detection.tag_id,
+            "pos": {"x": float(x), "y": float(y), "z": float(z)},
+            "rotation": detection.pose_R,
+            "cam": getattr(detection, "cam", 0),
+            "decision_margin": float(detection.decision_margin),
+            "hamming": int(detection.hamming),
+        }
+
+    def on_cpu_detections(self, detections, capture_time=None):
+        """
+        Callback for AprilTagVPS, runs the pose processing on the detections in-process
+        instead of going through the broker and JSON
+        """
+        detections = [d for d in detections if d.pose_R is not None]
+        num_tags = len(detections)
+
+        if self.default_config["publish_raw"]:
+            raw = [dict(tag, rotation=tag["rotation"].tolist()) for tag in map(self.detection_to_raw, detections)]
+            self.mqtt_client.publish(f"{self.topic_prefix}/raw", json.dumps(raw))
+
+        self.process_tags(
+            [d.tag_id for d in detections],
+            np.array([d.pose_t.ravel() for d in detections], dtype=np.float64).reshape(num_tags, 3),
+            np.array([d.pose_R for d in detections], dtype=np.float64).reshape(num_tags, 3, 3),
+            cams=[getattr(d, "cam", 0) for d in detections],
+            margin=np.array([d.decision_margin for d in detections], dtype=np.float64),
+            hamming=np.array([d.hamming for d in detections], dtype=np.float64),
+        )
 
     def angle_to_tag(self, pos):
         deg = degrees(atan2(pos[1], pos[0])) # TODO - i think plus pi/2 bc this is respect to +x
@@ -239,22 +469,19 @@ class VRCAprilTag(object):
 
 
 
-    def handle_tag(self, tag):
+    def handle_tag(self, tag_id, pos, rotation, cam_index=0):
         """
         Calculates the distance, position, and heading of the drone in NED frame
-        based on the tag detections.
+        based on a tag detection: its id, position in the camera frame in meters and
+        rotation, seen by camera 'cam_index'.
         """
-        tag_id = tag["id"]
+        tag_id = int(tag_id)
+        H_aeroBody_cam = self.tm[self.cam_transform_name(int(cam_index))]
 
-        tag_rot = np.asarray(tag["rotation"])
-        rpy = t3d.euler.mat2euler(tag_rot)
+        rpy = t3d.euler.mat2euler(rotation)
         R = t3d.euler.euler2mat(0, 0, rpy[2], axes="rxyz")
         H_tag_cam = t3d.affines.compose(
-            [
-                tag["pos"]["x"] * 100,
-                tag["pos"]["y"] * 100,
-                tag["pos"]["z"] * 100
-            ],
+            pos * 100,
             R,
             [1, 1, 1],
         )
@@ -267,7 +494,7 @@ class VRCAprilTag(object):
         #H_cam_tag = np.linalg.inv(H_tag_cam)
         H_cam_tag = self.H_inv(H_tag_cam)
 
-        H_aerobody_tag = H_cam_tag.dot(self.tm["H_aeroBody_cam"]) #type: ignore
+        H_aerobody_tag = H_cam_tag.dot(H_aeroBody_cam) #type: ignore
 
         T2, R2, Z2, S2 = t3d.affines.decompose44(H_aerobody_tag)
         rpy = t3d.euler.mat2euler(R2)
@@ -284,11 +511,11 @@ class VRCAprilTag(object):
         angle = self.angle_to_tag(pos_rel)
 
         # if we have a location definition for the visible tag
-        if str(tag["id"]) in self.default_config["tag_truth"].keys():
+        if str(tag_id) in self.default_config["tag_truth"].keys():
 
             H_cam_aeroRef = self.tm["H_" + name + "_aeroRef"].dot(H_cam_tag)
 
-            H_aeroBody_aeroRef = H_cam_aeroRef.dot(self.tm["H_aeroBody_cam"])
+            H_aeroBody_aeroRef = H_cam_aeroRef.dot(H_aeroBody_cam)
 
             pos_world, R, Z, S = t3d.affines.decompose44(H_aeroBody_aeroRef)
 
@@ -296,10 +523,46 @@ class VRCAprilTag(object):
         else:
             return tag_id, horizontal_distance, vertical_distance, angle, None, pos_rel, heading
 
+    def on_fusion_pos(self, payload: dict):
+        """
+        Keeps the latest fused position and refreshes the predicted tag regions
+        """
+        self.fused_pos = [payload["n"], payload["e"], payload["d"]]
+        self.update_rois()
+
+    def on_fusion_heading(self, payload: dict):
+        self.fused_heading = payload["heading"]
+
+    def update_rois(self):
+        """
+        Predicts where the known tags should be in each camera's image from the fused pose
+        and hands the regions to the detector
+        """
+        if self.fused_pos is None or self.fused_heading is None:
+            return
+
+        cfg = self.default_config["pose_prior"]
+        cpu_cfg = self.default_config["cpu_detector"]
+        for cam_index in range(len(self.vps.cameras)):  # type: ignore
+            _, rois = self.tag_map.predict(  # type: ignore
+                self.fused_pos,
+                self.fused_heading,
+                self.tm[self.cam_transform_name(cam_index)],
+                cpu_cfg["camera_params"],
+                cpu_cfg["res"],
+                max_range=cfg["max_range"],
+                margin=cfg["roi_margin"],
+            )
+            self.vps.set_rois(cam_index, rois)  # type: ignore
+
     def main(self):
         # tells the os what to name this process, for debugging
         setproctitle("AprilTagVPS_main")
 
+        if self.default_config["detector"] == "cpu":
+            self.main_cpu()
+            return
+
         subprocess.Popen("./vrcapriltags", cwd="./c/build",shell=True)
 
         threads = []
@@ -315,6 +578,62 @@ class VRCAprilTag(object):
         while True:
             time.sleep(0.1)
 
+    def main_cpu(self):
+        """
+        Runs the CPU detector pipeline in-process, publishing visible_tags and selected
+        straight from its detections. The raw topic is not subscribed to in this mode.
+        """
+        # only needed (and only installed) when running the cpu detector
+        from cpu_apriltag_library import AprilTagVPS
+        from frame_filter import BlurFilter
+
+        self.topic_map = {}
+        self.binary_topic_map = {}
+
+        if self.default_config["pose_prior"]["enabled"]:
+            # tag_truth is in cm, the detector's tag_size in meters
+            self.tag_map = TagMapIndex(
+                self.default_config["tag_truth"],
+                self.default_config["cpu_detector"]["tag_size"] * 100,  # type: ignore
+            )
+            self.fused_pos = None
+            self.fused_heading = None
+            self.topic_map["vrc/fusion/pos/ned"] = self.on_fusion_pos
+            self.topic_map["vrc/fusion/att/heading"] = self.on_fusion_heading
+
+        cfg = self.default_config["cpu_detector"]
+        # camera 0 is the cpu_detector's own device, the rest follow extra_cams in order
+        cameras = [{"protocol": cfg["protocol"], "video_device": cfg["video_device"], "framerate": None}]
+        for cam in self.default_config["extra_cams"]:  # type: ignore
+            cameras.append(
+                {
+                    "protocol": cam["protocol"],
+                    "video_device": cam["video_device"],
+                    "framerate": cam.get("framerate"),
+                }
+            )
+        blur_cfg = dict(cfg["blur_filter"])  # type: ignore
+        blur_filter = BlurFilter(**blur_cfg) if blur_cfg.pop("enabled") else None
+        self.vps = AprilTagVPS(
+            protocol=cfg["protocol"],  # type: ignore
+            video_device=cfg["video_device"],  # type: ignore
+            res=cfg["res"],  # type: ignore
+            camera_params=cfg["camera_params"],  # type: ignore
+            tag_size=cfg["tag_size"],  # type: ignore
+            undistort=cfg["undistort"],  # type: ignore
+            dist_coeffs=cfg["dist_coeffs"],  # type: ignore
+            blur_filter=blur_filter,
+            cameras=cameras,
+            mqtt_client=self.mqtt_client,
+            on_tags=self.on_cpu_detections,
+        )
+        # connect once the detector exists, the pose prior callbacks hand it regions
+        self.mqtt_client.connect(host=self.mqtt_host, port=self.mqtt_port, keepalive=60)
+        self.mqtt_client.loop_start()
+
+        logger.debug(f"{fore.GREEN}AT: starting cpu detector{style.RESET}")  # type: ignore
+        self.vps.start()
+
 
 if __name__ == "__main__":
     atag = VRCAprilTag()
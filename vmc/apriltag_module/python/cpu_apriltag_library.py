@@ -1,10 +1,13 @@
 # python standard libraries
+import json
 import logging
 import time
 import multiprocessing
 import os
+import queue
 
 # pip installed packages
+import cv2
 import numpy
 from setproctitle import setproctitle
 from colored import fore, back, style
@@ -13,15 +16,80 @@ from pupil_apriltags import Detector
 from loguru import logger
 
 from capture_device import CaptureDevice
+from frame_filter import BlurFilter
+from stage_stats import StageHistograms
+from undistort import FisheyeUndistorter
 
 
 # camera_params=[584.3866,583.3444,661.2944,320.7182],tag_size=0.057
 
+# bit pattern of tag36h11 id 0 including its black border (1 = white), used to warm up the detector
+WARMUP_TAG = [
+    "00000000",
+    "00010000",
+    "00110100",
+    "00001010",
+    "00001100",
+    "01011100",
+    "01010110",
+    "00000000",
+]
+
+
+def make_warmup_image(res, cell_size=20):
+    """
+    Renders WARMUP_TAG, with its white quiet zone, in the middle of a blank frame of size 'res'
+    """
+    bits = numpy.array([[int(b) for b in row] for row in WARMUP_TAG], dtype=numpy.uint8)
+    tag = numpy.pad(bits, 1, constant_values=1) * 255
+    tag = numpy.kron(tag, numpy.ones((cell_size, cell_size), dtype=numpy.uint8))
+
+    frame = numpy.full((res[1], res[0]), 128, dtype=numpy.uint8)
+    row = (res[1] - tag.shape[0]) // 2
+    col = (res[0] - tag.shape[1]) // 2
+    frame[row : row + tag.shape[0], col : col + tag.shape[1]] = tag
+    return frame
+
 
 class AprilTagWrapper(object):
-    def __init__(self, camera_params, tag_size):
+    def __init__(
+        self,
+        camera_params,
+        tag_size,
+        undistort=None,
+        res=[1280, 720],
+        blur_filter=None,
+        dist_coeffs=None,
+    ):
+        """
+        `undistort` selects how lens distortion is removed before pose estimation:
+        None skips it, "frame" remaps the whole image before detection, and
+        "corners" only corrects the detected corner points and re-solves the pose.
+        `dist_coeffs` are the fisheye k1..k4 of the camera `camera_params` belong to.
+
+        `blur_filter` is an optional BlurFilter used to skip frames that are too
+        blurred or badly exposed to be worth running the detector on.
+        """
         self.camera_params = camera_params
         self.tag_size = tag_size
+        self.undistort = undistort
+        self.blur_filter = blur_filter
+        self.res = res
+
+        self.undistorter = None
+        if self.undistort is not None:
+            if dist_coeffs is None:
+                raise ValueError("undistort needs the camera's dist_coeffs")
+            self.undistorter = FisheyeUndistorter(
+                res=res, camera_params=camera_params, dist_coeffs=dist_coeffs
+            )
+
+        # tag corners in the tag frame, in the same order and orientation as apriltag_pose.c
+        half = tag_size / 2
+        self.tag_object_points = numpy.array(
+            [[-half, half, 0], [half, half, 0], [half, -half, 0], [-half, -half, 0]],
+            dtype=numpy.float64,
+        )
 
         self.detector = Detector(
             families="tag36h11",
@@ -32,21 +100,111 @@ class AprilTagWrapper(object):
             decode_sharpening=0.25,
             debug=0,
         )
+        # whether the last process_image call was satisfied by its ROIs ("roi") or scanned the whole frame ("full")
+        self.last_scan = None
 
-    def process_image(self, frame):
+    def process_image(self, frame, rois=None):
         """
         Takes an image as input and returns the detected apriltags in list format
+
+        'rois' is an optional list of (x0, y0, x1, y1) regions where tags are expected
+        (see TagMapIndex.predict). They are searched first and the full frame is only
+        scanned if none of them yields a detection.
+        """
+        if self.blur_filter is not None and not self.blur_filter.should_detect(frame):
+            self.last_scan = None
+            return []
+
+        if self.undistort == "frame":
+            frame = self.undistorter.undistort_frame(frame)  # type: ignore
+
+        tags = []
+        if rois is not None and len(rois):
+            tags = self.detect_rois(frame, rois)
+            self.last_scan = "roi" if tags else "full"
+        else:
+            self.last_scan = "full"
+        if not tags:
+            tags = self.detect(frame)
+
+        if self.undistort == "corners":
+            for tag in tags:
+                self.estimate_pose_undistorted(tag)
+
+        return tags
+
+    def detect(self, frame, x0=0, y0=0):
+        """
+        Runs the detector on 'frame', which is a crop of the full image starting at (x0, y0).
+        The principal point is shifted so poses come out the same as for the full image,
+        and the corners and center are moved back into full image coordinates.
         """
+        fx, fy, cx, cy = self.camera_params
+        tags = self.detector.detect(
+            frame,
+            estimate_tag_pose=self.undistort != "corners",
+            camera_params=[fx, fy, cx - x0, cy - y0],
+            tag_size=self.tag_size,
+        )
+        if x0 or y0:
+            for tag in tags:
+                tag.corners += (x0, y0)
+                tag.center += (x0, y0)
+        return tags
+
+    def detect_rois(self, frame, rois):
+        """
+        Detects tags within each of the regions of interest, keeping one detection per tag id
+        where regions overlap
+        """
+        tags = []
+        seen = set()
+        for x0, y0, x1, y1 in rois:
+            for tag in self.detect(frame[y0:y1, x0:x1], x0, y0):
+                if tag.tag_id not in seen:
+                    seen.add(tag.tag_id)
+                    tags.append(tag)
+        return tags
+
+    def warm_up(self):
+        """
+        Runs a detection on a synthetic tag so the detector's buffers and thread pool are
+        set up before the first real frame arrives. Returns the number of tags found
+        """
+        frame = make_warmup_image(self.res)
         tags = self.detector.detect(
             frame,
             estimate_tag_pose=True,
             camera_params=self.camera_params,
             tag_size=self.tag_size,
         )
-        return tags
+        return len(tags)
+
+    def estimate_pose_undistorted(self, tag):
+        """
+        Undistorts the corners of a detection and solves for the tag pose from them,
+        filling in the same pose fields the detector would have
+        """
+        corners = self.undistorter.undistort_points(tag.corners)  # type: ignore
+        ok, rvec, tvec = cv2.solvePnP(
+            self.tag_object_points,
+            corners,
+            self.undistorter.K,  # type: ignore
+            None,
+            flags=cv2.SOLVEPNP_IPPE_SQUARE,
+        )
+        if ok:
+            tag.pose_R = cv2.Rodrigues(rvec)[0]
+            tag.pose_t = tvec
+        else:
+            tag.pose_R = None
+            tag.pose_t = None
 
 
 class AprilTagVPS(object):
+    # most regions of interest kept per camera, see set_rois
+    MAX_ROIS = 16
+
     def __init__(
         self,
         protocol,
@@ -55,54 +213,211 @@ class AprilTagVPS(object):
         camera_params,
         tag_size,
         framerate=None,
+        undistort=None,
+        dist_coeffs=None,
+        max_frame_age=0.25,
+        blur_filter=None,
+        cameras=None,
+        num_workers=2,
+        group_window=0.02,
+        worker_cpus=None,
+        worker_niceness=None,
+        mqtt_client=None,
+        on_tags=None,
+        roi_max_age=0.5,
     ):
+        """
+        By default a single camera is captured from 'protocol' / 'video_device'.
+        Several cameras can be fed into the same pool of perception workers by passing
+        'cameras', a list of dicts with "protocol", "video_device" and optional "framerate".
+        The camera index is the one VRCAprilTag uses to look up that camera's extrinsics.
+        Results are grouped by capture instant with at most one frame per camera; a group
+        closes when a camera repeats, and results older than the last group reported
+        are dropped.
+        All cameras are expected to share 'res', 'camera_params' and 'dist_coeffs'.
+
+        'undistort' ("frame", "corners" or None) and 'dist_coeffs' are passed on to
+        AprilTagWrapper.
+
+        'worker_cpus' optionally pins each perception worker to a set of cores, one entry
+        per worker (e.g. [[2], [3]]), and 'worker_niceness' is added to each worker's niceness.
+
+        If 'mqtt_client' is given, per-stage latency stats are published to
+        "vrc/apriltags/stats" once a second.
+
+        'on_tags' is called in the parent process with (tags, capture_time) for every
+        capture instant that had detections, so the pose code can run in-process.
+
+        Regions of interest predicted from the vehicle pose can be handed to the workers
+        with set_rois; they are searched before the full frame and ignored once they are
+        older than 'roi_max_age' seconds.
+        """
         self.protocol = protocol
         self.video_device = video_device
         self.res = res[0:2]
         self.framerate = framerate
 
-        self.atag = AprilTagWrapper(camera_params=camera_params, tag_size=tag_size)
+        if cameras is None:
+            cameras = [
+                {
+                    "protocol": protocol,
+                    "video_device": video_device,
+                    "framerate": framerate,
+                }
+            ]
+        self.cameras = cameras
+        self.num_workers = num_workers
+
+        # results whose capture times fall within this many seconds are reported together
+        self.group_window = group_window
 
-        self.img_queue = multiprocessing.Queue()
+        self.worker_cpus = worker_cpus
+        self.worker_niceness = worker_niceness
+        # number of perception workers that have finished warming up
+        self.workers_ready = multiprocessing.Value("i", 0)
+
+        # frames older than this (seconds since capture) are dropped before detection
+        self.max_frame_age = max_frame_age
+
+        self.atag = AprilTagWrapper(
+            camera_params=camera_params,
+            tag_size=tag_size,
+            undistort=undistort,
+            res=self.res,
+            blur_filter=blur_filter,
+            dist_coeffs=dist_coeffs,
+        )
+
+        # one image queue per camera so the workers can service the cameras fairly
+        self.img_queues = [multiprocessing.Queue() for _ in self.cameras]
         self.tags_queue = multiprocessing.Queue()
 
+        # tags from the latest capture instant, across all cameras. each detection
+        # carries the index of the camera it was seen by in "cam"
         self.tags = None
+        # capture time of the frame the current tags were detected in
         self.tags_timestamp = time.time()
 
+        # number of frames the perception loops dropped for exceeding max_frame_age
+        self.stale_frames = multiprocessing.Value("L", 0)
+
         self.avg = 0.0
         self.num_images = 0
+        # results dropped for arriving after a later capture instant was already reported
+        self.out_of_order_frames = 0
+
+        self.mqtt_client = mqtt_client
+        self.topic_prefix = "vrc/apriltags"
+        self.on_tags = on_tags
+
+        # predicted regions of interest per camera, written by set_rois and read by the workers
+        self.roi_max_age = roi_max_age
+        self.rois = multiprocessing.Array("i", len(self.cameras) * self.MAX_ROIS * 4)
+        self.roi_counts = multiprocessing.RawArray("i", len(self.cameras))
+        self.roi_times = multiprocessing.RawArray("d", len(self.cameras))
+        # frames resolved from their ROIs alone vs. frames that needed a full scan
+        self.roi_frames = multiprocessing.Value("L", 0)
+        self.full_scans = multiprocessing.Value("L", 0)
+        # each worker's BlurFilter frames checked and frames skipped, as they are per process
+        self.blur_counts = multiprocessing.RawArray("L", self.num_workers * 2)
+
+        # latency histograms, one row per capture process, per perception worker, and the parent
+        self.stats = StageHistograms(len(self.cameras) + self.num_workers + 1)
+        self.parent_stats_row = len(self.cameras) + self.num_workers
+
+    def publish_stats(self):
+        """
+        Publishes the stage latency histograms for the last interval along with the frame counters
+        """
+        stats = self.stats.report()
+        stats["fps"] = self.avg
+        stats["num_images"] = self.num_images
+        stats["stale_frames"] = self.stale_frames.value
+        stats["roi_frames"] = self.roi_frames.value
+        stats["full_scans"] = self.full_scans.value
+        stats["out_of_order_frames"] = self.out_of_order_frames
+        if self.atag.blur_filter is not None:
+            checked = sum(self.blur_counts[0::2])
+            skipped = sum(self.blur_counts[1::2])
+            # same as BlurFilter.skipped_fraction, over all the workers
+            stats["skipped_fraction"] = skipped / checked if checked else 0.0
+        self.mqtt_client.publish(  # type: ignore
+            f"{self.topic_prefix}/stats", json.dumps(stats), retain=False, qos=0
+        )
 
     def start(self):
         """
         Kicks off the AprilTagVPS pipeline, capturing images from a v4l2 camera @ 'video_device' and uses 'camera_params' along with 'tag_size' to calculate pose.
         """
         self.consumer_processes = []
-        # we will setup 2 processing consumers for the imagery.
-        for i in range(0, 2):
+        # setup the processing consumers for the imagery, shared by all the cameras
+        for i in range(0, self.num_workers):
             proc = multiprocessing.Process(
-                target=self.perception_loop, args=[], daemon=True  # type: ignore
+                target=self.perception_loop, args=[i], daemon=True  # type: ignore
             )
             proc.start()
+            self.consumer_processes.append(proc)
 
-        # start the capturing process
-        proc = multiprocessing.Process(target=self.capture_loop, args=[], daemon=True)  # type: ignore
-        proc.start()
+        # hold off capturing until the workers are warmed up, so the first frames aren't stale
+        while self.workers_ready.value < self.num_workers and all(
+            proc.is_alive() for proc in self.consumer_processes
+        ):
+            time.sleep(0.01)
+        logger.debug(f"{fore.GREEN}AT: {self.num_workers} perception workers ready{style.RESET}")  # type: ignore
+
+        # start a capturing process per camera
+        for cam_index in range(len(self.cameras)):
+            proc = multiprocessing.Process(target=self.capture_loop, args=[cam_index], daemon=True)  # type: ignore
+            proc.start()
 
         last_loop = time.time()
+        last_stats = last_loop
         delta_buckets = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
         i = 0
 
+        # detections from the capture instant currently being assembled
+        group = []
+        group_cameras = set()
+        group_time = None
+        # capture time of the last group reported, nothing older is reported after it
+        last_group_time = None
+
         while True:
             # if the perception loop has completed analysis on a frame, show some stats or even render the frame
             if not self.tags_queue.empty():
                 self.num_images += 1
                 now = time.time()
-                tags = self.tags_queue.get()
-                if tags:
-                    self.tags = tags
-                    self.tags_timestamp = now
-                else:
-                    self.tags = []
+                cam_index, capture_time, detect_done, tags = self.tags_queue.get()
+                self.stats.record(self.parent_stats_row, StageHistograms.PUBLISH, now - detect_done)
+
+                # with several workers a frame can finish after a later one, drop it rather
+                # than report tags from an instant older than ones already reported
+                if (group_time is not None and capture_time < group_time - self.group_window) or (
+                    last_group_time is not None and capture_time <= last_group_time
+                ):
+                    self.out_of_order_frames += 1
+                    tags = None
+
+                # a frame from a later instant, or a second frame from a camera already in
+                # the group, closes out the group being assembled
+                elif group_time is not None and (
+                    capture_time - group_time > self.group_window or cam_index in group_cameras
+                ):
+                    self.publish_group(group, group_time)
+                    last_group_time = group_time
+                    group, group_cameras, group_time = [], set(), None
+
+                if tags is not None:
+                    if group_time is None:
+                        group_time = capture_time
+                    group.extend(tags)
+                    group_cameras.add(cam_index)
+
+                # once every camera has reported for this instant there is nothing left to wait for
+                if len(group_cameras) == len(self.cameras):
+                    self.publish_group(group, group_time)
+                    last_group_time = group_time
+                    group, group_cameras, group_time = [], set(), None
 
                 tdelta = now - last_loop
                 delta_buckets[i % 10] = tdelta  # type: ignore
@@ -111,43 +426,157 @@ class AprilTagVPS(object):
                 last_loop = now
                 i = i + 1
             else:
+                # don't hold a partial group waiting on a camera that has stopped reporting
+                if group_time is not None and time.time() - group_time > self.max_frame_age:
+                    self.publish_group(group, group_time)
+                    last_group_time = group_time
+                    group, group_cameras, group_time = [], set(), None
                 time.sleep(0.01)
 
-    def capture_loop(self):
+            if self.mqtt_client is not None and time.time() - last_stats > 1:
+                self.publish_stats()
+                last_stats = time.time()
+
+    def publish_group(self, tags, capture_time):
+        """
+        Makes the detections from one capture instant (across all cameras) the current set of tags
+        """
+        if tags:
+            self.tags = tags
+            self.tags_timestamp = capture_time
+            if self.on_tags is not None:
+                self.on_tags(tags, capture_time)
+        else:
+            self.tags = []
+
+    def set_rois(self, cam_index, rois):
+        """
+        Replaces the regions of interest (an Nx4 array of x0, y0, x1, y1) for a camera.
+        Anything beyond MAX_ROIS is dropped, so pass them in order of preference
+        """
+        rois = numpy.asarray(rois, dtype=numpy.int32).reshape(-1, 4)[: self.MAX_ROIS]
+        start = cam_index * self.MAX_ROIS * 4
+        with self.rois.get_lock():
+            self.rois[start : start + rois.size] = rois.ravel().tolist()
+            self.roi_counts[cam_index] = len(rois)
+            self.roi_times[cam_index] = time.time()
+
+    def get_rois(self, cam_index):
         """
-        Captures frames from the camera and places them into the image queue to be consumed downstream by "perception loop"
+        Returns the current regions of interest for a camera, or None if there are none
+        or they have gone stale
+        """
+        with self.rois.get_lock():
+            count = self.roi_counts[cam_index]
+            if count == 0 or time.time() - self.roi_times[cam_index] > self.roi_max_age:
+                return None
+            start = cam_index * self.MAX_ROIS * 4
+            return numpy.array(self.rois[start : start + count * 4]).reshape(-1, 4)
+
+    def capture_loop(self, cam_index):
+        """
+        Captures frames from one camera and places them into that camera's image queue to be consumed downstream by "perception loop"
         Checks to make sure queue is not being overloaded and limits queue size to "max_depth"
         """
-        setproctitle("AprilTagVPS_capture")
+        setproctitle(f"AprilTagVPS_capture_{cam_index}")
         max_depth = 3
+        camera = self.cameras[cam_index]
+        img_queue = self.img_queues[cam_index]
         capture = CaptureDevice(
-            self.protocol, self.video_device, self.res, self.framerate
+            camera["protocol"], camera["video_device"], self.res, camera.get("framerate")
         )
-        logger.debug(f"{fore.GREEN}AT: Capture Loop Started!{style.RESET}")  # type: ignore
+        logger.debug(f"{fore.GREEN}AT: Capture Loop {cam_index} Started!{style.RESET}")  # type: ignore
         while True:
+            read_start = time.time()
             ret, img = capture.read_gray()
+            self.stats.record(cam_index, StageHistograms.CAPTURE, time.time() - read_start)
             # logger.debug(f"{fore.GREEN}AT: ret: {ret}{style.RESET}") #type: ignore
             # if theres room in the queue and we have a valid image
-            if (self.img_queue.qsize() < max_depth) and (ret is True):
-                # put the image in the queue
-                self.img_queue.put(img)
+            if (img_queue.qsize() < max_depth) and (ret is True):
+                # put the image in the queue, stamped with when it was captured
+                img_queue.put((time.time(), img))
                 # logger.debug(f"{fore.GREEN}AT: Placed an image!{style.RESET}") #type: ignore
             time.sleep(0.01)
 
-    def perception_loop(self):
+    def next_frame(self, start_index):
+        """
+        Round-robins over the camera image queues starting at 'start_index' and returns
+        (cam_index, capture_time, img) for the first frame found, or None if all are empty
+        """
+        num_cameras = len(self.img_queues)
+        for offset in range(num_cameras):
+            cam_index = (start_index + offset) % num_cameras
+            try:
+                capture_time, img = self.img_queues[cam_index].get_nowait()
+                return cam_index, capture_time, img
+            except queue.Empty:
+                continue
+        return None
+
+    def configure_worker(self, worker_index):
         """
-        Pulls images off the image queue, hands them to the apriltag detector, and then places the results in the tags queue
+        Applies the configured core pinning and niceness to the calling worker process.
+        Either failing (e.g. a core that doesn't exist, or a negative niceness without
+        CAP_SYS_NICE) is logged and the worker carries on with the default scheduling
         """
-        setproctitle("AprilTagVPS_perception")
-        logger.debug(f"{fore.GREEN}AT: Perception Loop Started!{style.RESET}")  # type: ignore
+        if self.worker_cpus is not None:
+            cpus = self.worker_cpus[worker_index % len(self.worker_cpus)]
+            try:
+                os.sched_setaffinity(0, cpus)
+                logger.debug(f"{fore.GREEN}AT: Worker {worker_index} pinned to cores {sorted(cpus)}{style.RESET}")  # type: ignore
+            except (OSError, ValueError) as e:
+                logger.warning(f"{fore.YELLOW}AT: Worker {worker_index} could not be pinned to cores {cpus}: {e}{style.RESET}")  # type: ignore
+
+        if self.worker_niceness is not None:
+            try:
+                os.nice(self.worker_niceness)
+            except OSError as e:
+                logger.warning(f"{fore.YELLOW}AT: Worker {worker_index} could not change niceness by {self.worker_niceness}: {e}{style.RESET}")  # type: ignore
+
+    def perception_loop(self, worker_index=0):
+        """
+        Pulls images off the image queues, hands them to the apriltag detector, and then places the results in the tags queue
+        Frames that have waited longer than "max_frame_age" since capture are dropped without running the detector
+        """
+        setproctitle(f"AprilTagVPS_perception_{worker_index}")
+        self.configure_worker(worker_index)
+
+        found = self.atag.warm_up()
+        with self.workers_ready.get_lock():
+            self.workers_ready.value += 1
+        logger.debug(f"{fore.GREEN}AT: Perception Loop Started! (warm up found {found} tags){style.RESET}")  # type: ignore
+        # stagger the workers so they don't all start on the same camera
+        next_camera = worker_index
+        stats_row = len(self.cameras) + worker_index
         try:
             while True:
-                if not self.img_queue.empty():
-                    img = self.img_queue.get()
-                    tags = self.atag.process_image(img)
-                    self.tags_queue.put(tags)
+                frame = self.next_frame(next_camera)
+                if frame is not None:
+                    cam_index, capture_time, img = frame
+                    # resume from the camera after this one, so every camera gets a turn
+                    next_camera = cam_index + 1
+                    detect_start = time.time()
+                    self.stats.record(stats_row, StageHistograms.QUEUE, detect_start - capture_time)
+                    if detect_start - capture_time > self.max_frame_age:
+                        with self.stale_frames.get_lock():
+                            self.stale_frames.value += 1
+                        continue
+                    tags = self.atag.process_image(img, self.get_rois(cam_index))
+                    if self.atag.last_scan is not None:
+                        counter = self.roi_frames if self.atag.last_scan == "roi" else self.full_scans
+                        with counter.get_lock():
+                            counter.value += 1
+                    blur_filter = self.atag.blur_filter
+                    if blur_filter is not None:
+                        self.blur_counts[worker_index * 2] = blur_filter.num_frames
+                        self.blur_counts[worker_index * 2 + 1] = blur_filter.num_skipped
+                    for tag in tags:
+                        tag.cam = cam_index
+                    detect_done = time.time()
+                    self.stats.record(stats_row, StageHistograms.DETECT, detect_done - detect_start)
+                    self.tags_queue.put((cam_index, capture_time, detect_done, tags))
                 else:
-                    time.sleep(0.01)
+                    time.sleep(0.005)
         except Exception as e:
             logger.exception(f"{fore.RED}AT: Perception Loop Error: {e}{style.RESET}")  # type: ignore
             raise e
@@ -0,0 +1,79 @@
+"""
+Measures apriltag detection latency while every core is kept busy by a load generator,
+once with the detector free to float across all cores and once pinned (and reniced) the
+way AprilTagVPS pins its perception workers.
+
+usage: python3 detector_benchmark.py [iterations] [core ...]
+"""
+# python standard libraries
+import multiprocessing
+import os
+import sys
+import time
+
+# pip installed packages
+import numpy
+
+from cpu_apriltag_library import AprilTagWrapper, make_warmup_image
+
+
+def burn():
+    """
+    Load generator, spins a core forever
+    """
+    x = 0
+    while True:
+        x += 1
+
+
+def detection_latencies(cpus, niceness, iterations, results):
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    if niceness is not None:
+        os.nice(niceness)
+
+    atag = AprilTagWrapper(camera_params=[784.08, 784.90, 677.12, 385.34], tag_size=0.174)
+    atag.warm_up()
+    frame = make_warmup_image(atag.res)
+
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        atag.process_image(frame)
+        latencies.append(time.perf_counter() - start)
+    results.put(latencies)
+
+
+def run(label, cpus, niceness, iterations):
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(
+        target=detection_latencies, args=[cpus, niceness, iterations, results]
+    )
+    proc.start()
+    latencies = numpy.array(results.get()) * 1000
+    proc.join()
+
+    p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99])
+    print(
+        f"{label:>10}: p50 {p50:6.2f} ms  p95 {p95:6.2f} ms  p99 {p99:6.2f} ms  max {latencies.max():6.2f} ms"
+    )
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    all_cpus = sorted(os.sched_getaffinity(0))
+    pinned_cpus = {int(c) for c in sys.argv[2:]} or {all_cpus[-1]}
+
+    # one load generator per core, like the VIO/fusion/FCC containers competing for the CPU
+    load = [
+        multiprocessing.Process(target=burn, daemon=True) for _ in range(len(all_cpus))
+    ]
+    for proc in load:
+        proc.start()
+
+    try:
+        run("floating", None, None, iterations)
+        run("pinned", pinned_cpus, -5 if os.geteuid() == 0 else None, iterations)
+    finally:
+        for proc in load:
+            proc.terminate()
@@ -0,0 +1,105 @@
+"""
+Measures the time from a set of detections being available to "vrc/apriltags/selected"
+being published, for the in-process CPU path (AprilTagVPS -> VRCAprilTag.on_cpu_detections)
+for the raw JSON path (encode as vrcapriltags does -> decode in on_message -> on_apriltag_message)
+and for the binary raw path (encode as vrcapriltags does -> on_apriltag_binary).
+
+The broker round trip of the raw JSON path is not included, so the real gap is larger.
+
+usage: python3 publish_benchmark.py [iterations] [tags per frame]
+"""
+# python standard libraries
+import json
+import sys
+import time
+
+# pip installed packages
+import numpy
+
+from apriltag_processor import VRCAprilTag
+from cpu_apriltag_library import AprilTagWrapper, make_warmup_image
+from raw_tags import encode_raw_binary
+
+
+class TimingClient(object):
+    """
+    Stands in for the paho client, noting when "selected" gets published
+    """
+
+    def __init__(self):
+        self.selected_time = None
+
+    def publish(self, topic, payload, *args, **kwargs):
+        if topic.endswith("/selected"):
+            self.selected_time = time.perf_counter()
+
+
+def raw_json(detections):
+    """
+    Encodes the detections the same way jsonify_tag in vrcapriltags.cpp does
+    """
+    return json.dumps(
+        [
+            {
+                "id": d.tag_id,
+                "pos": dict(zip("xyz", d.pose_t.ravel().tolist())),
+                "rotation": d.pose_R.tolist(),
+            }
+            for d in detections
+        ]
+    )
+
+
+def raw_binary(detections):
+    """
+    Encodes the detections the same way pack_tag in vrcapriltags.cpp does
+    """
+    return encode_raw_binary(
+        [d.tag_id for d in detections],
+        [d.pose_t.ravel() for d in detections],
+        [d.pose_R for d in detections],
+        [d.hamming for d in detections],
+    )
+
+
+def report(label, latencies):
+    latencies = numpy.array(latencies) * 1e6
+    p50, p99 = numpy.percentile(latencies, [50, 99])
+    print(f"{label:>10}: p50 {p50:8.1f} us  p99 {p99:8.1f} us")
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    num_tags = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    atag = AprilTagWrapper(camera_params=[784.08, 784.90, 677.12, 385.34], tag_size=0.174)
+    detections = atag.process_image(make_warmup_image(atag.res)) * num_tags
+
+    processor = VRCAprilTag()
+    client = TimingClient()
+    processor.mqtt_client = client  # type: ignore
+
+    in_process = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        processor.on_cpu_detections(detections)
+        in_process.append(client.selected_time - start)  # type: ignore
+
+    via_json = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        payload = raw_json(detections).encode()
+        processor.on_apriltag_message(json.loads(payload))
+        via_json.append(client.selected_time - start)  # type: ignore
+
+    via_binary = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        payload = raw_binary(detections)
+        processor.on_apriltag_binary(payload)
+        via_binary.append(client.selected_time - start)  # type: ignore
+
+    print(f"{num_tags} tag(s) per frame, {iterations} frames")
+    report("in-process", in_process)
+    report("raw json", via_json)
+    report("raw binary", via_binary)
@@ -0,0 +1,164 @@
+# python standard libraries
+import json
+import threading
+import time
+
+# pip installed packages
+import numpy as np
+
+
+class PublishPolicy(object):
+    """
+    Decides whether an update to a topic is worth publishing, so consumers (like the GUI,
+    which repaints on every message) aren't flooded with near identical payloads.
+
+    With 'on_set_change' and/or a threshold set, an update is only published when the set
+    of tags differs from the last published one, or when any tag has moved more than
+    'pos_threshold' (cm) or turned more than 'heading_threshold' (degrees) since then.
+    With none of them set every update counts as a change. 'max_rate' (Hz) caps how often anything is published, and
+    'heartbeat' (seconds) republishes the cached payload when nothing has changed for that long.
+
+    A change that arrives before 'max_rate' allows another publish is held, replaced by any
+    newer change, and published from a timer once the interval is up, so the last change
+    always goes out even if no further updates arrive.
+    """
+
+    def __init__(
+        self,
+        max_rate=0.0,
+        on_set_change=False,
+        pos_threshold=None,
+        heading_threshold=None,
+        heartbeat=None,
+    ):
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self.on_set_change = on_set_change
+        self.pos_threshold = pos_threshold
+        self.heading_threshold = heading_threshold
+        self.heartbeat = heartbeat
+
+        # state as of the last publish
+        self.payload = None
+        self.last_time = 0.0
+        self.last_ids = None
+        self.last_pos = None
+        self.last_heading = None
+
+        # newest change held back by max_rate as (mqtt_client, topic, ids, pos, heading,
+        # make_payload), and the timer that will publish it
+        self.pending = None
+        self.timer = None
+        # publish is called from the mqtt thread, the timer fires on its own
+        self.lock = threading.Lock()
+
+        self.published = 0
+        self.cached = 0
+        self.suppressed = 0
+        self.deferred = 0
+
+    @classmethod
+    def from_config(cls, cfg: dict):
+        return cls(
+            max_rate=cfg.get("max_rate", 0.0),
+            on_set_change=cfg.get("on_set_change", False),
+            pos_threshold=cfg.get("pos_threshold"),
+            heading_threshold=cfg.get("heading_threshold"),
+            heartbeat=cfg.get("heartbeat"),
+        )
+
+    def changed(self, ids, pos, heading):
+        if self.payload is None:
+            return True
+        if not (self.on_set_change or self.pos_threshold is not None or self.heading_threshold is not None):
+            return True
+        if ids != self.last_ids:
+            # a different set of tags can't be compared pose to pose, so it always counts
+            return True
+        if len(ids) == 0:
+            return False
+        if self.pos_threshold is not None:
+            if np.abs(pos - self.last_pos).max() > self.pos_threshold:
+                return True
+        if self.heading_threshold is not None:
+            turned = (heading - self.last_heading + 180.0) % 360.0 - 180.0
+            if np.abs(turned).max() > self.heading_threshold:
+                return True
+        return False
+
+    def publish(self, mqtt_client, topic, ids, pos, heading, make_payload):
+        """
+        Publishes to 'topic' if the policy allows it. 'ids' is a tuple of the tag ids in
+        the update, 'pos' an Nx3 array of their positions and 'heading' an array of their
+        headings, in the same order. 'make_payload' builds the payload object and is only
+        called (and serialized) when there is something new to publish.
+
+        Returns True if anything was published
+        """
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.last_time
+            changed = self.changed(ids, pos, heading)
+
+            if self.payload is not None and elapsed < self.min_interval:
+                self.suppressed += 1
+                if changed:
+                    self.defer((mqtt_client, topic, ids, pos, heading, make_payload), self.min_interval - elapsed)
+                else:
+                    # back to what was last published, so there is nothing left to send
+                    self.pending = None
+                return False
+
+            self.pending = None
+            if changed:
+                self.update(ids, pos, heading, make_payload)
+            elif self.heartbeat is not None and elapsed >= self.heartbeat:
+                self.cached += 1
+            else:
+                self.suppressed += 1
+                return False
+
+            mqtt_client.publish(topic, self.payload, retain=False, qos=0)
+            self.last_time = now
+            return True
+
+    def update(self, ids, pos, heading, make_payload):
+        """
+        Makes the update the last published state and serializes its payload
+        """
+        self.payload = json.dumps(make_payload())
+        self.last_ids = ids
+        self.last_pos = pos
+        self.last_heading = heading
+        self.published += 1
+
+    def defer(self, pending, delay):
+        """
+        Holds a change back until the rate limit allows it, in place of any held before
+        """
+        self.pending = pending
+        if self.timer is None:
+            self.timer = threading.Timer(delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """
+        Publishes the change held back by the rate limit, if it is still pending
+        """
+        with self.lock:
+            self.timer = None
+            if self.pending is None:
+                return
+            (mqtt_client, topic, ids, pos, heading, make_payload), self.pending = self.pending, None
+            self.update(ids, pos, heading, make_payload)
+            self.deferred += 1
+            mqtt_client.publish(topic, self.payload, retain=False, qos=0)
+            self.last_time = time.monotonic()
+
+    def stats(self):
+        return {
+            "published": self.published,
+            "cached": self.cached,
+            "suppressed": self.suppressed,
+            "deferred": self.deferred,
+        }
@@ -0,0 +1,84 @@
+"""
+Binary layout for "vrc/apriltags/raw/bin", the compact counterpart to the JSON "vrc/apriltags/raw".
+
+The payload is a plain concatenation of fixed size little-endian records, one per tag:
+
+    int32   id
+    uint32  hamming         bits corrected when decoding (same as "hamming" in the JSON)
+    float32 pos[3]          x, y, z in meters (same as "pos" in the JSON)
+    float32 rotation[3][3]  row-major (same as "rotation" in the JSON)
+
+56 bytes per tag, with no header; the tag count is len(payload) / 56.
+"""
+# python standard libraries
+import json
+import sys
+import time
+
+# pip installed packages
+import numpy as np
+
+RAW_TAG_DTYPE = np.dtype(
+    [("id", "<i4"), ("hamming", "<u4"), ("pos", "<f4", (3,)), ("rotation", "<f4", (3, 3))]
+)
+
+
+def decode_raw_binary(payload: bytes) -> np.ndarray:
+    """
+    Decodes a whole payload into a structured array with "id", "hamming", "pos" and "rotation" fields,
+    without creating any per-tag Python objects
+    """
+    return np.frombuffer(payload, dtype=RAW_TAG_DTYPE)
+
+
+def encode_raw_binary(ids, pos, rotation, hamming=0) -> bytes:
+    """
+    Packs N ids, Nx3 positions, Nx3x3 rotations and N hamming distances into the binary layout
+    """
+    tags = np.empty(len(ids), dtype=RAW_TAG_DTYPE)
+    tags["id"] = ids
+    tags["hamming"] = hamming
+    tags["pos"] = pos
+    tags["rotation"] = rotation
+    return tags.tobytes()
+
+
+if __name__ == "__main__":
+    # compare decoding the JSON raw payload (as VRCAprilTag.on_message does) with the binary one.
+    # this times the decode alone, publish_benchmark.py times the whole callback for both
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rng = np.random.default_rng(0)
+
+    for num_tags in [1, 10, 50]:
+        ids = np.arange(num_tags)
+        pos = rng.normal(size=(num_tags, 3))
+        rotation = rng.normal(size=(num_tags, 3, 3))
+
+        json_payload = json.dumps(
+            [
+                {
+                    "id": int(i),
+                    "hamming": 0,
+                    "pos": dict(zip("xyz", p.tolist())),
+                    "rotation": r.tolist(),
+                }
+                for i, p, r in zip(ids, pos, rotation)
+            ]
+        ).encode()
+        binary_payload = encode_raw_binary(ids, pos, rotation)
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for tag in json.loads(json_payload):
+                np.asarray(tag["rotation"])
+        json_us = (time.perf_counter() - start) / iterations * 1e6
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            decode_raw_binary(binary_payload)
+        binary_us = (time.perf_counter() - start) / iterations * 1e6
+
+        print(
+            f"{num_tags:>3} tags: json {len(json_payload):>6} B {json_us:8.2f} us"
+            f"  |  binary {len(binary_payload):>5} B {binary_us:6.2f} us"
+        )
@@ -0,0 +1,83 @@
+# python standard libraries
+import bisect
+import multiprocessing
+
+# pip installed packages
+import numpy
+
+
+class StageHistograms(object):
+    """
+    Fixed-bucket latency histograms for the stages of the AprilTagVPS pipeline, kept in
+    shared memory so the capture, perception and parent processes can all record into them.
+
+    Every process writes only to its own row, so no locking is needed; recording a sample
+    is a bisect and two increments. The parent sums the rows when it reports.
+    """
+
+    STAGES = ["capture", "queue", "detect", "publish"]
+    CAPTURE, QUEUE, DETECT, PUBLISH = range(4)
+    # upper edge of each bucket in ms, anything above the last edge goes in an overflow bucket
+    BUCKET_EDGES_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+    def __init__(self, num_rows):
+        self.num_rows = num_rows
+        self.num_stages = len(self.STAGES)
+        self.num_buckets = len(self.BUCKET_EDGES_MS) + 1
+
+        self.counts = multiprocessing.RawArray(
+            "Q", num_rows * self.num_stages * self.num_buckets
+        )
+        self.totals = multiprocessing.RawArray("d", num_rows * self.num_stages)
+
+        # counts/totals as of the last report, so each report covers only its own interval
+        self.last_counts = numpy.zeros((self.num_stages, self.num_buckets), dtype=numpy.uint64)
+        self.last_totals = numpy.zeros(self.num_stages)
+
+    def record(self, row, stage, seconds):
+        """
+        Records a latency (in seconds) for a stage (an index into STAGES) from the process owning 'row'
+        """
+        ms = seconds * 1000
+        bucket = bisect.bisect_left(self.BUCKET_EDGES_MS, ms)
+        self.counts[(row * self.num_stages + stage) * self.num_buckets + bucket] += 1
+        self.totals[row * self.num_stages + stage] += ms
+
+    def percentile(self, buckets, count, q):
+        """
+        Upper bucket edge below which at least 'q' of the samples fall
+        """
+        target = q * count
+        cumulative = numpy.cumsum(buckets)
+        index = int(numpy.searchsorted(cumulative, target))
+        if index >= len(self.BUCKET_EDGES_MS):
+            return None
+        return self.BUCKET_EDGES_MS[index]
+
+    def report(self):
+        """
+        Aggregates all the rows and returns a dict of per-stage stats for samples recorded
+        since the previous report
+        """
+        counts = numpy.frombuffer(self.counts, dtype=numpy.uint64)  # type: ignore
+        counts = counts.reshape(self.num_rows, self.num_stages, self.num_buckets).sum(axis=0)
+        totals = numpy.frombuffer(self.totals).reshape(self.num_rows, self.num_stages).sum(axis=0)
+
+        interval_counts = counts - self.last_counts
+        interval_totals = totals - self.last_totals
+        self.last_counts = counts
+        self.last_totals = totals
+
+        report = {"bucket_edges_ms": self.BUCKET_EDGES_MS}
+        for stage, name in enumerate(self.STAGES):
+            buckets = interval_counts[stage]
+            count = int(buckets.sum())
+            report[name] = {
+                "count": count,
+                "mean_ms": float(interval_totals[stage] / count) if count else None,
+                "p50_ms": self.percentile(buckets, count, 0.5) if count else None,
+                "p95_ms": self.percentile(buckets, count, 0.95) if count else None,
+                "p99_ms": self.percentile(buckets, count, 0.99) if count else None,
+                "buckets": [int(b) for b in buckets],
+            }
+        return report
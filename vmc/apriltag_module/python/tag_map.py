@@ -0,0 +1,164 @@
+# python standard libraries
+import math
+import sys
+import time
+from collections import defaultdict
+
+# pip installed packages
+import numpy as np
+import transforms3d as t3d
+
+
+class TagMapIndex(object):
+    """
+    Uniform grid over the known tag positions, used to predict which tags should be in view
+    of a camera given the current vehicle pose and roughly where they will land in the image.
+
+    Positions are in cm in the aeroRef (NED) frame, the same units and frame as the "tag_truth"
+    config of VRCAprilTag. Queries only touch the grid cells within range of the camera, so the
+    cost scales with the number of nearby tags rather than the size of the arena.
+    """
+
+    def __init__(self, tag_truth: dict, tag_size: float, cell_size: float = 200.0):
+        """
+        'tag_truth' is {"<id>": {"xyz": [...], "rpy": [...]}}, 'tag_size' is the tag edge length
+        in cm, 'cell_size' is the grid pitch in cm
+        """
+        self.cell_size = cell_size
+
+        half = tag_size / 2
+        # tag corners in the tag frame, same order as the detector reports them
+        tag_corners = np.array(
+            [[-half, half, 0], [half, half, 0], [half, -half, 0], [-half, -half, 0]]
+        )
+
+        ids = []
+        corners = []
+        for tag_id, tag in tag_truth.items():
+            R = t3d.euler.euler2mat(tag["rpy"][0], tag["rpy"][1], tag["rpy"][2], axes="rxyz")
+            corners.append(tag_corners.dot(R.T) + np.asarray(tag["xyz"], dtype=np.float64))
+            ids.append(int(tag_id))
+
+        self.ids = np.array(ids, dtype=np.int64)
+        # Nx4x3 corners in aeroRef, as a flat Nx4 homogeneous point list for projection
+        self.corners = np.array(corners, dtype=np.float64).reshape(-1, 4, 3)
+        self.centers = self.corners.mean(axis=1)
+
+        cells = defaultdict(list)
+        for index, center in enumerate(self.centers):
+            cells[self.cell_of(center[0], center[1])].append(index)
+        self.cells = {cell: np.array(indices) for cell, indices in cells.items()}
+
+    def cell_of(self, n, e):
+        return (int(math.floor(n / self.cell_size)), int(math.floor(e / self.cell_size)))
+
+    def nearby(self, n, e, radius):
+        """
+        Indices of the tags within 'radius' cm (horizontally) of (n, e)
+        """
+        n0, e0 = self.cell_of(n - radius, e - radius)
+        n1, e1 = self.cell_of(n + radius, e + radius)
+
+        found = [
+            self.cells[(i, j)]
+            for i in range(n0, n1 + 1)
+            for j in range(e0, e1 + 1)
+            if (i, j) in self.cells
+        ]
+        if not found:
+            return np.empty(0, dtype=np.int64)
+
+        indices = np.concatenate(found)
+        d = self.centers[indices, :2] - (n, e)
+        return indices[np.einsum("ij,ij->i", d, d) <= radius * radius]
+
+    def predict(
+        self,
+        pos,
+        heading,
+        H_aeroBody_cam,
+        camera_params,
+        res,
+        max_range=500.0,
+        margin=0.25,
+        roll=0.0,
+        pitch=0.0,
+    ):
+        """
+        Predicts the tags visible to a camera.
+
+        'pos' is the vehicle [n, e, d] in cm, 'heading' in degrees, 'roll'/'pitch' in radians.
+        'H_aeroBody_cam' is the camera transform as kept in VRCAprilTag.tm (aeroBody -> camera),
+        'camera_params' is [fx, fy, cx, cy] and 'res' is [width, height].
+
+        Returns the ids of the predicted tags and an Nx4 int array of their image ROIs
+        (x0, y0, x1, y1), grown by 'margin' of the tag's projected size on each side and
+        clipped to the image.
+        """
+        indices = self.nearby(pos[0], pos[1], max_range)
+        if len(indices) == 0:
+            return self.ids[:0], np.empty((0, 4), dtype=np.int32)
+
+        # aeroRef -> camera
+        R_body = t3d.euler.euler2mat(roll, pitch, math.radians(heading), axes="rxyz")
+        H_ref_body = np.eye(4)
+        H_ref_body[:3, :3] = R_body.T
+        H_ref_body[:3, 3] = -R_body.T.dot(pos)
+        H_cam_ref = H_aeroBody_cam.dot(H_ref_body)
+
+        pts = self.corners[indices].dot(H_cam_ref[:3, :3].T) + H_cam_ref[:3, 3]
+
+        # every corner must be in front of the camera
+        in_front = (pts[:, :, 2] > 1.0).all(axis=1)
+        if not in_front.any():
+            return self.ids[:0], np.empty((0, 4), dtype=np.int32)
+        indices = indices[in_front]
+        pts = pts[in_front]
+
+        fx, fy, cx, cy = camera_params
+        u = fx * pts[:, :, 0] / pts[:, :, 2] + cx
+        v = fy * pts[:, :, 1] / pts[:, :, 2] + cy
+
+        x0, x1 = u.min(axis=1), u.max(axis=1)
+        y0, y1 = v.min(axis=1), v.max(axis=1)
+        pad_x = (x1 - x0) * margin
+        pad_y = (y1 - y0) * margin
+
+        rois = np.stack([x0 - pad_x, y0 - pad_y, x1 + pad_x, y1 + pad_y], axis=1)
+        rois = np.clip(rois, 0, [res[0], res[1], res[0], res[1]]).astype(np.int32)
+
+        # drop anything that ended up entirely off the image
+        on_image = (rois[:, 2] > rois[:, 0]) & (rois[:, 3] > rois[:, 1])
+        return self.ids[indices[on_image]], rois[on_image]
+
+
+if __name__ == "__main__":
+    # time a query against a large synthetic arena
+    num_tags = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rng = np.random.default_rng(0)
+
+    # tags laid flat on the floor over a 40m x 40m area
+    tag_truth = {
+        str(i): {"xyz": [float(n), float(e), 0.0], "rpy": [0, 0, 0]}
+        for i, (n, e) in enumerate(rng.uniform(-2000, 2000, (num_tags, 2)))
+    }
+    index = TagMapIndex(tag_truth, tag_size=17.4)
+
+    # downward facing camera, same mounting as VRCAprilTag's default "cam"
+    H_cam_aeroBody = t3d.affines.compose(
+        [13, 0, 8.5], t3d.euler.euler2mat(0, 0, -math.pi / 2, axes="rxyz"), [1, 1, 1]
+    )
+    H_aeroBody_cam = np.linalg.inv(H_cam_aeroBody)
+    camera_params = [784.08, 784.90, 677.12, 385.34]
+
+    iterations = 2000
+    total = 0
+    start = time.perf_counter()
+    for _ in range(iterations):
+        n, e = rng.uniform(-1800, 1800, 2)
+        ids, rois = index.predict(
+            [n, e, -150.0], rng.uniform(0, 360), H_aeroBody_cam, camera_params, [1280, 720]
+        )
+        total += len(ids)
+    per_query = (time.perf_counter() - start) / iterations * 1e6
+    print(f"{num_tags} tags: {per_query:.1f} us/query, {total / iterations:.2f} tags predicted per query")
@@ -12,8 +12,10 @@ from mavsdk import System
 
 try:
     from fcc_library import FCC, PyMAVLinkAgent # type: ignore
+    from mavlink_telemetry import MAVLinkTelemetry # type: ignore
 except ImportError:
     from .fcc_library import FCC, PyMAVLinkAgent
+    from .mavlink_telemetry import MAVLinkTelemetry
 
 class FCCModule(object):
     def __init__(self):
@@ -88,7 +90,10 @@ class FCCModule(object):
             self.offboard_body_queue,
         )
 
-        self.gps_fcc = PyMAVLinkAgent(self.mqtt_client, self.mocap_queue)
+        telemetry = None
+        if self.fcc.telemetry_source == "pymavlink":
+            telemetry = MAVLinkTelemetry(self.fcc)
+        self.gps_fcc = PyMAVLinkAgent(self.mqtt_client, self.mocap_queue, telemetry)
         # connect the drone
         await self.fcc.connect()
 
@@ -2,10 +2,11 @@ import asyncio
 import datetime
 import functools
 import json
-import math
+import os
 import queue
+import threading
 import time
-from typing import Any, Callable, List
+from typing import Any, Callable, List, Optional, Tuple
 
 import mavsdk
 from loguru import logger
@@ -16,6 +17,43 @@ from mavsdk.offboard import VelocityBodyYawspeed, VelocityNedYaw
 from paho.mqtt.client import Client as MQTTClient
 from pymavlink import mavutil
 
+try:
+    from telemetry_bridge import TelemetryBridge  # type: ignore
+    from telemetry_state import TelemetryAggregator  # type: ignore
+except ImportError:
+    from .telemetry_bridge import TelemetryBridge
+    from .telemetry_state import TelemetryAggregator
+
+# state machine event published when the flight mode changes to each mode
+FCC_MODE_EVENTS = {
+    "UNKNOWN": "fcc_unknown_mode_event",
+    "READY": "fcc_ready_mode_event",
+    "TAKEOFF": "fcc_takeoff_mode_event",
+    "HOLD": "fcc_hold_mode_event",
+    "MISSION": "fcc_mission_mode_event",
+    "RETURN_TO_LAUNCH": "fcc_rtl_mode_event",
+    "LAND": "fcc_land_mode_event",
+    "OFFBOARD": "fcc_offboard_mode_event",
+    "FOLLOW_ME": "fcc_follow_mode_event",
+    "MANUAL": "fcc_manual_mode_event",
+    "ALTCTL": "fcc_alt_mode_event",
+    "POSCTL": "fcc_pos_mode_event",
+    "ACRO": "fcc_acro_mode_event",
+    "STABILIZED": "fcc_stabilized_mode_event",
+    "RATTITUDE": "fcc_rattitude_mode_event",
+}
+
+
+# dispatcher priority of the safety actions, lower is more urgent; they preempt any
+# running or queued action with a higher number, all other actions are ordinary
+ACTION_PRIORITIES = {
+    "kill": 0,
+    "land": 1,
+    "disarm": 1,
+}
+ORDINARY_PRIORITY = 10
+
+
 # decorators
 
 
@@ -134,6 +172,154 @@ class MAVMQTTBase:
                 logger.exception("Unexpected error in async_queue_action")
 
 
+class DispatcherBusy(Exception):
+    """
+    Exception for when the action dispatcher already has as many actions waiting as
+    it will queue
+    """
+
+
+class DispatcherManager(MAVMQTTBase):
+    """
+    Runs actions (async funcs) one at a time, in order of priority and then of arrival.
+
+    Safety actions (ACTION_PRIORITIES) do not wait: scheduling one cancels the running
+    action and drops the queued ones if they have a lower priority, so the safety action
+    is the next to run. Other actions queue, up to 'max_queued' waiting. Each action's
+    outcome, time spent queued and time spent running are published to
+    vrc/fcc/actions.
+    """
+
+    def __init__(self, client: MQTTClient, max_queued: int = 5) -> None:
+        super().__init__(client)
+        self.max_queued = max_queued
+        self.timeout = 10
+
+        # (priority, sequence, name, task, payload, time scheduled)
+        self.queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self.sequence = 0
+        # (priority, name, asyncio.Task) of the running action
+        self.currently_running_task = None
+        # (name, result, time scheduled, time started) of the actions a safety
+        # action cancelled or dropped, reported once it has been sent
+        self.preempted: List[Tuple[str, str, float, Any]] = []
+
+    def schedule_task(self, task: Callable, payload: Any, name: str) -> None:
+        """
+        Schedule a task (async func) to be run by the dispatcher with the
+        given payload. Task name is also required for printing.
+        """
+        scheduled = time.perf_counter()
+        priority = ACTION_PRIORITIES.get(name, ORDINARY_PRIORITY)
+
+        # safety actions are logged once sent, see `report_preempted` and `set_kill`
+        if priority < ORDINARY_PRIORITY:
+            self.preempt(priority, name)
+        elif self.waiting() >= self.max_queued:
+            raise DispatcherBusy
+        else:
+            logger.debug(f"Scheduling a task for '{name}'")
+
+        self.sequence += 1
+        self.queue.put_nowait((priority, self.sequence, name, task, payload, scheduled))
+
+    def waiting(self) -> int:
+        """
+        Number of actions waiting, not counting the one the dispatcher is about to take
+        """
+        if self.currently_running_task is None and not self.queue.empty():
+            return self.queue.qsize() - 1
+        return self.queue.qsize()
+
+    def preempt(self, priority: int, name: str) -> None:
+        """
+        Cancels the running action and drops the queued ones if their priority is lower
+        than 'priority'. Nothing is logged or published here, so the safety action
+        is not held up; see `report_preempted`.
+        """
+        if self.currently_running_task is not None:
+            running_priority, _, running_task = self.currently_running_task
+            if running_priority > priority and not running_task.done():
+                running_task.cancel()
+
+        kept = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item[0] > priority:
+                self.preempted.append((item[2], "dropped", item[5], None))
+            else:
+                kept.append(item)
+        for item in kept:
+            self.queue.put_nowait(item)
+
+    def report_preempted(self, by: str) -> None:
+        """
+        Logs, publishes and reports the actions cancelled or dropped by safety action 'by'
+        """
+        preempted, self.preempted = self.preempted, []
+        for name, result, scheduled, started in preempted:
+            verb = "Preempted" if result == "preempted" else "Dropped queued"
+            logger.warning(f"{verb} '{name}' for '{by}'")
+            self._publish_event("action_preempted_event", name)
+            self.report(name, result, scheduled, started)
+
+    async def run(self) -> None:
+        """
+        Runs the queued actions, one after the other
+        """
+        while True:
+            priority, _, name, task, payload, scheduled = await self.queue.get()
+            running = asyncio.create_task(self.task_waiter(task, payload, name, scheduled))
+            self.currently_running_task = (priority, name, running)
+            await asyncio.wait([running])
+            self.currently_running_task = None
+
+    async def task_waiter(self, task: Callable, payload: dict, name: str, scheduled: float):
+        """
+        Execute a task with a timeout.
+        """
+        started = time.perf_counter()
+        try:
+            action = asyncio.ensure_future(task(**payload))
+            if self.preempted:
+                # runs after the action's first step, so once the safety action is sent
+                asyncio.get_running_loop().call_soon(self.report_preempted, name)
+            await asyncio.wait_for(action, timeout=self.timeout)
+            self._publish_event("request_" + name + "_completed_event")
+            self.report(name, "completed", scheduled, started)
+
+        except asyncio.TimeoutError:
+            logger.warning(f"Task '{name}' timed out!")
+            self._publish_event("action_timeout_event", name)
+            self.report(name, "timeout", scheduled, started)
+        except asyncio.CancelledError:
+            self.preempted.append((name, "preempted", scheduled, started))
+        except Exception as e:
+            logger.exception("ERROR IN TASK WAITER")
+            self.report(name, "failed", scheduled, started)
+
+    @try_except()
+    def report(self, name: str, result: str, scheduled: float, started: Any) -> None:
+        """
+        Publishes how long an action waited in the queue and ran for, in ms
+        """
+        now = time.perf_counter()
+        update = {}
+        update["name"] = name
+        update["result"] = result
+        update["queued_ms"] = ((started or now) - scheduled) * 1000
+        update["run_ms"] = (now - started) * 1000 if started is not None else None
+        update["timestamp"] = self._timestamp()
+
+        logger.debug(
+            f"Action '{name}' {result}, queued {update['queued_ms']:.1f} ms, ran "
+            f"{update['run_ms'] or 0:.1f} ms"
+        )
+        self.mqtt_client.publish(
+            f"{self.topic_prefix}/actions", json.dumps(update), retain=False, qos=0
+        )
+
+
 class FCC(MAVMQTTBase):
     def __init__(
         self,
@@ -165,6 +351,23 @@ class FCC(MAVMQTTBase):
         self.connected = False
         self.heading = 0.0
 
+        # forwards telemetry to MQTT at the rates in telemetry_bridge.TELEMETRY_RATES,
+        # with FCC_UPSTREAM_RATES=1 also asking PX4 to stream no faster than that,
+        # and publishes all of it together on vrc/fcc/state at FCC_STATE_RATE Hz (0 is off)
+        self.state = TelemetryAggregator(
+            client, self.topic_prefix, float(os.environ.get("FCC_STATE_RATE", 10))
+        )
+        self.telemetry = TelemetryBridge(client, self.topic_prefix, aggregator=self.state)
+        # where telemetry is read from, "mavsdk" or "pymavlink"
+        self.telemetry_source = os.environ.get("FCC_TELEMETRY", "mavsdk")
+        self.upstream_rates = os.environ.get("FCC_UPSTREAM_RATES") == "1"
+
+        # event loop the action dispatcher runs on, and its DispatcherManager, set once
+        # action_dispatcher starts
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.dispatch: Optional[DispatcherManager] = None
+        self.action_map: dict = {}
+
     async def connect(self) -> None:
         """
         Connect the Drone object.
@@ -177,7 +380,17 @@ class FCC(MAVMQTTBase):
         """
         Gathers the telemetry tasks
         """
+        if self.telemetry_source == "pymavlink":
+            # the telemetry comes from PyMAVLinkAgent's connection instead, see
+            # mavlink_telemetry.py
+            return asyncio.gather(self.telemetry.stats_loop(), self.state.publish_loop())
+
+        if self.upstream_rates:
+            await self.telemetry.set_upstream_rates(self.drone)
+
         return asyncio.gather(
+            self.telemetry.stats_loop(),
+            self.state.publish_loop(),
             # self.connected_status_telemetry(),
             self.battery_telemetry(),
             # self.in_air_telemetry(),
@@ -234,11 +447,8 @@ class FCC(MAVMQTTBase):
             # TODO see if mavsdk supports battery current
             # TODO see is mavsdk supports power draw
             update["soc"] = battery.remaining_percent * 100.0
-            update["timestamp"] = self._timestamp()
 
-            self.mqtt_client.publish(
-                f"{self.topic_prefix}/battery", json.dumps(update), retain=False, qos=0
-            )
+            self.telemetry.put("battery", update)
 
     @async_try_except()
     async def in_air_telemetry(self) -> None:
@@ -271,11 +481,8 @@ class FCC(MAVMQTTBase):
 
             update["armed"] = armed
             update["mode"] = str(self.fcc_mode)
-            update["timestamp"] = self._timestamp()
 
-            self.mqtt_client.publish(
-                f"{self.topic_prefix}/status", json.dumps(update), retain=False, qos=0
-            )
+            self.telemetry.put("status", update)
 
     @async_try_except()
     async def landed_state_telemetry(self) -> None:
@@ -306,24 +513,6 @@ class FCC(MAVMQTTBase):
         """
         Runs the flight_mode telemetry loop
         """
-        fcc_mode_map = {
-            "UNKNOWN": "fcc_unknown_mode_event",
-            "READY": "fcc_ready_mode_event",
-            "TAKEOFF": "fcc_takeoff_mode_event",
-            "HOLD": "fcc_hold_mode_event",
-            "MISSION": "fcc_mission_mode_event",
-            "RETURN_TO_LAUNCH": "fcc_rtl_mode_event",
-            "LAND": "fcc_land_mode_event",
-            "OFFBOARD": "fcc_offboard_mode_event",
-            "FOLLOW_ME": "fcc_follow_mode_event",
-            "MANUAL": "fcc_manual_mode_event",
-            "ALTCTL": "fcc_alt_mode_event",
-            "POSCTL": "fcc_pos_mode_event",
-            "ACRO": "fcc_acro_mode_event",
-            "STABILIZED": "fcc_stabilized_mode_event",
-            "RATTITUDE": "fcc_rattitude_mode_event",
-        }
-
         fcc_mode = "UNKNOWN"
 
         logger.debug(f"flight_mode_telemetry loop started")
@@ -334,15 +523,12 @@ class FCC(MAVMQTTBase):
 
             update["mode"] = str(mode)
             update["armed"] = self.is_armed
-            update["timestamp"] = self._timestamp()
 
-            self.mqtt_client.publish(
-                f"{self.topic_prefix}/status", json.dumps(update), retain=False, qos=0
-            )
+            self.telemetry.put("status", update)
 
             if mode != fcc_mode:
-                if mode in fcc_mode_map.keys():
-                    self._publish_event(fcc_mode_map[str(mode)])
+                if str(mode) in FCC_MODE_EVENTS:
+                    self._publish_event(FCC_MODE_EVENTS[str(mode)])
                 else:
                     self._publish_event("fcc_mode_error_event")
             fcc_mode = mode
@@ -365,14 +551,8 @@ class FCC(MAVMQTTBase):
             update["dX"] = n
             update["dY"] = e
             update["dZ"] = d
-            update["timestamp"] = self._timestamp()
 
-            self.mqtt_client.publish(
-                f"{self.topic_prefix}/location/local",
-                json.dumps(update),
-                retain=False,
-                qos=0,
-            )
+            self.telemetry.put("location/local", update)
 
     @async_try_except()
     async def position_lla_telemetry(self) -> None:
@@ -386,14 +566,8 @@ class FCC(MAVMQTTBase):
             update["lon"] = position.longitude_deg
             update["alt"] = position.relative_altitude_m
             update["hdg"] = self.heading
-            update["timestamp"] = self._timestamp()
 
-            self.mqtt_client.publish(
-                f"{self.topic_prefix}/location/global",
-                json.dumps(update),
-                retain=False,
-                qos=0,
-            )
+            self.telemetry.put("location/global", update)
 
     @async_try_except()
     async def home_lla_telemetry(self) -> None:
@@ -406,14 +580,8 @@ class FCC(MAVMQTTBase):
             update["lat"] = home_position.latitude_deg
             update["lon"] = home_position.longitude_deg
             update["alt"] = home_position.relative_altitude_m  # agl
-            update["timestamp"] = self._timestamp()
 
-            self.mqtt_client.publish(
-                f"{self.topic_prefix}/location/home",
-                json.dumps(update),
-                retain=False,
-                qos=0,
-            )
+            self.telemetry.put("location/home", update)
 
     @async_try_except()
     async def attitude_euler_telemetry(self) -> None:
@@ -437,24 +605,17 @@ class FCC(MAVMQTTBase):
             update["roll"] = psi
             update["pitch"] = theta
             update["yaw"] = phi
-            update["timestamp"] = self._timestamp()
 
+            # yaw_deg is already in degrees, wrap it to 0-360
             if phi < 0:
-                heading = (2 * math.pi) + phi
+                heading = 360 + phi
             else:
                 heading = phi
 
-            heading = math.degrees(heading)
-
             self.heading = heading
 
             # publish the attitude
-            self.mqtt_client.publish(
-                f"{self.topic_prefix}/attitude/euler",
-                json.dumps(update),
-                retain=False,
-                qos=0,
-            )
+            self.telemetry.put("attitude/euler", update)
 
     @async_try_except()
     async def velocity_ned_telemetry(self) -> None:
@@ -469,11 +630,8 @@ class FCC(MAVMQTTBase):
             update["vX"] = velocity.north_m_s
             update["vY"] = velocity.east_m_s
             update["vZ"] = velocity.down_m_s
-            update["timestamp"] = self._timestamp()
 
-            self.mqtt_client.publish(
-                f"{self.topic_prefix}/velocity", json.dumps(update), retain=False, qos=0
-            )
+            self.telemetry.put("velocity", update)
 
     # endregion ###############################################################
 
@@ -481,68 +639,9 @@ class FCC(MAVMQTTBase):
 
     @async_try_except()
     async def action_dispatcher(self) -> None:
-        class DispatcherBusy(Exception):
-            """
-            Exception for when the action dispatcher is currently busy
-            executing another action
-            """
-
-        class DispatcherManager(MAVMQTTBase):
-            def __init__(self, client: MQTTClient) -> None:
-                super().__init__(client)
-                self.currently_running_task = None
-                self.timeout = 10
-
-            async def schedule_task(self, task: Callable, payload: Any, name: str):
-                """
-                Schedule a task (async func) to be run by the dispatcher with the
-                given payload. Task name is also required for printing.
-                """
-                logger.debug(f"Scheduling a task for '{name}'")
-                # if the dispatcher is ok to take on a new task
-                if self.currently_running_task is None:
-                    await self.create_task(task, payload, name)
-                # or if there is already a running task
-                else:  # see if the task is done
-                    if self.currently_running_task.done():
-                        await self.create_task(task, payload, name)
-                    # or tell the caller to go away
-                    else:
-                        raise DispatcherBusy
-
-            async def create_task(self, task: Callable, payload: dict, name: str):
-                """
-                Create a task to be run.
-                """
-                self.currently_running_task = asyncio.create_task(
-                    self.task_waiter(task, payload, name)
-                )
-
-            async def task_waiter(self, task: Callable, payload: dict, name: str):
-                """
-                Execute a task with a timeout.
-                """
-                try:
-                    await asyncio.wait_for(task(**payload), timeout=self.timeout)
-                    self._publish_event(
-                        "request_" + name + "_completed_event"
-                    )
-                    # Logging.normal(prefix, f"Task '{name}' returned")
-                    self.currently_running_task = None
-
-                except asyncio.TimeoutError:
-                    try:
-                        logger.warning(f"Task '{name}' timed out!")
-                        self._publish_event("action_timeout_event", name)
-                        self.currently_running_task = None
-                    except Exception as e:
-                        logger.exception("ERROR IN TIMEOUT HANDLER")
-                except Exception as e:
-                    logger.exception("ERROR IN TASK WAITER")
-
         logger.debug(f"action_dispatcher started")
 
-        action_map = {
+        self.action_map = {
             "break": self.set_intentional_timeout,
             "connect": self.connect,
             "arm": self.set_arm,
@@ -559,29 +658,56 @@ class FCC(MAVMQTTBase):
             "resume_mission": self.resume_mission,
         }
 
-        dispatch = DispatcherManager(self.mqtt_client)
+        self.dispatch = DispatcherManager(self.mqtt_client)
+        self.loop = asyncio.get_event_loop()
 
+        # actions can also be put on action_queue, a thread hands them on as they come
+        if self.action_queue is not None:
+            threading.Thread(
+                target=self.action_queue_loop, daemon=True, name="fcc_action_queue_thread"
+            ).start()
+
+        await self.dispatch.run()
+
+    def put_action(self, action: dict) -> None:
+        """
+        Hands an action ({"name": ..., "payload": json string}) to the dispatcher. Safe
+        to call from any thread, such as the MQTT client's: the action is scheduled
+        straight from the event loop, so a safety action preempts as soon as the loop
+        gets to it
+        """
+        if self.loop is None:
+            logger.warning(f"Action dispatcher not running, dropping '{action['name']}'")
+            return
+        self.loop.call_soon_threadsafe(self.schedule_action, action)
+
+    def action_queue_loop(self) -> None:
+        """
+        Moves actions from action_queue to the dispatcher
+        """
         while True:
-            try:
-                # TODO - Casey, 6/27 start here and make action into a dict instead of proto
-                action = self.action_queue.get_nowait()
-
-                if action["payload"] == "":
-                    # Logging.normal(prefix,"Creating empty JSON string because payload was empty")
-                    action["payload"] = "{}"
-
-                if action["name"] in action_map:
-                    payload = json.loads(action["payload"])
-                    await dispatch.schedule_task(
-                        action_map[action["name"]], payload, action["name"]
-                    )
-            except DispatcherBusy:
-                logger.info("I'm busy running another task, try again later")
-                self._publish_event("fcc_busy_event", payload=action["name"])
-            except queue.Empty:
-                await asyncio.sleep(0.1)
-            except Exception as e:
-                logger.exception("ERROR IN MAIN LOOP")
+            self.put_action(self.action_queue.get())
+
+    def schedule_action(self, action: dict) -> None:
+        """
+        Schedules an action on the dispatcher, runs on the event loop
+        """
+        try:
+            # TODO - Casey, 6/27 start here and make action into a dict instead of proto
+            if action["payload"] == "":
+                # Logging.normal(prefix,"Creating empty JSON string because payload was empty")
+                action["payload"] = "{}"
+
+            if action["name"] in self.action_map:
+                payload = json.loads(action["payload"])
+                self.dispatch.schedule_task(  # type: ignore
+                    self.action_map[action["name"]], payload, action["name"]
+                )
+        except DispatcherBusy:
+            logger.info("Too many actions queued, try again later")
+            self._publish_event("fcc_busy_event", payload=action["name"])
+        except Exception as e:
+            logger.exception("ERROR IN MAIN LOOP")
 
     async def simple_action_executor(
         self,
@@ -641,8 +767,8 @@ class FCC(MAVMQTTBase):
         Sets the drone to a kill state. This will forcefully shut off the drone
         regardless of being in the air or not.
         """
-        logger.warning("Sending kill command")
         await self.simple_action_executor(self.drone.action.kill, "kill")
+        logger.warning("Sent kill command")
 
     @async_try_except(reraise=True)
     async def set_land(self, **kwargs) -> None:
@@ -1004,9 +1130,13 @@ class MissionAPI(MAVMQTTBase):
 
 
 class PyMAVLinkAgent(MAVMQTTBase):
-    def __init__(self, client: MQTTClient, mocap_queue: queue.Queue) -> None:
+    def __init__(
+        self, client: MQTTClient, mocap_queue: queue.Queue, telemetry: Any = None
+    ) -> None:
         super().__init__(client)
         self.mocap_queue = mocap_queue
+        # a mavlink_telemetry.MAVLinkTelemetry to read telemetry from the connection
+        self.telemetry = telemetry
 
     @async_try_except()
     async def run(self) -> None:
@@ -1021,7 +1151,10 @@ class PyMAVLinkAgent(MAVMQTTBase):
         )
 
         await loop.run_in_executor(None, self.wait_for_heartbeat)
-        asyncio.gather(self.set_hil_gps())
+        if self.telemetry is not None:
+            asyncio.gather(self.set_hil_gps(), self.telemetry.run(self.master))
+        else:
+            asyncio.gather(self.set_hil_gps())
 
         while True:
             await asyncio.sleep(3)
@@ -0,0 +1,240 @@
+"""
+Compares the CPU it takes to turn 1000 MAVLink telemetry messages into MQTT updates
+through mavsdk (FCC's telemetry loops, fed by mavsdk_server over gRPC) and straight from
+pymavlink (MAVLinkTelemetry), both publishing every update through an unconnected paho
+client.
+
+The stream is a telemetry log (.tlog, as QGroundControl and MAVProxy record them), or
+if none is given one is generated: a vehicle circling with ATTITUDE at 100 Hz,
+GLOBAL_POSITION_INT at 50 Hz, LOCAL_POSITION_NED at 30 Hz, SYS_STATUS and
+EXTENDED_SYS_STATE at 5 Hz and HEARTBEAT at 1 Hz, roughly what PX4 streams on an onboard
+link, and saved for reuse in the temp directory.
+
+The pymavlink path parses the recorded frames as the connection would. The mavsdk path
+has to run in real time: another process sends the stream over UDP to the mavsdk_server
+that mavsdk starts, and the CPU of this process and of mavsdk_server while it plays,
+less what they use sitting idle for as long, is counted.
+
+usage: python3 mavlink_benchmark.py [stream.tlog] [seconds to generate]
+"""
+import asyncio
+import multiprocessing
+import os
+import socket
+import struct
+import sys
+import tempfile
+import time
+from math import cos, sin, pi
+
+from paho.mqtt.client import Client as MQTTClient
+from pymavlink import mavutil
+from pymavlink.dialects.v20 import common as mavlink2
+
+try:
+    from fcc_library import FCC  # type: ignore
+    from mavlink_telemetry import MAVLinkTelemetry  # type: ignore
+    from telemetry_bridge import TELEMETRY_RATES, TelemetryBridge  # type: ignore
+except ImportError:
+    from .fcc_library import FCC
+    from .mavlink_telemetry import MAVLinkTelemetry
+    from .telemetry_bridge import TELEMETRY_RATES, TelemetryBridge
+
+MAVSDK_PORT = 14641
+UNLIMITED = {topic: (0, setter) for topic, (rate, setter) in TELEMETRY_RATES.items()}
+
+
+class CountingClient(MQTTClient):
+    def __init__(self):
+        super().__init__()
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.published += 1
+        return super().publish(topic, payload, qos, retain)
+
+
+def generate(path, seconds):
+    """
+    Writes a tlog of a vehicle flying a 10 m circle every 20 s at 5 m, in POSCTL
+    """
+    mav = mavlink2.MAVLink(None, srcSystem=1, srcComponent=1)
+    rates = {"ATTITUDE": 100, "GLOBAL_POSITION_INT": 50, "LOCAL_POSITION_NED": 30, "SYS_STATUS": 5,
+             "EXTENDED_SYS_STATE": 5, "HEARTBEAT": 1}
+    start_us = int(time.time() * 1e6)
+    with open(path, "wb") as f:
+        for tick in range(int(seconds * 1000)):
+            t = tick / 1000
+            ms = tick
+            w = 2 * pi / 20
+            north, east, down = 10 * cos(w * t), 10 * sin(w * t), -5.0
+            vn, ve = -10 * w * sin(w * t), 10 * w * cos(w * t)
+            yaw = (w * t + pi / 2 + pi) % (2 * pi) - pi
+            for name, rate in rates.items():
+                if tick % (1000 // rate):
+                    continue
+                if name == "ATTITUDE":
+                    msg = mav.attitude_encode(ms, 0.02, -0.03, yaw, 0.0, 0.0, w)
+                elif name == "GLOBAL_POSITION_INT":
+                    msg = mav.global_position_int_encode(
+                        ms, int((32.8 + north / 111111) * 1e7), int((-97.1 + east / 93000) * 1e7), 200000,
+                        5000, int(vn * 100), int(ve * 100), 0, int(((yaw * 180 / pi) % 360) * 100),
+                    )
+                elif name == "LOCAL_POSITION_NED":
+                    msg = mav.local_position_ned_encode(ms, north, east, down, vn, ve, 0.0)
+                elif name == "SYS_STATUS":
+                    msg = mav.sys_status_encode(0, 0, 0, 500, 15800, 1200, 80 - int(t / 60), 0, 0, 0, 0, 0, 0)
+                elif name == "EXTENDED_SYS_STATE":
+                    msg = mav.extended_sys_state_encode(0, mavlink2.MAV_LANDED_STATE_IN_AIR)
+                else:
+                    msg = mav.heartbeat_encode(
+                        mavlink2.MAV_TYPE_QUADROTOR, mavlink2.MAV_AUTOPILOT_PX4,
+                        mavlink2.MAV_MODE_FLAG_SAFETY_ARMED | mavlink2.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED,
+                        3 << 16, mavlink2.MAV_STATE_ACTIVE,
+                    )
+                f.write(struct.pack(">Q", start_us + tick * 1000) + msg.pack(mav))
+
+
+def read_tlog(path):
+    """
+    The frames in a tlog, as (seconds from the start, bytes)
+    """
+    log = mavutil.mavlink_connection(path, dialect="common")
+    frames = []
+    while True:
+        msg = log.recv_msg()
+        if msg is None:
+            break
+        if msg.get_type() != "BAD_DATA":
+            frames.append((msg._timestamp, msg.get_msgbuf()))
+    start = frames[0][0]
+    return [(t - start, bytes(buf)) for t, buf in frames]
+
+
+def make_fcc(drone=None):
+    client = CountingClient()
+    fcc = FCC(drone, client, None, None, None)
+    fcc.telemetry = TelemetryBridge(client, fcc.topic_prefix, UNLIMITED)
+    return fcc, client
+
+
+async def pymavlink_path(frames, repeat=5):
+    """
+    CPU seconds per 1000 messages to only parse the frames, and to parse and publish them
+    """
+    results = []
+    for publish in (False, True):
+        best = float("inf")
+        for _ in range(repeat):
+            fcc, client = make_fcc()
+            telemetry = MAVLinkTelemetry(fcc)
+            parser = mavlink2.MAVLink(None, srcSystem=254)
+            start = time.process_time()
+            for _, buf in frames:
+                for msg in parser.parse_buffer(buf) or ():
+                    if publish:
+                        telemetry.handle(msg)
+            best = min(best, time.process_time() - start)
+        results.append(best / len(frames) * 1000)
+    return results[0], results[1], client.published
+
+
+def send(frames, port, start):
+    """
+    Sends heartbeats to the port until time.monotonic() reaches 'start', then plays the
+    frames to it in real time. Runs in its own process, so its CPU is not counted
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    heartbeat = next(buf for _, buf in frames if buf[7 if buf[0] == 0xFD else 5] == 0)
+    while time.monotonic() < start:
+        sock.sendto(heartbeat, ("127.0.0.1", port))
+        time.sleep(min(1.0, max(start - time.monotonic(), 0)))
+    for t, buf in frames:
+        delay = start + t - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        sock.sendto(buf, ("127.0.0.1", port))
+
+
+def process_cpu(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def mavsdk_path(frames):
+    """
+    CPU seconds per 1000 messages to get the frames through mavsdk_server and the FCC
+    telemetry loops, and the number of updates published
+    """
+    from mavsdk import System
+
+    # the sender is started before mavsdk, as gRPC does not like being forked; it gives
+    # mavsdk 5 s to start and discover the vehicle, then as long as the stream to idle
+    duration = frames[-1][0]
+    start = time.monotonic() + 5 + duration
+    sender = multiprocessing.Process(target=send, args=(frames, MAVSDK_PORT, start))
+    sender.start()
+
+    drone = System()
+    await drone.connect(system_address=f"udp://:{MAVSDK_PORT}")
+    server = drone._server_process.pid
+    # the telemetry streams only start once the vehicle has been discovered
+    async for state in drone.core.connection_state():
+        if state.is_connected:
+            break
+    fcc, client = make_fcc(drone)
+    loops = asyncio.gather(
+        fcc.battery_telemetry(),
+        fcc.is_armed_telemetry(),
+        fcc.flight_mode_telemetry(),
+        fcc.landed_state_telemetry(),
+        fcc.position_ned_telemetry(),
+        fcc.position_lla_telemetry(),
+        fcc.attitude_euler_telemetry(),
+        fcc.velocity_ned_telemetry(),
+    )
+
+    await asyncio.sleep(start - duration - time.monotonic())
+    idle_start = (time.process_time(), process_cpu(server))
+    await asyncio.sleep(start - time.monotonic())
+    idle = (time.process_time() - idle_start[0], process_cpu(server) - idle_start[1])
+
+    published = client.published
+    busy_start = (time.process_time(), process_cpu(server))
+    await asyncio.get_event_loop().run_in_executor(None, sender.join)
+    await asyncio.sleep(0.5)
+    busy = (time.process_time() - busy_start[0], process_cpu(server) - busy_start[1])
+    published = client.published - published
+
+    loops.cancel()
+    try:
+        await loops
+    except asyncio.CancelledError:
+        pass
+    drone._stop_mavsdk_server()
+    per_1000 = [(b - i) / len(frames) * 1000 for b, i in zip(busy, idle)]
+    return per_1000, idle, published
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(tempfile.gettempdir(), "telemetry_benchmark.tlog")
+    if not os.path.exists(path):
+        generate(path, float(sys.argv[2]) if len(sys.argv) > 2 else 20)
+        print(f"generated {path}")
+    frames = read_tlog(path)
+    duration = frames[-1][0]
+    print(f"{len(frames)} messages over {duration:.1f} s ({len(frames) / duration:.0f} per s)")
+
+    parse_ms, handle_ms, published = asyncio.run(pymavlink_path(frames))
+    print(
+        f"pymavlink: {handle_ms * 1000:.1f} ms CPU per 1000 messages, of which parsing "
+        f"{parse_ms * 1000:.1f} ms, {published} updates published"
+    )
+
+    (python_s, server_s), idle, published = asyncio.run(mavsdk_path(frames))
+    print(
+        f"mavsdk: {(python_s + server_s) * 1000:.1f} ms CPU per 1000 messages, {python_s * 1000:.1f} ms in "
+        f"python and {server_s * 1000:.1f} ms in mavsdk_server, {published} updates published "
+        f"(idle for {duration:.0f} s: {idle[0]:.2f} s python, {idle[1]:.2f} s mavsdk_server, not counted)"
+    )
@@ -0,0 +1,174 @@
+import asyncio
+import math
+from typing import Any
+
+from loguru import logger
+from pymavlink import mavutil
+
+try:
+    from fcc_library import FCC, FCC_MODE_EVENTS  # type: ignore
+except ImportError:
+    from .fcc_library import FCC, FCC_MODE_EVENTS
+
+mavlink = mavutil.mavlink
+
+# PX4 main mode, and auto sub mode, in custom_mode, to the mavsdk flight mode names
+PX4_MAIN_MODES = {
+    1: "MANUAL",
+    2: "ALTCTL",
+    3: "POSCTL",
+    5: "ACRO",
+    6: "OFFBOARD",
+    7: "STABILIZED",
+    8: "RATTITUDE",
+}
+PX4_AUTO_MODES = {
+    1: "READY",
+    2: "TAKEOFF",
+    3: "HOLD",
+    4: "MISSION",
+    5: "RETURN_TO_LAUNCH",
+    6: "LAND",
+    8: "FOLLOW_ME",
+}
+PX4_MAIN_MODE_AUTO = 4
+
+# EXTENDED_SYS_STATE landed_state to the mavsdk landed state names
+LANDED_STATES = {
+    mavlink.MAV_LANDED_STATE_UNDEFINED: "UNKNOWN",
+    mavlink.MAV_LANDED_STATE_ON_GROUND: "ON_GROUND",
+    mavlink.MAV_LANDED_STATE_IN_AIR: "IN_AIR",
+    mavlink.MAV_LANDED_STATE_TAKEOFF: "TAKING_OFF",
+    mavlink.MAV_LANDED_STATE_LANDING: "LANDING",
+}
+
+
+def px4_flight_mode(custom_mode: int) -> str:
+    main_mode = (custom_mode >> 16) & 0xFF
+    if main_mode == PX4_MAIN_MODE_AUTO:
+        return PX4_AUTO_MODES.get((custom_mode >> 24) & 0xFF, "UNKNOWN")
+    return PX4_MAIN_MODES.get(main_mode, "UNKNOWN")
+
+
+class MAVLinkTelemetry(object):
+    """
+    Telemetry straight from a pymavlink connection, in place of FCC's mavsdk telemetry
+    loops (FCC_TELEMETRY=pymavlink). Decodes ATTITUDE, LOCAL_POSITION_NED,
+    GLOBAL_POSITION_INT, SYS_STATUS, HEARTBEAT and EXTENDED_SYS_STATE into the same
+    topics, payloads and state machine events, through the FCC's telemetry bridge, and
+    keeps the FCC's state (armed, mode, in air, heading) up to date the same way.
+    """
+
+    # how long to wait when there are no messages to read, and how many to read
+    # before letting other tasks run
+    POLL_PERIOD = 0.005
+    BATCH = 100
+
+    def __init__(self, fcc: FCC, system_id: int = 1) -> None:
+        self.fcc = fcc
+        self.system_id = system_id
+
+        self.was_armed = False
+        self.fcc_mode = "UNKNOWN"
+        self.landed_state = "UNKNOWN"
+
+        self.handlers = {
+            "ATTITUDE": self.attitude,
+            "LOCAL_POSITION_NED": self.local_position_ned,
+            "GLOBAL_POSITION_INT": self.global_position_int,
+            "SYS_STATUS": self.sys_status,
+            "HEARTBEAT": self.heartbeat,
+            "EXTENDED_SYS_STATE": self.extended_sys_state,
+        }
+
+    async def run(self, master: Any) -> None:
+        """
+        Reads and handles messages from the connection as they come
+        """
+        logger.debug("pymavlink telemetry loop started")
+        while True:
+            msg = None
+            try:
+                for _ in range(self.BATCH):
+                    msg = master.recv_msg()
+                    if msg is None:
+                        break
+                    self.handle(msg)
+            except Exception as e:
+                logger.exception("Unexpected error in pymavlink telemetry loop")
+            await asyncio.sleep(self.POLL_PERIOD if msg is None else 0)
+
+    def handle(self, msg: Any) -> None:
+        handler = self.handlers.get(msg.get_type())
+        if handler is not None and msg.get_srcSystem() == self.system_id:
+            handler(msg)
+
+    def attitude(self, msg: Any) -> None:
+        update = {}
+        update["roll"] = math.degrees(msg.roll)
+        update["pitch"] = math.degrees(msg.pitch)
+        update["yaw"] = math.degrees(msg.yaw)
+
+        heading = update["yaw"]
+        if heading < 0:
+            heading += 360
+        self.fcc.heading = heading
+
+        self.fcc.telemetry.put("attitude/euler", update)
+
+    def local_position_ned(self, msg: Any) -> None:
+        update = {}
+        update["dX"] = msg.x
+        update["dY"] = msg.y
+        update["dZ"] = msg.z
+        self.fcc.telemetry.put("location/local", update)
+
+    def global_position_int(self, msg: Any) -> None:
+        update = {}
+        update["lat"] = msg.lat * 1e-7
+        update["lon"] = msg.lon * 1e-7
+        update["alt"] = msg.relative_alt * 1e-3
+        update["hdg"] = self.fcc.heading
+        self.fcc.telemetry.put("location/global", update)
+
+        # mavsdk's velocity_ned comes from this message too
+        update = {}
+        update["vX"] = msg.vx * 1e-2
+        update["vY"] = msg.vy * 1e-2
+        update["vZ"] = msg.vz * 1e-2
+        self.fcc.telemetry.put("velocity", update)
+
+    def sys_status(self, msg: Any) -> None:
+        update = {}
+        update["voltage"] = msg.voltage_battery * 1e-3 * 4  # bc 4 cell, as FCC does
+        update["soc"] = float(msg.battery_remaining)
+        self.fcc.telemetry.put("battery", update)
+
+    def heartbeat(self, msg: Any) -> None:
+        # only the autopilot's, not those of other components on the system
+        if msg.autopilot == mavlink.MAV_AUTOPILOT_INVALID:
+            return
+
+        armed = bool(msg.base_mode & mavlink.MAV_MODE_FLAG_SAFETY_ARMED)
+        if armed != self.was_armed:
+            self.fcc._publish_event("fcc_armed_event" if armed else "fcc_disarmed_event")
+        self.was_armed = armed
+        self.fcc.is_armed = armed
+
+        mode = px4_flight_mode(msg.custom_mode)
+        if mode != self.fcc_mode:
+            self.fcc._publish_event(FCC_MODE_EVENTS.get(mode, "fcc_mode_error_event"))
+        self.fcc_mode = mode
+        self.fcc.fcc_mode = mode
+
+        update = {}
+        update["armed"] = armed
+        update["mode"] = mode
+        self.fcc.telemetry.put("status", update)
+
+    def extended_sys_state(self, msg: Any) -> None:
+        state = LANDED_STATES.get(msg.landed_state, "UNKNOWN")
+        if state != self.landed_state:
+            self.fcc._publish_event(f"landed_state_{state.lower()}_event")
+        self.landed_state = state
+        self.fcc.in_air = state == "IN_AIR"
@@ -0,0 +1,166 @@
+"""
+Runs FCC's telemetry coroutines against a fake drone streaming at typical PX4 rates, once
+forwarding every update as FCC used to and once through the rate limits in
+TELEMETRY_RATES, and reports updates received and published per topic, the CPU time the
+process spent and what a forwarded and a held back update cost on their own. Publishes go
+through an unconnected paho client, which still builds each packet. Also checks that the
+last update published on each topic is the last one the drone sent, that the
+vrc/fcc/state snapshot goes out at its rate and holds the latest of every stream, and
+compares the cost of stamping an update against formatting a timestamp string for each.
+
+usage: python3 telemetry_benchmark.py [seconds]
+"""
+import asyncio
+import json
+import sys
+import time
+from types import SimpleNamespace
+
+from paho.mqtt.client import Client as MQTTClient
+
+try:
+    from fcc_library import FCC  # type: ignore
+    from telemetry_bridge import TELEMETRY_RATES, TelemetryBridge  # type: ignore
+    from telemetry_state import TelemetryAggregator  # type: ignore
+except ImportError:
+    from .fcc_library import FCC
+    from .telemetry_bridge import TELEMETRY_RATES, TelemetryBridge
+    from .telemetry_state import TelemetryAggregator
+
+# mavsdk telemetry stream: (updates per second, sample at time t)
+STREAMS = {
+    "attitude_euler": (100, lambda t: SimpleNamespace(roll_deg=t, pitch_deg=-t, yaw_deg=t % 360 - 180)),
+    "velocity_ned": (50, lambda t: SimpleNamespace(north_m_s=t, east_m_s=0.5, down_m_s=-0.1)),
+    "position": (50, lambda t: SimpleNamespace(latitude_deg=32 + t * 1e-6, longitude_deg=-97.0, relative_altitude_m=t)),
+    "battery": (10, lambda t: SimpleNamespace(voltage_v=3.9, remaining_percent=0.8)),
+    "armed": (5, lambda t: False),
+    "flight_mode": (5, lambda t: "HOLD"),
+    "landed_state": (5, lambda t: "ON_GROUND"),
+}
+
+
+class FakeTelemetry(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.sent = {}
+
+    def stream(self, name):
+        rate, sample = STREAMS[name]
+
+        async def updates():
+            start = time.monotonic()
+            for i in range(int(self.seconds * rate)):
+                delay = start + i / rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                value = sample(i / rate)
+                self.sent[name] = value
+                yield value
+
+        return updates
+
+    def __getattr__(self, name):
+        if name in STREAMS:
+            return self.stream(name)
+        raise AttributeError(name)
+
+
+class CountingClient(MQTTClient):
+    def __init__(self):
+        super().__init__()
+        self.published = {}
+        self.last = {}
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.published[topic] = self.published.get(topic, 0) + 1
+        self.last[topic] = payload
+        return super().publish(topic, payload, qos, retain)
+
+
+async def fly(rates, seconds):
+    client = CountingClient()
+    drone = SimpleNamespace(telemetry=FakeTelemetry(seconds))
+    fcc = FCC(drone, client, None, None, None)
+    fcc.state = TelemetryAggregator(client, fcc.topic_prefix, rate=10)
+    fcc.telemetry = TelemetryBridge(client, fcc.topic_prefix, rates, aggregator=fcc.state)
+
+    start = time.process_time()
+    state_loop = asyncio.create_task(fcc.state.publish_loop())
+    await asyncio.gather(
+        fcc.battery_telemetry(),
+        fcc.is_armed_telemetry(),
+        fcc.flight_mode_telemetry(),
+        fcc.landed_state_telemetry(),
+        fcc.position_lla_telemetry(),
+        fcc.attitude_euler_telemetry(),
+        fcc.velocity_ned_telemetry(),
+    )
+    # let held back updates go out
+    await asyncio.sleep(1)
+    state_loop.cancel()
+    cpu = time.process_time() - start
+    return cpu, fcc.telemetry.take_stats(seconds), client, drone.telemetry
+
+
+async def time_put(count=20000):
+    """
+    Per update cost (us) of TelemetryBridge.put forwarding an attitude update, and holding
+    one back
+    """
+    update = {"roll": 1.5, "pitch": -0.5, "yaw": 90.0, "timestamp": "2021-07-01T12:00:00.000000"}
+    results = []
+    for rate in (0, 10):
+        bridge = TelemetryBridge(CountingClient(), rates={"attitude/euler": (rate, None)})
+        start = time.perf_counter()
+        for _ in range(count):
+            bridge.put("attitude/euler", update)
+        results.append((time.perf_counter() - start) / count * 1e6)
+    return results
+
+
+def time_stamps(count=100000):
+    """
+    Per update cost (us) of the timestamp string FCC used to format for every update, and
+    of the two integer clocks the bridge reads instead
+    """
+    fcc = FCC(None, None, None, None, None)
+    start = time.perf_counter()
+    for _ in range(count):
+        fcc._timestamp()
+    string_us = (time.perf_counter() - start) / count * 1e6
+    start = time.perf_counter()
+    for _ in range(count):
+        time.monotonic_ns()
+        time.time_ns()
+    return string_us, (time.perf_counter() - start) / count * 1e6
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    unlimited = {topic: (0, setter) for topic, (rate, setter) in TELEMETRY_RATES.items()}
+
+    forwarded_us, held_us = asyncio.run(time_put())
+    print(f"per update: {forwarded_us:.1f} us forwarded, {held_us:.1f} us held back")
+    string_us, clocks_us = time_stamps()
+    print(f"stamping an update: {string_us:.2f} us for a timestamp string, {clocks_us:.2f} us for the clocks")
+
+    for label, rates in (("every update", unlimited), ("rate limited", TELEMETRY_RATES)):
+        cpu, stats, client, telemetry = asyncio.run(fly(rates, seconds))
+        received = sum(s["received"] for s in stats["streams"].values())
+        forwarded = sum(s["forwarded"] for s in stats["streams"].values())
+        print(f"{label}: {received} updates received, {forwarded} published, {cpu:.2f} s CPU in {seconds + 1:.0f} s")
+        for topic, s in stats["streams"].items():
+            if s["received"]:
+                print(f"    {topic:>16}: {s['received_rate']:6.1f} Hz in, {s['forwarded_rate']:6.1f} Hz out")
+
+        last_yaw = json.loads(client.last["vrc/fcc/attitude/euler"])["yaw"]
+        last_north = json.loads(client.last["vrc/fcc/velocity"])["vX"]
+        assert last_yaw == telemetry.sent["attitude_euler"].yaw_deg, "last attitude not published"
+        assert last_north == telemetry.sent["velocity_ned"].north_m_s, "last velocity not published"
+
+        state = json.loads(client.last["vrc/fcc/state"])
+        assert state["attitude_euler"]["yaw"] == last_yaw, "state is missing the last attitude"
+        assert state["velocity"]["vX"] == last_north, "state is missing the last velocity"
+        print(f"    {client.published['vrc/fcc/state']} state snapshots")
+
+    print(json.dumps(state, indent=2))
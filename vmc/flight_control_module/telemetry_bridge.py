@@ -0,0 +1,188 @@
+import asyncio
+import datetime
+import json
+import time
+from typing import Any, Dict, Optional
+
+from loguru import logger
+from paho.mqtt.client import Client as MQTTClient
+
+# topic (under vrc/fcc): (most updates per second forwarded, 0 forwards every update,
+# mavsdk telemetry set_rate_* call for the stream feeding the topic, or None).
+# set_rate_velocity_ned and set_rate_position both set the GLOBAL_POSITION_INT interval,
+# see SHARED_MESSAGES; the other setters each have a message of their own
+TELEMETRY_RATES = {
+    "attitude/euler": (10, "set_rate_attitude"),
+    "velocity": (10, "set_rate_velocity_ned"),
+    "location/global": (5, "set_rate_position"),
+    "location/local": (10, "set_rate_position_velocity_ned"),
+    "location/home": (1, "set_rate_home"),
+    "battery": (1, "set_rate_battery"),
+    "status": (0, None),
+}
+
+# mavsdk set_rate_* calls that set the interval of the same MAVLink message, where the
+# last call wins, so only one of them is made, at the highest rate asked for
+SHARED_MESSAGES = {
+    "set_rate_position": "GLOBAL_POSITION_INT",
+    "set_rate_velocity_ned": "GLOBAL_POSITION_INT",
+}
+
+
+class TelemetryStream(object):
+    """
+    Rate limit and counters for one telemetry topic
+    """
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.period_ns = int(1e9 / rate) if rate else 0
+        self.last_sent_ns: Optional[int] = None
+        # newest update held back by the rate limit with the time.time_ns() it arrived
+        # at, and the timer that will send it
+        self.pending: Optional[tuple] = None
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+        self.received = 0
+        self.forwarded = 0
+
+
+class TelemetryBridge(object):
+    """
+    Forwards telemetry updates to MQTT, at no more than the rate configured for their
+    topic. An update that arrives while its topic is rate limited is held until the
+    topic may send again, and replaced by any newer one in the meantime, so consumers
+    always get the latest value and nothing is serialized only to be thrown away.
+    Topics that are not in the table are forwarded as they come.
+
+    Updates are stamped with the time they arrived at, and the "timestamp" string the
+    topics carry is only formatted for the ones forwarded. Every update is also handed
+    to 'aggregator', if given, for the vrc/fcc/state snapshot.
+    """
+
+    def __init__(
+        self,
+        client: MQTTClient,
+        topic_prefix: str = "vrc/fcc",
+        rates: Dict[str, tuple] = TELEMETRY_RATES,
+        stats_period: float = 1.0,
+        aggregator: Any = None,
+    ) -> None:
+        self.mqtt_client = client
+        self.topic_prefix = topic_prefix
+        self.rates = rates
+        self.stats_period = stats_period
+        self.aggregator = aggregator
+
+        self.streams = {topic: TelemetryStream(rate) for topic, (rate, _) in rates.items()}
+
+    def put(self, topic: str, update: dict) -> None:
+        """
+        Takes an update for 'topic' and forwards it now, or once the rate limit allows.
+        Must be called from the event loop.
+        """
+        now_ns = time.monotonic_ns()
+        epoch_ns = time.time_ns()
+        if self.aggregator is not None:
+            self.aggregator.update(topic, update, now_ns, epoch_ns)
+
+        stream = self.streams.get(topic)
+        if stream is None:
+            stream = self.streams[topic] = TelemetryStream(0)
+        stream.received += 1
+
+        if stream.handle is None and (
+            stream.last_sent_ns is None or now_ns - stream.last_sent_ns >= stream.period_ns
+        ):
+            self.forward(topic, stream, update, epoch_ns, now_ns)
+            return
+
+        stream.pending = (update, epoch_ns)
+        if stream.handle is None:
+            stream.handle = asyncio.get_event_loop().call_later(
+                (stream.last_sent_ns + stream.period_ns - now_ns) / 1e9, self.flush, topic
+            )
+
+    def flush(self, topic: str) -> None:
+        """
+        Sends the update held back for 'topic'
+        """
+        stream = self.streams[topic]
+        stream.handle = None
+        if stream.pending is not None:
+            (update, epoch_ns), stream.pending = stream.pending, None
+            self.forward(topic, stream, update, epoch_ns, time.monotonic_ns())
+
+    def forward(
+        self, topic: str, stream: TelemetryStream, update: dict, epoch_ns: int, now_ns: int
+    ) -> None:
+        stream.last_sent_ns = now_ns
+        stream.forwarded += 1
+        # same format as MAVMQTTBase._timestamp(), for when the update arrived
+        payload = dict(update)
+        payload["timestamp"] = datetime.datetime.fromtimestamp(epoch_ns / 1e9).isoformat()
+        self.mqtt_client.publish(
+            f"{self.topic_prefix}/{topic}", json.dumps(payload), retain=False, qos=0
+        )
+
+    def take_stats(self, elapsed: float) -> dict:
+        """
+        Received and forwarded updates per topic since the last call, which resets them
+        """
+        streams = {}
+        for topic, stream in self.streams.items():
+            streams[topic] = {
+                "limit": stream.rate,
+                "received": stream.received,
+                "forwarded": stream.forwarded,
+                "received_rate": stream.received / elapsed if elapsed > 0 else 0.0,
+                "forwarded_rate": stream.forwarded / elapsed if elapsed > 0 else 0.0,
+            }
+            stream.received = stream.forwarded = 0
+        return {"period": elapsed, "streams": streams}
+
+    async def stats_loop(self) -> None:
+        """
+        Publishes the stats to vrc/fcc/telemetry/stats every stats period
+        """
+        last_time = time.monotonic()
+        while True:
+            await asyncio.sleep(self.stats_period)
+            try:
+                now = time.monotonic()
+                stats = self.take_stats(now - last_time)
+                last_time = now
+                stats["timestamp"] = datetime.datetime.now().isoformat()
+                self.mqtt_client.publish(
+                    f"{self.topic_prefix}/telemetry/stats",
+                    json.dumps(stats),
+                    retain=False,
+                    qos=0,
+                )
+            except Exception as e:
+                logger.exception("Unexpected error in telemetry stats loop")
+
+    async def set_upstream_rates(self, drone: Any) -> None:
+        """
+        Asks the flight controller, through mavsdk's set_rate_* calls, to stream each
+        rate limited topic's source no faster than it is forwarded. Topics whose setters
+        share a MAVLink message get one call, at the highest of their rates. Failures are
+        logged and leave that stream at its default rate.
+        """
+        # message (or setter, if it shares none): [setter, rate, topics]
+        requests: Dict[str, list] = {}
+        for topic, (rate, setter) in self.rates.items():
+            if not rate or setter is None:
+                continue
+            request = requests.setdefault(SHARED_MESSAGES.get(setter, setter), [setter, 0, []])
+            request[1] = max(request[1], rate)
+            request[2].append(topic)
+
+        for setter, rate, topics in requests.values():
+            try:
+                await getattr(drone.telemetry, setter)(rate)
+                logger.info(f"Set upstream rate for {', '.join(topics)} to {rate} Hz")
+            except Exception as e:
+                logger.warning(
+                    f"Could not set upstream rate for {', '.join(topics)} with {setter}: {e}"
+                )
@@ -0,0 +1,110 @@
+import asyncio
+import json
+import time
+from typing import Optional
+
+from loguru import logger
+from paho.mqtt.client import Client as MQTTClient
+
+# telemetry topics (under vrc/fcc) collected into the state snapshot, by the name of
+# their field in it
+STATE_STREAMS = {
+    "status": "status",
+    "battery": "battery",
+    "location/global": "location_global",
+    "location/local": "location_local",
+    "location/home": "location_home",
+    "attitude/euler": "attitude_euler",
+    "velocity": "velocity",
+}
+
+
+class TelemetryState(object):
+    """
+    Latest update of each stream in STATE_STREAMS, as a (time.monotonic_ns(),
+    time.time_ns(), update) tuple, or None until the first one arrives
+    """
+
+    __slots__ = tuple(STATE_STREAMS.values()) + ("updates",)
+
+    def __init__(self) -> None:
+        for field in STATE_STREAMS.values():
+            setattr(self, field, None)
+        # updates stored since the last snapshot
+        self.updates = 0
+
+
+class TelemetryAggregator(object):
+    """
+    Keeps the latest value of each telemetry stream and publishes them all together on
+    vrc/fcc/state at 'rate' Hz, so a consumer that needs several streams gets them from
+    one message. The snapshot and each stream in it carry integer monotonic_ns and
+    epoch_ns times: when the snapshot was taken, and when each update was received.
+    Nothing is published until the first update arrives, and a stream that has not
+    been received yet is null.
+    """
+
+    def __init__(self, client: MQTTClient, topic_prefix: str = "vrc/fcc", rate: float = 10) -> None:
+        self.mqtt_client = client
+        self.topic_prefix = topic_prefix
+        self.rate = rate
+
+        self.state = TelemetryState()
+        self.received = False
+
+    def update(self, topic: str, update: dict, monotonic_ns: int, epoch_ns: int) -> None:
+        """
+        Stores 'update' as the latest value of the stream published on 'topic'. Topics
+        that are not part of the state are ignored.
+        """
+        field = STATE_STREAMS.get(topic)
+        if field is None:
+            return
+        setattr(self.state, field, (monotonic_ns, epoch_ns, update))
+        self.state.updates += 1
+        self.received = True
+
+    def snapshot(self) -> dict:
+        """
+        The state as a dict, ready to be serialized
+        """
+        snapshot = {
+            "monotonic_ns": time.monotonic_ns(),
+            "epoch_ns": time.time_ns(),
+            "updates": self.state.updates,
+        }
+        self.state.updates = 0
+        for field in STATE_STREAMS.values():
+            value = getattr(self.state, field)
+            if value is None:
+                snapshot[field] = None
+                continue
+            monotonic_ns, epoch_ns, update = value
+            stream = dict(update)
+            stream["monotonic_ns"] = monotonic_ns
+            stream["epoch_ns"] = epoch_ns
+            snapshot[field] = stream
+        return snapshot
+
+    async def publish_loop(self) -> None:
+        """
+        Publishes the snapshot to vrc/fcc/state at the configured rate
+        """
+        if not self.rate:
+            return
+        period = 1 / self.rate
+        next_time = time.monotonic()
+        while True:
+            next_time += period
+            await asyncio.sleep(max(next_time - time.monotonic(), 0))
+            try:
+                if not self.received:
+                    continue
+                self.mqtt_client.publish(
+                    f"{self.topic_prefix}/state",
+                    json.dumps(self.snapshot()),
+                    retain=False,
+                    qos=0,
+                )
+            except Exception as e:
+                logger.exception("Unexpected error in telemetry state loop")
@@ -45,7 +45,10 @@ class Fusion(object):
             "AT_THRESH": 0.25,
             "T265_THRESH": 0.25,
             "AT_DERIV_THRESH": 10,
-            "INIT_WAIT_TIME": 2
+            "INIT_WAIT_TIME": 2,
+            # consume the combined vrc/vio/state record instead of the separate vio topics,
+            # the same env var turns on publishing it in the vio module
+            "VIO_STATE": os.environ.get("VIO_STATE") == "1",
         }
 
         self.mqtt_host = "mqtt"
@@ -60,13 +63,18 @@ class Fusion(object):
 
         
         self.topic_map = {
-            "vrc/vio/position/ned":self.fuse_pos,
-            "vrc/vio/orientation/eul":self.fuse_att_euler,
-            "vrc/vio/heading":self.fuse_att_heading,
-            "vrc/vio/velocity/ned":self.fuse_vel,
             f"{self.topic_prefix}/pos/ned":self.local_to_geo,
             #"vrc/apriltags/selected/pos": self.on_apriltag_message
         }
+        if self.config["VIO_STATE"]:
+            self.topic_map["vrc/vio/state"] = self.fuse_state
+        else:
+            self.topic_map.update({
+                "vrc/vio/position/ned":self.fuse_pos,
+                "vrc/vio/orientation/eul":self.fuse_att_euler,
+                "vrc/vio/heading":self.fuse_att_heading,
+                "vrc/vio/velocity/ned":self.fuse_vel,
+            })
 
         self.primary_topic = None
         self.norm = None
@@ -176,6 +184,17 @@ class Fusion(object):
             logger.debug(f"{fore.RED}FUS: Error fusing pos sources {str(e)}{style.RESET}") #type: ignore
             raise e
 
+    def fuse_state(self, msg: dict) -> None:
+        '''
+        Callback for the combined vrc/vio/state record, fuses each part of it the same way as the separate vio topics.
+
+        Velocity goes first since the heading fusion uses the groundspeed.
+        '''
+        self.fuse_vel(msg["vel"])
+        self.fuse_pos(msg["pos"])
+        self.fuse_att_euler(msg["eul"])
+        self.fuse_att_heading({"degrees": msg["heading"]})
+
     def fuse_vel(self, msg: dict) -> None:
         '''
         Callback for receiving vel data in NED reference frame from vio and publishes into a fusion/vel topic. 
@@ -0,0 +1,132 @@
+"""
+Runs ImuPropagator against a simulated flight: a 2 m circle every 10 s, turning to face the
+direction of travel, with a 400 Hz IMU (noise and a small accelerometer bias) and 30 Hz camera
+poses (2 mm noise) that arrive 40 ms after they were taken. Poses are output at 100, 200 and
+400 Hz, each output reading only the newest IMU sample, the way VIO.propagation_loop polls
+the camera.
+
+Reports the CPU time used per second of flight, without and with the NED transform each
+published pose goes through, and the velocity error (after the first SETTLE seconds)
+against the old two-frame difference.
+
+usage: python3 imu_benchmark.py [seconds]
+"""
+# python standard library
+import random
+import sys
+import time
+from math import cos, sin, sqrt, pi
+
+try:
+    from imu_propagation import ImuPropagator, pipe_data, qconj, qrotate  # type: ignore
+    from vio_library import ZEDCameraCoordinateTransformation  # type: ignore
+except ImportError:
+    from .imu_propagation import ImuPropagator, pipe_data, qconj, qrotate
+    from .vio_library import ZEDCameraCoordinateTransformation
+
+RADIUS = 2.0  # m
+OMEGA = 2 * pi / 10  # rad/s
+IMU_RATE = 400
+CAMERA_RATE = 30
+CAMERA_LATENCY = 0.04  # s
+# velocity errors are only counted after this, once the filter has caught up from standing still
+SETTLE = 2.0  # s
+
+
+def truth(t):
+    """
+    Position, velocity, acceleration and orientation of the flight at time 't', in the ZED
+    world frame (y up)
+    """
+    c, s = cos(OMEGA * t), sin(OMEGA * t)
+    position = (RADIUS * c, 1.0, RADIUS * s)
+    velocity = (-RADIUS * OMEGA * s, 0.0, RADIUS * OMEGA * c)
+    accel = (-RADIUS * OMEGA * OMEGA * c, 0.0, -RADIUS * OMEGA * OMEGA * s)
+    yaw = -OMEGA * t  # about y
+    orientation = (cos(yaw / 2), 0.0, sin(yaw / 2), 0.0)
+    return position, velocity, accel, orientation
+
+
+def imu_sample(t, rng):
+    _, _, accel, orientation = truth(t)
+    # the accelerometer reads the specific force in the body frame
+    force = qrotate(qconj(orientation), (accel[0], accel[1] + 9.81, accel[2]))
+    accel = tuple(f + 0.02 + rng.gauss(0, 0.05) for f in force)
+    gyro = (rng.gauss(0, 0.005), -OMEGA + rng.gauss(0, 0.005), rng.gauss(0, 0.005))
+    return accel, gyro
+
+
+def run(output_rate, seconds, transform=None):
+    """
+    Returns (CPU seconds per flight second, RMS velocity error in m/s)
+    """
+    rng = random.Random(0)
+    propagator = ImuPropagator()
+
+    # precompute the sensor data, so only the propagator's work is timed
+    imu = [(i / IMU_RATE, *imu_sample(i / IMU_RATE, rng)) for i in range(int(seconds * IMU_RATE) + 1)]
+    frames = []
+    for i in range(int(seconds * CAMERA_RATE)):
+        t = i / CAMERA_RATE
+        position, _, _, orientation = truth(t)
+        frames.append((t, tuple(p + rng.gauss(0, 0.002) for p in position), orientation))
+
+    ticks = int(seconds * output_rate)
+    errors = 0.0
+    counted = 0
+    frame = 0
+    cpu = 0.0
+    for tick in range(ticks):
+        now = tick / output_rate
+        start = time.process_time()
+        while frame < len(frames) and frames[frame][0] + CAMERA_LATENCY <= now:
+            propagator.correct(*frames[frame])
+            frame += 1
+        propagator.propagate(*imu[int(now * IMU_RATE)])
+        t, position, velocity, orientation = propagator.state()
+        if t is not None:
+            data = pipe_data(position, velocity, orientation)
+            if transform is not None:
+                transform(data)
+        cpu += time.process_time() - start
+
+        if t is not None and now >= SETTLE:
+            _, true_velocity, _, _ = truth(t)
+            errors += sum((v - tv) ** 2 for v, tv in zip(velocity, true_velocity))
+            counted += 1
+    return cpu / seconds, sqrt(errors / counted)
+
+
+def finite_difference_error(seconds):
+    """
+    RMS velocity error of differencing consecutive camera frames, as get_pipe_data used to
+    """
+    rng = random.Random(0)
+    errors = 0.0
+    counted = 0
+    last = truth(0)[0]
+    for i in range(1, int(seconds * CAMERA_RATE)):
+        t = i / CAMERA_RATE
+        position, true_velocity, _, _ = truth(t)
+        position = tuple(p + rng.gauss(0, 0.002) for p in position)
+        velocity = [(p - lp) * CAMERA_RATE for p, lp in zip(position, last)]
+        last = position
+        if t >= SETTLE:
+            errors += sum((v - tv) ** 2 for v, tv in zip(velocity, true_velocity))
+            counted += 1
+    return sqrt(errors / counted)
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 30
+    transform = ZEDCameraCoordinateTransformation().transform_zedcamera_to_global_ned
+
+    print(f"{seconds:.0f} s flight, IMU {IMU_RATE} Hz, camera {CAMERA_RATE} Hz")
+    print(f"two frame difference at {CAMERA_RATE} Hz: velocity RMS error {finite_difference_error(seconds):.3f} m/s")
+    for rate in (100, 200, 400):
+        cpu, error = run(rate, seconds)
+        cpu_transform, _ = run(rate, seconds, transform)
+        print(
+            f"propagated at {rate} Hz: velocity RMS error {error:.3f} m/s, "
+            f"CPU {cpu * 100:.2f}% of a core ({cpu_transform * 100:.2f}% with the NED transform)"
+        )
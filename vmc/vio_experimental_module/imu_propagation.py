@@ -0,0 +1,199 @@
+# python standard library
+import threading
+from collections import deque
+from math import cos, sin, sqrt
+
+
+def qmult(a, b):
+    aw, ax, ay, az = a
+    bw, bx, by, bz = b
+    return (
+        aw * bw - ax * bx - ay * by - az * bz,
+        aw * bx + ax * bw + ay * bz - az * by,
+        aw * by - ax * bz + ay * bw + az * bx,
+        aw * bz + ax * by - ay * bx + az * bw,
+    )
+
+
+def qconj(q):
+    return (q[0], -q[1], -q[2], -q[3])
+
+
+def qnormalize(q):
+    n = sqrt(q[0] * q[0] + q[1] * q[1] + q[2] * q[2] + q[3] * q[3])
+    return (q[0] / n, q[1] / n, q[2] / n, q[3] / n)
+
+
+def qrotate(q, v):
+    """
+    Rotates vector 'v' by unit quaternion 'q' (w, x, y, z)
+    """
+    w, x, y, z = q
+    vx, vy, vz = v
+    # t = 2 * cross(q.xyz, v), v' = v + w * t + cross(q.xyz, t)
+    tx = 2 * (y * vz - z * vy)
+    ty = 2 * (z * vx - x * vz)
+    tz = 2 * (x * vy - y * vx)
+    return (
+        vx + w * tx + y * tz - z * ty,
+        vy + w * ty + z * tx - x * tz,
+        vz + w * tz + x * ty - y * tx,
+    )
+
+
+def qfromrotvec(wx, wy, wz):
+    """
+    Quaternion for a rotation by the vector (wx, wy, wz), in radians
+    """
+    angle = sqrt(wx * wx + wy * wy + wz * wz)
+    if angle < 1e-12:
+        return (1.0, 0.5 * wx, 0.5 * wy, 0.5 * wz)
+    s = sin(angle / 2) / angle
+    return (cos(angle / 2), wx * s, wy * s, wz * s)
+
+
+class ImuPropagator(object):
+    """
+    Carries the ZED pose forward between camera frames with the IMU, so poses can be
+    published faster than the camera grabs.
+
+    Everything is in the ZED world frame (right handed, y up, meters) with the orientation
+    as a (w, x, y, z) quaternion from camera body to world. Each IMU sample rotates the
+    orientation by the gyro rate and integrates the accelerometer (gravity removed) into
+    velocity and position. Each camera pose then pulls the propagated state back towards
+    what the camera saw: the orientation is taken from the camera, and the position error
+    corrects the position by 'pos_gain' of it and the velocity by 'vel_gain' of it per
+    second between frames (an alpha-beta filter with the IMU as its input).
+
+    Camera poses arrive a frame or so late, so the error is measured against the state
+    propagated up to the frame's own timestamp, kept in a short history.
+
+    Without IMU samples this still works as an alpha-beta filter on the camera positions,
+    which gives a much steadier velocity than differencing consecutive frames.
+    """
+
+    GRAVITY = (0.0, -9.81, 0.0)  # m/s^2, y up
+
+    def __init__(self, pos_gain=0.5, vel_gain=0.2, history=256):
+        self.pos_gain = pos_gain
+        self.vel_gain = vel_gain
+
+        self.lock = threading.Lock()
+        # (time, position, orientation) of each propagated state back to the last camera frame
+        self.history = deque(maxlen=history)
+        self.reset()
+
+    def reset(self):
+        self.initialized = False
+        self.time = None
+        self.position = (0.0, 0.0, 0.0)
+        self.velocity = (0.0, 0.0, 0.0)
+        self.orientation = (1.0, 0.0, 0.0, 0.0)
+        self.last_correction_time = None
+        self.last_imu_time = None
+        self.history.clear()
+
+    def propagate(self, t, accel, gyro):
+        """
+        Integrates an IMU sample taken at time 't' (s): 'accel' is the specific force
+        (m/s^2, gravity included, as the accelerometer reads it) and 'gyro' the angular
+        rate (rad/s), both in the camera body frame. Samples older than the last one are
+        ignored.
+        """
+        with self.lock:
+            if self.last_imu_time is not None and t <= self.last_imu_time:
+                return
+            self.last_imu_time = t
+            if not self.initialized or t <= self.time:
+                return
+
+            dt = t - self.time
+            q = qnormalize(qmult(self.orientation, qfromrotvec(gyro[0] * dt, gyro[1] * dt, gyro[2] * dt)))
+            fx, fy, fz = qrotate(q, accel)
+            gx, gy, gz = self.GRAVITY
+            ax, ay, az = fx + gx, fy + gy, fz + gz
+
+            px, py, pz = self.position
+            vx, vy, vz = self.velocity
+            half_dt2 = 0.5 * dt * dt
+            self.position = (px + vx * dt + ax * half_dt2, py + vy * dt + ay * half_dt2, pz + vz * dt + az * half_dt2)
+            self.velocity = (vx + ax * dt, vy + ay * dt, vz + az * dt)
+            self.orientation = q
+            self.time = t
+            self.history.append((t, self.position, q))
+
+    def correct(self, t, position, orientation):
+        """
+        Corrects the state with a camera pose taken at time 't' (s). 'position' is in
+        meters and 'orientation' a (w, x, y, z) quaternion
+        """
+        with self.lock:
+            if not self.initialized:
+                self.initialized = True
+                self.time = t
+                self.position = tuple(position)
+                self.velocity = (0.0, 0.0, 0.0)
+                self.orientation = qnormalize(orientation)
+                self.last_correction_time = t
+                self.history.append((t, self.position, self.orientation))
+                return
+
+            if t > self.time:
+                # nothing propagated this far yet, so coast at the current velocity
+                dt = t - self.time
+                px, py, pz = self.position
+                vx, vy, vz = self.velocity
+                self.position = (px + vx * dt, py + vy * dt, pz + vz * dt)
+                self.time = t
+                self.history.append((t, self.position, self.orientation))
+
+            # the propagated state at the frame's timestamp, dropping anything older
+            history = self.history
+            while len(history) > 1 and history[1][0] <= t:
+                history.popleft()
+            then_t, then_pos, then_q = history[0]
+
+            k = self.pos_gain
+            rx = position[0] - then_pos[0]
+            ry = position[1] - then_pos[1]
+            rz = position[2] - then_pos[2]
+            dx, dy, dz = k * rx, k * ry, k * rz
+
+            dt = t - self.last_correction_time
+            if dt > 0:
+                vx, vy, vz = self.velocity
+                k = self.vel_gain / dt
+                self.velocity = (vx + k * rx, vy + k * ry, vz + k * rz)
+                self.last_correction_time = t
+
+            # shift the states since the frame by the same correction, keeping whatever the
+            # gyro turned through since then on top of the camera's orientation
+            turn = qmult(orientation, qconj(then_q))
+            corrected = deque(maxlen=history.maxlen)
+            for entry_t, (px, py, pz), q in history:
+                corrected.append((entry_t, (px + dx, py + dy, pz + dz), qnormalize(qmult(turn, q))))
+            self.history = corrected
+            _, self.position, self.orientation = corrected[-1]
+
+    def state(self):
+        """
+        Returns (time, position, velocity, orientation) of the latest propagated state
+        """
+        with self.lock:
+            return self.time, self.position, self.velocity, self.orientation
+
+
+def pipe_data(position, velocity, orientation, confidence=0x3):
+    """
+    Builds the dict ZEDCamera.get_pipe_data returns from a position (m), velocity (m/s)
+    and (w, x, y, z) orientation in the ZED world frame
+    """
+    w, x, y, z = orientation
+    return {
+        # the SDK's (x, y, z, w) order with y flipped, which the VIO transforms are set up for
+        "rotation": [x, -y, z, w],
+        "translation": {"x": position[0], "y": position[1], "z": position[2]},
+        "velocity": list(velocity),
+        "tracker_confidence": confidence,
+        "mapper_confidence": confidence,
+    }
@@ -0,0 +1,197 @@
+"""
+Stand-in for the parts of pyzed.sl ZEDCamera uses, so the grab loop can be run and profiled
+without a camera (ZED_MOCK=1). The camera flies a 1 m circle every 10 s at 1 m up, its
+x axis pointing away from the center, in the RIGHT_HANDED_Y_UP frame. grab() paces itself to the
+camera's frame rate (InitParameters.camera_fps, or ZED_MOCK_FPS, 60 by default) and the
+IMU runs at 400 Hz.
+"""
+# python standard library
+import os
+import time
+from math import cos, sin, pi
+
+# pip installed packages
+import numpy as np
+
+RADIUS = 1.0  # m
+OMEGA = 2 * pi / 10  # rad/s
+IMU_RATE = 400
+
+# SDK objects and arrays handed out, for counting allocations per frame
+allocations = {"objects": 0, "arrays": 0}
+
+
+class ERROR_CODE(object):
+    SUCCESS = "SUCCESS"
+    FAILURE = "FAILURE"
+
+
+class RESOLUTION(object):
+    HD720 = "HD720"
+
+
+class COORDINATE_SYSTEM(object):
+    RIGHT_HANDED_Y_UP = "RIGHT_HANDED_Y_UP"
+
+
+class UNIT(object):
+    METER = "METER"
+
+
+class REFERENCE_FRAME(object):
+    WORLD = "WORLD"
+
+
+class TIME_REFERENCE(object):
+    IMAGE = "IMAGE"
+    CURRENT = "CURRENT"
+
+
+class Timestamp(object):
+    def __init__(self, ns=0):
+        self.ns = ns
+
+    def get_nanoseconds(self):
+        return self.ns
+
+    def get_milliseconds(self):
+        return self.ns // 1000000
+
+
+class InitParameters(object):
+    def __init__(self):
+        self.camera_resolution = RESOLUTION.HD720
+        self.camera_fps = 0
+        self.coordinate_system = COORDINATE_SYSTEM.RIGHT_HANDED_Y_UP
+        self.coordinate_units = UNIT.METER
+
+
+class Transform(object):
+    pass
+
+
+class PositionalTrackingParameters(object):
+    def __init__(self, _init_pos=None):
+        self.set_floor_as_origin = False
+
+
+class RuntimeParameters(object):
+    pass
+
+
+class Translation(object):
+    def __init__(self):
+        allocations["objects"] += 1
+        self.value = np.zeros(3)
+
+    def get(self):
+        # like the SDK, hands back a new array each time
+        allocations["arrays"] += 1
+        return self.value.copy()
+
+
+class Orientation(object):
+    def __init__(self):
+        allocations["objects"] += 1
+        self.value = np.array([0.0, 0.0, 0.0, 1.0])
+
+    def init_vector(self, x, y, z, w):
+        self.value[:] = (x, y, z, w)
+
+    def get(self):
+        allocations["arrays"] += 1
+        return self.value.copy()
+
+
+class Pose(object):
+    def __init__(self):
+        self.translation = np.zeros(3)
+        self.orientation = np.array([0.0, 0.0, 0.0, 1.0])  # x, y, z, w
+        self.timestamp = Timestamp()
+
+    def get_translation(self, py_translation):
+        py_translation.value[:] = self.translation
+        return py_translation
+
+    def get_orientation(self, py_orientation):
+        py_orientation.value[:] = self.orientation
+        return py_orientation
+
+
+class IMUData(object):
+    def __init__(self):
+        self.timestamp = Timestamp()
+        self.linear_acceleration = np.zeros(3)  # m/s^2
+        self.angular_velocity = np.zeros(3)  # deg/s
+
+    def get_linear_acceleration(self):
+        allocations["arrays"] += 1
+        return self.linear_acceleration.copy()
+
+    def get_angular_velocity(self):
+        allocations["arrays"] += 1
+        return self.angular_velocity.copy()
+
+
+class SensorsData(object):
+    def __init__(self):
+        self.imu = IMUData()
+
+    def get_imu_data(self):
+        return self.imu
+
+
+class Camera(object):
+    def __init__(self):
+        self.frame_period = None
+        self.start_ns = None
+        self.frame = 0
+        self.image_ns = 0
+
+    def open(self, init_params):
+        fps = init_params.camera_fps or float(os.environ.get("ZED_MOCK_FPS", 60))
+        self.frame_period = 1 / fps
+        self.start_ns = time.monotonic_ns()
+        return ERROR_CODE.SUCCESS
+
+    def enable_positional_tracking(self, tracking_parameters):
+        return ERROR_CODE.SUCCESS
+
+    def grab(self, runtime_parameters):
+        self.frame += 1
+        due = self.start_ns / 1e9 + self.frame * self.frame_period
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.image_ns = self.start_ns + int(self.frame * self.frame_period * 1e9)
+        return ERROR_CODE.SUCCESS
+
+    def get_timestamp(self, time_reference):
+        if time_reference == TIME_REFERENCE.IMAGE:
+            return Timestamp(self.image_ns)
+        return Timestamp(time.monotonic_ns())
+
+    def get_position(self, pose, reference_frame):
+        t = (self.image_ns - self.start_ns) / 1e9
+        c, s = cos(OMEGA * t), sin(OMEGA * t)
+        pose.translation[:] = (RADIUS * c, 1.0, RADIUS * s)
+        yaw = -OMEGA * t  # about y
+        pose.orientation[:] = (0.0, sin(yaw / 2), 0.0, cos(yaw / 2))
+        pose.timestamp = Timestamp(self.image_ns)
+        return ERROR_CODE.SUCCESS
+
+    def get_sensors_data(self, sensors_data, time_reference):
+        ns = self.image_ns if time_reference == TIME_REFERENCE.IMAGE else time.monotonic_ns()
+        # the IMU sample at or before that time
+        period_ns = int(1e9 / IMU_RATE)
+        ns = self.start_ns + (ns - self.start_ns) // period_ns * period_ns
+
+        imu = sensors_data.imu
+        imu.timestamp = Timestamp(ns)
+        # the centripetal acceleration points to the center, along body -x
+        imu.linear_acceleration[:] = (-RADIUS * OMEGA * OMEGA, 9.81, 0.0)
+        imu.angular_velocity[:] = (0.0, -OMEGA * 180 / pi, 0.0)
+        return ERROR_CODE.SUCCESS
+
+    def close(self):
+        pass
@@ -0,0 +1,596 @@
+# python standard library
+import abc
+import bisect
+import os
+import random
+import threading
+import time
+from math import atan2, cos, hypot, sin, pi
+
+# pip installed packages
+import numpy as np
+
+
+class PoseSource(abc.ABC):
+    """
+    Interface the VIO loop pulls poses through.
+
+    Sources are used in one of two modes, picked when they are set up:
+      - callback: setup(callback) and the source calls callback(data, timestamp) for
+        every pose from its own thread
+      - blocking: setup() and then get_pose() blocks until the next pose is available
+
+    'data' is shaped like the pyrealsense2 pose data (rotation, translation, velocity,
+    tracker_confidence, mapper_confidence) and 'timestamp' is the sensor time of the
+    pose in seconds.
+    """
+
+    @abc.abstractmethod
+    def setup(self, callback=None) -> None:
+        pass
+
+    @abc.abstractmethod
+    def get_pose(self):
+        """
+        Blocks until the next pose and returns (data, timestamp), or None if there was none
+        """
+
+    def get_pipe_data(self):
+        """
+        Same as get_pose, without the timestamp
+        """
+        sample = self.get_pose()
+        if sample is not None:
+            return sample[0]
+
+    def stop(self) -> None:
+        pass
+
+
+class Trajectory(abc.ABC):
+    """
+    A path for the simulated sensor to follow. Positions are in m in a frame with x right,
+    y forward and z up (relative to where the T265 reference frame starts), and the yaw is
+    counterclockwise from the forward axis looking down, in rad.
+
+    By default the sensor faces its direction of travel, and keeps its last yaw while stopped.
+    """
+
+    def __init__(self, yaw=0.0):
+        self.yaw = yaw
+
+    @abc.abstractmethod
+    def position_velocity(self, t):
+        """
+        Returns ((x, y, z), (vx, vy, vz)) 't' seconds into the trajectory
+        """
+
+    def state(self, t):
+        pos, vel = self.position_velocity(t)
+        if hypot(vel[0], vel[1]) > 1e-6:
+            self.yaw = atan2(-vel[0], vel[1])
+        return pos, vel, self.yaw
+
+
+class Hover(Trajectory):
+    def __init__(self, position=(0.0, 0.0, 1.0), yaw=0.0):
+        super().__init__(yaw)
+        self.position = tuple(position)
+
+    def position_velocity(self, t):
+        return self.position, (0.0, 0.0, 0.0)
+
+
+class Circle(Trajectory):
+    def __init__(self, radius=1.0, period=10.0, height=1.0, center=(0.0, 0.0)):
+        super().__init__()
+        self.radius = radius
+        self.omega = 2 * pi / period
+        self.height = height
+        self.center = center
+
+    def position_velocity(self, t):
+        a = self.omega * t
+        r = self.radius
+        return (
+            (self.center[0] + r * cos(a), self.center[1] + r * sin(a), self.height),
+            (-r * self.omega * sin(a), r * self.omega * cos(a), 0.0),
+        )
+
+
+class FigureEight(Trajectory):
+    """
+    Lemniscate of Gerono, 'size' m from the center to either end
+    """
+
+    def __init__(self, size=1.0, period=20.0, height=1.0, center=(0.0, 0.0)):
+        super().__init__()
+        self.size = size
+        self.omega = 2 * pi / period
+        self.height = height
+        self.center = center
+
+    def position_velocity(self, t):
+        a = self.omega * t
+        s = self.size
+        return (
+            (self.center[0] + s * sin(a), self.center[1] + s * sin(a) * cos(a), self.height),
+            (s * self.omega * cos(a), s * self.omega * cos(2 * a), 0.0),
+        )
+
+
+class Waypoints(Trajectory):
+    """
+    Straight legs between 'points' (x, y, z) at a constant 'speed' (m/s). With 'loop' the
+    path returns to the first point and repeats, otherwise it stops at the last one
+    """
+
+    def __init__(self, points, speed=0.5, loop=True):
+        super().__init__()
+        self.points = [tuple(p) for p in points]
+        if loop:
+            self.points.append(self.points[0])
+        self.speed = speed
+        self.loop = loop
+
+        # distance along the path at the start of each leg
+        self.distances = [0.0]
+        for a, b in zip(self.points, self.points[1:]):
+            self.distances.append(self.distances[-1] + hypot(hypot(b[0] - a[0], b[1] - a[1]), b[2] - a[2]))
+        self.length = self.distances[-1]
+
+    def position_velocity(self, t):
+        distance = self.speed * t
+        if self.length == 0:
+            return self.points[0], (0.0, 0.0, 0.0)
+        if self.loop:
+            distance %= self.length
+        elif distance >= self.length:
+            return self.points[-1], (0.0, 0.0, 0.0)
+
+        leg = bisect.bisect_right(self.distances, distance) - 1
+        a, b = self.points[leg], self.points[leg + 1]
+        leg_length = self.distances[leg + 1] - self.distances[leg]
+        f = (distance - self.distances[leg]) / leg_length
+        scale = self.speed / leg_length
+        return (
+            tuple(a[i] + (b[i] - a[i]) * f for i in range(3)),
+            tuple((b[i] - a[i]) * scale for i in range(3)),
+        )
+
+
+class Vector(object):
+    __slots__ = ["x", "y", "z", "w"]
+
+    def __init__(self, x=0.0, y=0.0, z=0.0, w=0.0):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.w = w
+
+
+class SimulatedPose(object):
+    """
+    Stand in for the pyrealsense2 pose data
+    """
+
+    __slots__ = ["translation", "velocity", "rotation", "tracker_confidence", "mapper_confidence"]
+
+    def __init__(self):
+        self.translation = Vector()
+        self.velocity = Vector()
+        self.rotation = Vector(w=1.0)
+        self.tracker_confidence = 3
+        self.mapper_confidence = 3
+
+
+class SimulatedPoseSource(PoseSource):
+    """
+    Generates T265 poses at 'rate' Hz (up to ~1 kHz) along a Trajectory, without any hardware.
+
+    Gaussian noise with a standard deviation of 'pos_noise' (m), 'vel_noise' (m/s) and
+    'yaw_noise' (rad) is added to each pose. The tracker and mapper confidence are
+    'confidence', except for the last 'dropout_length' seconds of every 'dropout_period'
+    (if set) where they fall to 1. Timestamps are wall clock times of when each pose is due, in seconds.
+
+    Poses are in the T265 reference frame (x right, y up, z back) like the real sensor.
+    """
+
+    def __init__(
+        self,
+        trajectory: Trajectory = None,
+        rate=200.0,
+        pos_noise=0.0,
+        vel_noise=0.0,
+        yaw_noise=0.0,
+        confidence=3,
+        dropout_period=None,
+        dropout_length=0.5,
+        seed=None,
+    ):
+        self.trajectory = trajectory if trajectory is not None else Circle()
+        self.rate = rate
+        self.pos_noise = pos_noise
+        self.vel_noise = vel_noise
+        self.yaw_noise = yaw_noise
+        self.confidence = confidence
+        self.dropout_period = dropout_period
+        self.dropout_length = dropout_length
+        self.random = random.Random(seed)
+
+        self.running = False
+        self.thread = None
+        self.start_time = None
+        self.next_time = None
+
+    def sample(self, t):
+        """
+        The pose 't' seconds into the trajectory
+        """
+        (x, y, z), (vx, vy, vz), yaw = self.trajectory.state(t)
+        gauss = self.random.gauss
+
+        data = SimulatedPose()
+        # trajectory (right, forward, up) -> T265 (right, up, back)
+        data.translation.x = x + gauss(0, self.pos_noise) if self.pos_noise else x
+        data.translation.y = z + gauss(0, self.pos_noise) if self.pos_noise else z
+        data.translation.z = -y + gauss(0, self.pos_noise) if self.pos_noise else -y
+        data.velocity.x = vx + gauss(0, self.vel_noise) if self.vel_noise else vx
+        data.velocity.y = vz + gauss(0, self.vel_noise) if self.vel_noise else vz
+        data.velocity.z = -vy + gauss(0, self.vel_noise) if self.vel_noise else -vy
+
+        # yaw about the up axis
+        if self.yaw_noise:
+            yaw += gauss(0, self.yaw_noise)
+        data.rotation.w = cos(yaw / 2)
+        data.rotation.y = sin(yaw / 2)
+
+        confidence = self.confidence
+        if self.dropout_period and t % self.dropout_period >= self.dropout_period - self.dropout_length:
+            confidence = 1
+        data.tracker_confidence = confidence
+        data.mapper_confidence = confidence
+        return data
+
+    def setup(self, callback=None) -> None:
+        self.start_time = time.time()
+        self.next_time = self.start_time
+        if callback is not None:
+            self.running = True
+            self.thread = threading.Thread(
+                target=self.callback_loop, args=[callback], daemon=True, name="sim_pose_thread"
+            )
+            self.thread.start()
+
+    def wait_next(self):
+        """
+        Sleeps until the next sample is due and returns its timestamp. If the reader has
+        fallen behind, the samples it missed are skipped like a sensor's frame queue would
+        """
+        now = time.time()
+        if self.next_time > now:
+            time.sleep(self.next_time - now)
+        elif now - self.next_time > 1 / self.rate:
+            self.next_time += int((now - self.next_time) * self.rate) / self.rate
+        timestamp = self.next_time
+        self.next_time += 1 / self.rate
+        return timestamp
+
+    def get_pose(self):
+        timestamp = self.wait_next()
+        return self.sample(timestamp - self.start_time), timestamp  # type: ignore
+
+    def callback_loop(self, callback):
+        while self.running:
+            timestamp = self.wait_next()
+            callback(self.sample(timestamp - self.start_time), timestamp)  # type: ignore
+
+    def stop(self) -> None:
+        self.running = False
+
+
+def to_zed(data):
+    """
+    Reshapes T265 style pose data into the dicts ZEDCamera.get_pipe_data returns, the
+    same shape as imu_propagation.pipe_data in vio_experimental_module builds
+    """
+    r = data.rotation
+    return {
+        # the SDK's (x, y, z, w) order with y flipped, which the VIO transforms are set up for
+        "rotation": [r.x, -r.y, r.z, r.w],
+        "translation": {"x": data.translation.x, "y": data.translation.y, "z": data.translation.z},
+        "velocity": [data.velocity.x, data.velocity.y, data.velocity.z],
+        "tracker_confidence": data.tracker_confidence,
+        "mapper_confidence": data.mapper_confidence,
+    }
+
+
+class SimulatedZEDCamera(SimulatedPoseSource):
+    """
+    The same simulated poses, shaped like ZEDCamera.get_pipe_data's dicts
+    """
+
+    def get_pose(self):
+        data, timestamp = super().get_pose()
+        return to_zed(data), timestamp
+
+    def callback_loop(self, callback):
+        super().callback_loop(lambda data, timestamp: callback(to_zed(data), timestamp))
+
+
+# pose log file layout: POSE_LOG_MAGIC followed by packed little-endian POSE_RECORD_DTYPE records
+POSE_LOG_MAGIC = b"VRCPOSE1"
+POSE_RECORD_DTYPE = np.dtype(
+    [
+        ("timestamp", "<f8"),  # sensor time, s
+        ("translation", "<f4", (3,)),  # m
+        ("rotation", "<f4", (4,)),  # w, x, y, z
+        ("velocity", "<f4", (3,)),  # m/s
+        ("tracker_confidence", "u1"),
+        ("mapper_confidence", "u1"),
+    ]
+)
+
+
+class PoseRecorder(object):
+    """
+    Appends raw poses, as the sensor produced them, to a pose log at 'path'. Records are
+    collected in a buffer of 'buffer_records' and written out whenever it fills, so the
+    VIO loop only touches the disk once every few seconds.
+
+    Both T265 pose data and ZEDCamera dicts can be recorded, the rotation is always
+    stored as w, x, y, z.
+
+    When appending to an existing log, a record cut short at its end (by a run that died
+    mid write) is cut off first, so the new records line up with the old ones.
+    """
+
+    def __init__(self, path, buffer_records=1024):
+        self.path = path
+        self.truncate_partial(path)
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(POSE_LOG_MAGIC)
+
+        self.lock = threading.Lock()
+        self.buffer = np.zeros(buffer_records, dtype=POSE_RECORD_DTYPE)
+        self.count = 0
+        self.recorded = 0
+
+    @staticmethod
+    def truncate_partial(path):
+        """
+        Cuts an existing pose log at 'path' back to its last whole record
+        """
+        if not os.path.exists(path):
+            return
+        size = os.path.getsize(path)
+        if size < len(POSE_LOG_MAGIC):
+            # died before the header was out, start over
+            os.truncate(path, 0)
+            return
+        with open(path, "rb") as f:
+            if f.read(len(POSE_LOG_MAGIC)) != POSE_LOG_MAGIC:
+                raise ValueError(f"{path} is not a pose log")
+        partial = (size - len(POSE_LOG_MAGIC)) % POSE_RECORD_DTYPE.itemsize
+        if partial:
+            os.truncate(path, size - partial)
+
+    def record(self, data, timestamp):
+        if isinstance(data, dict):
+            t, r, v = data["translation"], data["rotation"], data["velocity"]
+            record = (
+                timestamp,
+                (t["x"], t["y"], t["z"]),
+                # ZEDCamera's [x, -y, z, w], see to_zed
+                (r[3], r[0], -r[1], r[2]),
+                v,
+                data["tracker_confidence"],
+                data["mapper_confidence"],
+            )
+        else:
+            t, r, v = data.translation, data.rotation, data.velocity
+            record = (
+                timestamp,
+                (t.x, t.y, t.z),
+                (r.w, r.x, r.y, r.z),
+                (v.x, v.y, v.z),
+                data.tracker_confidence,
+                data.mapper_confidence,
+            )
+
+        with self.lock:
+            self.buffer[self.count] = record
+            self.count += 1
+            self.recorded += 1
+            if self.count == len(self.buffer):
+                self.write_buffer()
+
+    def write_buffer(self):
+        self.file.write(self.buffer[: self.count].tobytes())
+        self.file.flush()
+        self.count = 0
+
+    def close(self):
+        with self.lock:
+            self.write_buffer()
+            self.file.close()
+
+
+def open_pose_log(path):
+    """
+    Memory maps a pose log as an array of POSE_RECORD_DTYPE records. A record cut short
+    at the end of the file (e.g. by a crash) is ignored
+    """
+    with open(path, "rb") as f:
+        if f.read(len(POSE_LOG_MAGIC)) != POSE_LOG_MAGIC:
+            raise ValueError(f"{path} is not a pose log")
+    size = os.path.getsize(path) - len(POSE_LOG_MAGIC)
+    count = size // POSE_RECORD_DTYPE.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=POSE_RECORD_DTYPE)
+    return np.memmap(path, dtype=POSE_RECORD_DTYPE, mode="r", offset=len(POSE_LOG_MAGIC), shape=(count,))
+
+
+class ReplayPoseSource(PoseSource):
+    """
+    Plays a pose log back as a pose source, with the recorded timestamps.
+
+    'speed' 1.0 replays in real time (2.0 twice as fast, etc.) and 0 as fast as the
+    reader takes the poses. The log is memory mapped, so only the pages being played
+    are read from disk. With 'zed' the poses come out as ZEDCamera dicts.
+
+    Once the end of the log is reached 'finished' is set and get_pose returns None,
+    unless 'loop' starts it over.
+    """
+
+    def __init__(self, path, speed=1.0, loop=False, zed=False):
+        self.records = open_pose_log(path)
+        self.speed = speed
+        self.loop = loop
+        self.zed = zed
+
+        self.index = 0
+        self.finished = False
+        self.running = False
+        self.thread = None
+        # wall clock time the first record is played at
+        self.start_time = None
+
+    def make_data(self, record):
+        data = SimulatedPose()
+        t, r, v = record["translation"], record["rotation"], record["velocity"]
+        data.translation.x, data.translation.y, data.translation.z = float(t[0]), float(t[1]), float(t[2])
+        data.rotation.w, data.rotation.x, data.rotation.y, data.rotation.z = (
+            float(r[0]), float(r[1]), float(r[2]), float(r[3])
+        )
+        data.velocity.x, data.velocity.y, data.velocity.z = float(v[0]), float(v[1]), float(v[2])
+        data.tracker_confidence = int(record["tracker_confidence"])
+        data.mapper_confidence = int(record["mapper_confidence"])
+        return to_zed(data) if self.zed else data
+
+    def setup(self, callback=None) -> None:
+        self.start_time = time.time()
+        if callback is not None:
+            self.running = True
+            self.thread = threading.Thread(
+                target=self.callback_loop, args=[callback], daemon=True, name="replay_pose_thread"
+            )
+            self.thread.start()
+
+    def get_pose(self):
+        if self.index >= len(self.records):
+            if not self.loop or len(self.records) == 0:
+                self.finished = True
+                time.sleep(0.01)
+                return None
+            self.index = 0
+            self.start_time = time.time()
+
+        record = self.records[self.index]
+        timestamp = float(record["timestamp"])
+        if self.speed:
+            due = self.start_time + (timestamp - float(self.records[0]["timestamp"])) / self.speed  # type: ignore
+            now = time.time()
+            if due > now:
+                time.sleep(due - now)
+        self.index += 1
+        return self.make_data(record), timestamp
+
+    def callback_loop(self, callback):
+        while self.running:
+            sample = self.get_pose()
+            if sample is not None:
+                callback(*sample)
+            elif self.finished:
+                break
+
+    def stop(self) -> None:
+        self.running = False
+
+
+def parse_points(text):
+    """
+    "x,y,z;x,y,z;..." -> [(x, y, z), ...]
+    """
+    return [tuple(float(v) for v in point.split(",")) for point in text.split(";") if point]
+
+
+def trajectory_from_env():
+    name = os.environ.get("VIO_SIM_TRAJECTORY", "circle")
+    height = float(os.environ.get("VIO_SIM_HEIGHT", 1.0))
+    if name == "hover":
+        return Hover((0.0, 0.0, height))
+    if name == "circle":
+        return Circle(
+            radius=float(os.environ.get("VIO_SIM_SIZE", 1.0)),
+            period=float(os.environ.get("VIO_SIM_PERIOD", 10.0)),
+            height=height,
+        )
+    if name == "figure8":
+        return FigureEight(
+            size=float(os.environ.get("VIO_SIM_SIZE", 1.0)),
+            period=float(os.environ.get("VIO_SIM_PERIOD", 20.0)),
+            height=height,
+        )
+    if name == "waypoints":
+        return Waypoints(
+            parse_points(os.environ.get("VIO_SIM_WAYPOINTS", "0,0,1;2,0,1;2,2,1;0,2,1")),
+            speed=float(os.environ.get("VIO_SIM_SPEED", 0.5)),
+        )
+    raise ValueError(f"Unknown VIO_SIM_TRAJECTORY: {name}")
+
+
+def pose_source_from_env(zed=False):
+    """
+    Returns a simulated pose source if VIO_POSE_SOURCE is "sim", configured from the
+    VIO_SIM_* variables, a replay of the pose log at VIO_REPLAY if it is "replay",
+    or None to use the real sensor.
+
+        VIO_REPLAY_SPEED    1 for real time, 0 for as fast as possible (default 1)
+        VIO_REPLAY_LOOP     1 to start over at the end of the log
+
+        VIO_SIM_TRAJECTORY  hover, circle, figure8 or waypoints (default circle)
+        VIO_SIM_RATE        poses per second (default 200)
+        VIO_SIM_SIZE        circle radius / figure eight half width in m (default 1)
+        VIO_SIM_PERIOD      seconds per lap of the circle / figure eight
+        VIO_SIM_HEIGHT      m above the start point (default 1)
+        VIO_SIM_WAYPOINTS   "x,y,z;x,y,z;..." in m, for waypoints
+        VIO_SIM_SPEED       m/s along the waypoints (default 0.5)
+        VIO_SIM_POS_NOISE, VIO_SIM_VEL_NOISE, VIO_SIM_YAW_NOISE
+                            standard deviations in m, m/s and rad (default 0)
+        VIO_SIM_DROPOUT     seconds between half second low confidence spells (default none)
+
+    Any source can be recorded to a pose log by setting VIO_RECORD, see recorder_from_env.
+    """
+    source = os.environ.get("VIO_POSE_SOURCE", "hardware")
+    if source == "replay":
+        return ReplayPoseSource(
+            os.environ["VIO_REPLAY"],
+            speed=float(os.environ.get("VIO_REPLAY_SPEED", 1.0)),
+            loop=os.environ.get("VIO_REPLAY_LOOP") == "1",
+            zed=zed,
+        )
+    if source != "sim":
+        return None
+
+    dropout = os.environ.get("VIO_SIM_DROPOUT")
+    source_class = SimulatedZEDCamera if zed else SimulatedPoseSource
+    return source_class(
+        trajectory_from_env(),
+        rate=float(os.environ.get("VIO_SIM_RATE", 200)),
+        pos_noise=float(os.environ.get("VIO_SIM_POS_NOISE", 0)),
+        vel_noise=float(os.environ.get("VIO_SIM_VEL_NOISE", 0)),
+        yaw_noise=float(os.environ.get("VIO_SIM_YAW_NOISE", 0)),
+        dropout_period=float(dropout) if dropout else None,
+    )
+
+
+def recorder_from_env():
+    """
+    Returns a PoseRecorder appending to VIO_RECORD if it is set, otherwise None
+    """
+    path = os.environ.get("VIO_RECORD")
+    if path:
+        return PoseRecorder(path)
+    return None
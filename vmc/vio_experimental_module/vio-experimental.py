@@ -51,7 +51,7 @@ class VIOModule(object):
 
         # add signal handler for the T265
         def signal_handler(sig, frame):
-            self.vio.t265.stop()
+            self.vio.stop()
             sys.exit(0)
 
         signal.signal(signal.SIGTERM, signal_handler)
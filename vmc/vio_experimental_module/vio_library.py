@@ -2,6 +2,8 @@
 import time
 from math import pi
 import json
+import os
+import threading
 
 # pip installed packages
 import numpy as np
@@ -10,9 +12,9 @@ from colored import fore, back, style
 from loguru import logger
 
 try:
-    from zed_library import ZEDCamera # type: ignore
+    from pose_source import pose_source_from_env, recorder_from_env # type: ignore
 except ImportError:
-    from .zed_library import ZEDCamera
+    from .pose_source import pose_source_from_env, recorder_from_env
 
 class ZEDCameraCoordinateTransformation(object):
     """
@@ -195,11 +197,26 @@ class ZEDCameraCoordinateTransformation(object):
 class VIO(object):
     def __init__(self, mqtt_client):
 
-        self.init = False
+        self.init_sync = False
         self.continuous_sync = True
 
-        self.zedcamera = ZEDCamera()
+        # VIO_POSE_SOURCE=sim/replay swaps the ZED for a simulated sensor or a pose log
+        self.zedcamera = pose_source_from_env(zed=True)
+        if self.zedcamera is None:
+            # pyzed is only needed when talking to the real sensor
+            try:
+                from zed_library import ZEDCamera  # type: ignore
+            except ImportError:
+                from .zed_library import ZEDCamera
+            self.zedcamera = ZEDCamera()
         self.ZEDCAM_UPDATE_FREQ = 10
+        # VIO_IMU_RATE=<Hz> publishes poses propagated with the ZED's IMU at that rate, from
+        # their own thread, instead of publishing the camera poses
+        self.IMU_RATE = float(os.environ.get("VIO_IMU_RATE", 0))
+        # seconds between logs of the camera's grab to publish latency
+        self.LATENCY_LOG_PERIOD = 10
+        # VIO_RECORD=<path> appends every raw pose to a pose log, for ReplayPoseSource
+        self.recorder = recorder_from_env()
 
         self.coord_trans = ZEDCameraCoordinateTransformation()
 
@@ -287,12 +304,67 @@ class VIO(object):
         except ValueError as e:
             logger.exception(str(e))
 
+    def stop(self):
+        self.zedcamera.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def publish_data(self, data):
+        # collect data from the sensor and transform it into "global" NED frame
+        ned_pos, ned_vel, rpy = self.coord_trans.transform_zedcamera_to_global_ned(
+            data
+        )
+        #logger.debug(f"Publishing updates:{ned_pos},{ned_vel},{rpy}")
+        try:
+            self.publish_updates(
+                ned_pos,
+                ned_vel,
+                rpy,
+                data["tracker_confidence"],
+                data["mapper_confidence"]
+            )
+        except BaseException as err:
+            logger.debug(f"Unexpected {err}, {type(err)}")
+            logger.debug("Didnt call publish")
+
+    def propagation_loop(self):
+        """
+        Publishes the IMU propagated pose every 1 / IMU_RATE seconds
+        """
+        period = 1 / self.IMU_RATE
+        next_time = time.monotonic()
+        while True:
+            data = self.zedcamera.get_propagated_data()
+            if data is not None:
+                self.publish_data(data)
+
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # fell behind, don't try to catch up with a burst
+                next_time = time.monotonic()
+
     def run(self):
 
         #setup the zedcamera
         logger.debug("Setting up ZEDCAM")
         self.zedcamera.setup()
 
+        propagate = self.IMU_RATE > 0 and hasattr(self.zedcamera, "get_propagated_data")
+        if self.IMU_RATE > 0 and not propagate:
+            logger.warning("VIO_IMU_RATE is set but the pose source has no IMU, publishing camera poses")
+        if propagate:
+            # the camera poses below only correct the propagator from here on
+            logger.debug(f"Publishing IMU propagated poses at {self.IMU_RATE} Hz")
+            threading.Thread(target=self.propagation_loop, daemon=True, name="imu_propagation_thread").start()
+
+        # only the real camera has a grab thread, whose frames pace this loop (get_pipe_data
+        # waits for the next one), and tracks how long its frames take to get out
+        grab_thread = hasattr(self.zedcamera, "latency_stats")
+        next_latency_log = time.monotonic() + self.LATENCY_LOG_PERIOD
+
         #start the loop
         logger.debug("Beginning data loop")
         while True:
@@ -300,23 +372,20 @@ class VIO(object):
 
             data = self.zedcamera.get_pipe_data()
             if data is not None:
-                # collect data from the sensor and transform it into "global" NED frame
-                ned_pos, ned_vel, rpy = self.coord_trans.transform_zedcamera_to_global_ned(
-                    data
-                )
-                #logger.debug(f"Publishing updates:{ned_pos},{ned_vel},{rpy}")
-                try:
-                    self.publish_updates(
-                        ned_pos,
-                        ned_vel,
-                        rpy,
-                        data["tracker_confidence"],
-                        data["mapper_confidence"]
-                    )
-                except BaseException as err:
-                    logger.debug(f"Unexpected {err}, {type(err)}")
-                    logger.debug("Didnt call publish")
+                if self.recorder is not None:
+                    self.recorder.record(data, data.get("timestamp", time.time()))
+                if propagate:
+                    # every frame has already corrected the propagator in the grab thread
+                    continue
+                self.publish_data(data)
+                if grab_thread:
+                    self.zedcamera.published(data)
+                    if time.monotonic() >= next_latency_log:
+                        logger.debug(f"ZEDCAM grab to publish latency (ms): {self.zedcamera.latency_stats()}")
+                        next_latency_log += self.LATENCY_LOG_PERIOD
             else:
                 continue
 
-            time.sleep(1 / self.ZEDCAM_UPDATE_FREQ)
+            if not grab_thread:
+                # the simulated and replayed sources are published at ZEDCAM_UPDATE_FREQ
+                time.sleep(1 / self.ZEDCAM_UPDATE_FREQ)
@@ -1,16 +1,68 @@
 from typing import Dict
+import os
 import subprocess
+import threading
+import time
+from math import pi
+import numpy as np
 from loguru import logger
 from colored import fore, back, style
-import pyzed.sl as sl
+
+if os.environ.get("ZED_MOCK") == "1":
+    # runs the grab loop against a simulated camera, see mock_sl.py
+    try:
+        import mock_sl as sl  # type: ignore
+    except ImportError:
+        from . import mock_sl as sl
+else:
+    import pyzed.sl as sl
+
+try:
+    from imu_propagation import ImuPropagator, pipe_data  # type: ignore
+except ImportError:
+    from .imu_propagation import ImuPropagator, pipe_data
+
+# columns of a frame slot, as the grab thread hands it over. seq is 0 while the slot is
+# being written, timestamp is the image time (s), grab_time time.monotonic() when grab
+# returned, then translation (m), orientation (w, x, y, z) and velocity (m/s)
+FRAME_COLUMNS = ("seq", "timestamp", "grab_time", "tx", "ty", "tz", "qw", "qx", "qy", "qz", "vx", "vy", "vz")
 
 
 class ZEDCamera(object):
     '''
     ZED Tracking Camera interface. Manages pulling data off of the camera for use by the transforms to get it in the correct reference frame.
+
+    A grab thread started by setup() grabs every frame into a ring of preallocated slots,
+    reusing the same SDK objects each time, and get_pipe_data hands out the newest one
+    without blocking on the camera or taking a lock.
     '''
+    # enough that the grab thread can't lap a reader that is partway through a slot
+    FRAME_SLOTS = 4
+    LATENCY_WINDOW = 1024
+
     def __init__(self):
-        self.pipe = None
+        # fuses the camera poses with the IMU, for the velocity and for poses between frames
+        self.propagator = ImuPropagator()
+
+        self.frames = np.zeros((self.FRAME_SLOTS, len(FRAME_COLUMNS)))
+        # seq of the newest complete frame, and of the last one handed out
+        self.seq = 0
+        self.read_seq = 0
+        self.new_frame = threading.Event()
+        # handed out by get_pipe_data, and refilled in place for every frame
+        self.pipe_buffer = pipe_data((0.0, 0.0, 0.0), (0.0, 0.0, 0.0), (1.0, 0.0, 0.0, 0.0))
+        self.pipe_buffer["timestamp"] = 0.0
+        self.pipe_buffer["grab_time"] = 0.0
+        self.running = False
+        self.thread = None
+
+        self.grabbed = 0
+        self.grab_errors = 0
+        # frames replaced by a newer one before anything read them
+        self.skipped = 0
+        # grab to publish latencies (s) of the last LATENCY_WINDOW published frames
+        self.latencies = np.zeros(self.LATENCY_WINDOW)
+        self.published_count = 0
 
 
     def setup(self) -> None:
@@ -56,80 +108,161 @@ class ZEDCamera(object):
             self.zed.get_position(self.zed_pose, sl.REFERENCE_FRAME.WORLD)
             self.zed.get_sensors_data(self.zed_sensors, sl.TIME_REFERENCE.IMAGE)
             self.zed_imu = self.zed_sensors.get_imu_data()
-            self.last_pos = [0,0,0]
+            # separate from zed_sensors, which the grab thread fills
+            self.current_sensors = sl.SensorsData()
+            # reused for every frame
+            self.py_translation = sl.Translation()
+            self.py_orientation = sl.Orientation()
 
             self.runtime_parameters = sl.RuntimeParameters()
-            self.last_time = 0
         except Exception as e:
             logger.exception(f"{fore.RED}ZED: Error connecting to ZED Camera: {e}{style.RESET}")
             raise e
 
-    def get_pipe_data(self) -> str:
-        #logger.debug("Getting pipe data")    
-            #Ok if returns none if not available -- will get called again
-        if self.zed.grab(self.runtime_parameters) == sl.ERROR_CODE.SUCCESS:
+        self.running = True
+        self.thread = threading.Thread(target=self.grab_loop, daemon=True, name="zed_grab_thread")
+        self.thread.start()
+
+    def grab_loop(self) -> None:
+        while self.running:
+            if self.zed.grab(self.runtime_parameters) != sl.ERROR_CODE.SUCCESS:
+                self.grab_errors += 1
+                time.sleep(0.001)
+                continue
+            grab_time = time.monotonic()
             try:
-                #logger.debug("Zed Camera Successfully grabbed params")
-                # Get the pose of the left eye of the camera with reference to the world frame
-                self.zed.get_position(self.zed_pose, sl.REFERENCE_FRAME.WORLD)
-                #logger.debug("Zed Camera Successfully go position data")
-
-                self.zed.get_sensors_data(self.zed_sensors, sl.TIME_REFERENCE.IMAGE)
-                #logger.debug("Zed Camera Successfully got sensor data")
-
-                self.zed_imu = self.zed_sensors.get_imu_data()
-
-
-                # Retrieve the translation
-                py_translation = sl.Translation()
-                tx = self.zed_pose.get_translation(py_translation).get()[0]
-                ty = self.zed_pose.get_translation(py_translation).get()[1]
-                tz = self.zed_pose.get_translation(py_translation).get()[2]
-                #logger.debug("Translation: Tx: {0}, Ty: {1}, Tz {2}, Timestamp: {3}\n".format(tx, ty, tz, self.zed_pose.timestamp.get_milliseconds()))
-
-                # Calculate Velocity
-                
-                current_time = self.zed.get_timestamp(sl.TIME_REFERENCE.IMAGE).get_milliseconds()
-                diffx = (tx - self.last_pos[0])
-                diffy = (ty - self.last_pos[1])
-                diffz = (tz - self.last_pos[2])
-                time_diff =( current_time - self.last_time)/1000 
-                #logger.debug("velocity calc ->:timediff: {0}  x: {1}, y: {2}, z {3}\n".format(time_diff, diffx, diffy, diffz))
-                velocity = [diffx/time_diff, diffy/time_diff, diffz/time_diff]
-                self.last_time = current_time
-                self.last_pos[0] = tx
-                self.last_pos[1] = ty
-                self.last_pos[2] = tz
-            
-
-                #get orientation
-                py_orientation = sl.Orientation()
-                orotation = self.zed_pose.get_orientation(py_orientation)
-                 #fix backwards y
-                o = sl.Orientation()
-                #fixing y rotation problem -- need to investigate
-                o.init_vector (orotation.get()[0],orotation.get()[1]*-1, orotation.get()[2],orotation.get()[3])
-                rotation =  o.get()
-                
-
-                #assemble return value
-                translation =   {"x" : tx, "y" : ty, "z" : tz}
-                data = {"rotation" : rotation, "translation" : translation, "velocity" : velocity, "tracker_confidence":0x3,"mapper_confidence":0x3}
-
-                return data
-
-            except OSError as err:
-                logger.debug("OS error: {0}".format(err))
-            except ValueError as err:
-                logger.debug(f"Could not convert data:  {err}, {type(err)}")
+                self.read_frame(grab_time)
             except BaseException as err:
-                logger.debug(f"Unexpected {err}, {type(err)}")
-                raise
+                logger.exception(f"Unexpected {err}, {type(err)}")
+
+    def read_frame(self, grab_time: float) -> None:
+        """
+        Reads the pose of the frame just grabbed into the next slot and publishes it
+        """
+        # Get the pose of the left eye of the camera with reference to the world frame
+        self.zed.get_position(self.zed_pose, sl.REFERENCE_FRAME.WORLD)
+        self.zed.get_sensors_data(self.zed_sensors, sl.TIME_REFERENCE.IMAGE)
+        self.zed_imu = self.zed_sensors.get_imu_data()
+        self.feed_imu(self.zed_imu)
+
+        # as floats, numpy scalars are several times slower in the propagator's arithmetic
+        tx, ty, tz = self.zed_pose.get_translation(self.py_translation).get().tolist()[:3]
+        #get orientation, (x, y, z, w) from the SDK
+        ox, oy, oz, ow = self.zed_pose.get_orientation(self.py_orientation).get().tolist()
+        timestamp = self.zed.get_timestamp(sl.TIME_REFERENCE.IMAGE).get_nanoseconds() / 1e9
+
+        # the velocity comes from the propagator, which filters the camera positions
+        # (and integrates the IMU in between) instead of differencing two frames
+        self.propagator.correct(timestamp, (tx, ty, tz), (ow, ox, oy, oz))
+        _, _, (vx, vy, vz), _ = self.propagator.state()
+
+        seq = self.seq + 1
+        frame = self.frames[seq % self.FRAME_SLOTS]
+        frame[0] = 0
+        frame[1:] = (timestamp, grab_time, tx, ty, tz, ow, ox, oy, oz, vx, vy, vz)
+        frame[0] = seq
+        # a single assignment, so readers see either the old frame or the complete new one
+        self.seq = seq
+        self.grabbed += 1
+        self.new_frame.set()
+
+    def get_pipe_data(self, timeout: float = 0.1):
+        """
+        Returns the newest frame not handed out yet, shaped for the transforms, with its
+        "timestamp" and "grab_time" added. Waits up to 'timeout' seconds for one to be
+        grabbed, returning None if none was.
+
+        The same dict is returned every time, refilled with the new frame, so copy out
+        anything that has to outlive the next call.
+        """
+        seq = self.seq
+        if seq == self.read_seq:
+            self.new_frame.clear()
+            # a frame may have landed between the check and the clear
+            seq = self.seq
+            if seq == self.read_seq:
+                self.new_frame.wait(timeout)
+                seq = self.seq
+                if seq == self.read_seq:
+                    return None
+
+        while True:
+            frame = self.frames[seq % self.FRAME_SLOTS].tolist()
+            if frame[0] == seq:
+                break
+            # the grab thread came round and rewrote the slot while it was read, take the newest
+            seq = self.seq
+
+        self.skipped += seq - self.read_seq - 1
+        self.read_seq = seq
+
+        _, timestamp, grab_time, tx, ty, tz, qw, qx, qy, qz, vx, vy, vz = frame
+        data = self.pipe_buffer
+        # the SDK's (x, y, z, w) order with y flipped, as pipe_data lays it out
+        rotation = data["rotation"]
+        rotation[0], rotation[1], rotation[2], rotation[3] = qx, -qy, qz, qw
+        translation = data["translation"]
+        translation["x"], translation["y"], translation["z"] = tx, ty, tz
+        velocity = data["velocity"]
+        velocity[0], velocity[1], velocity[2] = vx, vy, vz
+        data["timestamp"] = timestamp
+        data["grab_time"] = grab_time
+        return data
+
+    def published(self, data) -> None:
+        """
+        Records the grab to publish latency of a frame from get_pipe_data, once it's out
+        """
+        self.latencies[self.published_count % self.LATENCY_WINDOW] = time.monotonic() - data["grab_time"]
+        self.published_count += 1
+
+    def latency_stats(self) -> dict:
+        """
+        Grab to publish latency (ms) over the last LATENCY_WINDOW published frames
+        """
+        latencies = self.latencies[: min(self.published_count, self.LATENCY_WINDOW)] * 1000
+        if len(latencies) == 0:
+            return {"count": 0}
+        return {
+            "count": self.published_count,
+            "p50": float(np.percentile(latencies, 50)),
+            "p99": float(np.percentile(latencies, 99)),
+            "max": float(latencies.max()),
+            "grabbed": self.grabbed,
+            "skipped": self.skipped,
+            "grab_errors": self.grab_errors,
+        }
+
+    def feed_imu(self, imu) -> None:
+        """
+        Hands an sl.IMUData sample to the propagator
+        """
+        t = imu.timestamp.get_nanoseconds() / 1e9
+        accel = imu.get_linear_acceleration().tolist()  # m/s^2
+        gyro = [rate * pi / 180 for rate in imu.get_angular_velocity().tolist()]  # deg/s -> rad/s
+        self.propagator.propagate(t, accel, gyro)
+
+    def get_propagated_data(self):
+        """
+        Propagates the last camera pose to the newest IMU sample and returns it shaped like
+        get_pipe_data's. Meant to be polled from its own thread, faster than the camera
+        grabs; returns None until the first camera pose
+        """
+        if self.zed.get_sensors_data(self.current_sensors, sl.TIME_REFERENCE.CURRENT) != sl.ERROR_CODE.SUCCESS:
+            return None
+        self.feed_imu(self.current_sensors.get_imu_data())
+
+        t, position, velocity, orientation = self.propagator.state()
+        if t is None:
+            return None
+        return pipe_data(position, velocity, orientation)
 
-    
     def stop(self) -> None:
         try:
             logger.debug("Closing ZED pipeline")
-            self.pipe.stop()
+            self.running = False
+            if self.thread is not None:
+                self.thread.join(timeout=1)
+            self.zed.close()
         except:
             logger.exception("Couldn't stop the pipe")
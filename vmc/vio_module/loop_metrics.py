@@ -0,0 +1,128 @@
+# python standard library
+from bisect import bisect_right
+from math import log10
+
+
+class Histogram(object):
+    """
+    Counts durations (s) into fixed log spaced buckets from 'low' to 'high', so recording
+    one is a bisect and an increment and nothing is kept per sample. Percentiles are
+    reported as the upper edge of the bucket they fall in.
+    """
+
+    def __init__(self, low=1e-6, high=1.0, buckets_per_decade=10):
+        buckets = int(round(log10(high / low) * buckets_per_decade))
+        self.edges = [low * 10 ** (i / buckets_per_decade) for i in range(buckets + 1)]
+        self.reset()
+
+    def reset(self):
+        # one more bucket than edges, for anything past the last edge
+        self.counts = [0] * (len(self.edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect_right(self.edges, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        target = self.count * q / 100
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target and n:
+                return self.edges[i] if i < len(self.edges) else self.max
+        return self.max
+
+    def summary(self, scale=1.0):
+        """
+        count, mean, p50, p90, p99 and max, multiplied by 'scale' (e.g. 1000 for ms)
+        """
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": self.total / self.count * scale,
+            "p50": min(self.percentile(50), self.max) * scale,
+            "p90": min(self.percentile(90), self.max) * scale,
+            "p99": min(self.percentile(99), self.max) * scale,
+            "max": self.max * scale,
+        }
+
+
+class LoopMetrics(object):
+    """
+    Timings and counters for the VIO pose loop, collected per pose and summarized (then
+    reset) by take() once per stats period.
+
+    The histograms time the loop period (between poses arriving), the transform and the
+    publish step. The counters track poses, sources returning nothing, gaps of more than
+    'gap' seconds between sensor timestamps, and poses dropped for NaNs. NaN counts are
+    also kept until take_nans() so they can be logged as a summary now and then rather
+    than on every sample.
+
+    The pose loop and take() run on different threads without a lock, so an update racing
+    a take() can land in either period.
+    """
+
+    COUNTERS = ["poses", "none", "gaps", "nan_position", "nan_orientation", "nan_velocity"]
+    NAN_COUNTERS = ["nan_position", "nan_orientation", "nan_velocity"]
+
+    def __init__(self, gap=0.05):
+        self.gap = gap
+
+        self.period = Histogram()
+        self.transform = Histogram()
+        self.publish = Histogram()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.nans = dict.fromkeys(self.NAN_COUNTERS, 0)
+
+        self.last_time = None
+        self.last_timestamp = None
+
+    def pose(self, now, timestamp):
+        """
+        Notes a pose arriving at 'now' (time.perf_counter()) with sensor time 'timestamp' (s)
+        """
+        self.counters["poses"] += 1
+        if self.last_time is not None:
+            self.period.record(now - self.last_time)
+        self.last_time = now
+        if timestamp is not None:
+            if self.last_timestamp is not None and timestamp - self.last_timestamp > self.gap:
+                self.counters["gaps"] += 1
+            self.last_timestamp = timestamp
+
+    def count(self, name):
+        self.counters[name] += 1
+        if name in self.nans:
+            self.nans[name] += 1
+
+    def take(self, elapsed):
+        """
+        Returns the summary for the last 'elapsed' seconds and starts a new period
+        """
+        counters, self.counters = self.counters, dict.fromkeys(self.COUNTERS, 0)
+        stats = {
+            "period": elapsed,
+            "rate": counters["poses"] / elapsed if elapsed > 0 else 0.0,
+            "counters": counters,
+            "loop_period_ms": self.period.summary(1000),
+            "transform_us": self.transform.summary(1e6),
+            "publish_us": self.publish.summary(1e6),
+        }
+        self.period.reset()
+        self.transform.reset()
+        self.publish.reset()
+        return stats
+
+    def take_nans(self):
+        """
+        Returns the NaN counts since the last call and resets them
+        """
+        nans, self.nans = self.nans, dict.fromkeys(self.NAN_COUNTERS, 0)
+        return nans
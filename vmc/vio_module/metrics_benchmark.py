@@ -0,0 +1,112 @@
+"""
+Measures what the loop metrics cost the VIO pose loop, as a share of the loop period at the
+given rate: directly, timing the metrics calls handle_pose makes per pose on their own, and
+end to end, running the same simulated poses through VIO.handle_pose with LoopMetrics and
+with a collector that does nothing (this one is within the noise). Then prints the
+vrc/vio/stats payload for a run with some NaN poses mixed in.
+
+usage: python3 metrics_benchmark.py [poses] [rate Hz]
+"""
+# python standard library
+import json
+import sys
+import time
+
+try:
+    from loop_metrics import LoopMetrics  # type: ignore
+    from pose_source import SimulatedPoseSource  # type: ignore
+    from vio_library import VIO, OutputDecimator  # type: ignore
+except ImportError:
+    from .loop_metrics import LoopMetrics
+    from .pose_source import SimulatedPoseSource
+    from .vio_library import VIO, OutputDecimator
+
+
+class NullHistogram(object):
+    def record(self, value):
+        pass
+
+
+class NullMetrics(object):
+    """
+    Same interface as LoopMetrics, collecting nothing
+    """
+
+    def __init__(self):
+        self.period = self.transform = self.publish = NullHistogram()
+
+    def pose(self, now, timestamp):
+        pass
+
+    def count(self, name):
+        pass
+
+
+class NullPublisher(object):
+    def put(self, topic, payload):
+        pass
+
+    def stats(self):
+        return {}
+
+
+def make_vio(metrics, rate):
+    vio = VIO(None, SimulatedPoseSource(rate=rate))
+    vio.decimator = OutputDecimator(0)  # publish every pose, the worst case
+    vio.publisher = NullPublisher()
+    vio.metrics = metrics
+    return vio
+
+
+def time_metrics(count, rate):
+    """
+    Per pose cost of the metrics calls in handle_pose, perf_counter calls included
+    """
+    metrics = LoopMetrics()
+    start = time.perf_counter()
+    for i in range(count):
+        now = time.perf_counter()
+        metrics.pose(now, i / rate)
+        transformed = time.perf_counter()
+        metrics.transform.record(transformed - now)
+        metrics.publish.record(time.perf_counter() - transformed)
+    return (time.perf_counter() - start) / count
+
+
+def time_poses(vio, poses):
+    start = time.perf_counter()
+    for data, timestamp in poses:
+        vio.handle_pose(data, timestamp)
+    return (time.perf_counter() - start) / len(poses)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    source = SimulatedPoseSource(rate=rate, pos_noise=0.01, seed=0)
+    poses = [(source.sample(i / rate), i / rate) for i in range(count)]
+
+    direct = min(time_metrics(count, rate) for _ in range(5))
+    print(f"metrics calls: {direct * 1e6:.2f} us per pose = {direct * rate * 100:.3f}% of the loop at {rate:.0f} Hz")
+
+    # alternate, so both see the same machine state, and keep the best of each
+    with_metrics = without_metrics = float("inf")
+    for _ in range(5):
+        with_metrics = min(with_metrics, time_poses(make_vio(LoopMetrics(), rate), poses))
+        without_metrics = min(without_metrics, time_poses(make_vio(NullMetrics(), rate), poses))
+    overhead = with_metrics - without_metrics
+    print(
+        f"end to end: {without_metrics * 1e6:.2f} us without metrics, {with_metrics * 1e6:.2f} us with, "
+        f"{overhead * 1e6:.2f} us overhead = {overhead * rate * 100:.3f}% of the loop at {rate:.0f} Hz"
+    )
+
+    # one stats period with every 50th pose turned to NaNs and a dropout
+    vio = make_vio(LoopMetrics(), rate)
+    for i, (data, timestamp) in enumerate(poses[: int(rate)]):
+        if i % 50 == 0:
+            data.translation.x = float("nan")
+        if not 100 <= i < 110:
+            vio.handle_pose(data, timestamp)
+    print(json.dumps(vio.metrics.take(1.0), indent=2))
+    print("NaNs to log:", vio.metrics.take_nans())
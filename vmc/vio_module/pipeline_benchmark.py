@@ -0,0 +1,81 @@
+"""
+Runs the VIO pose pipeline against the simulated pose source and reports how many poses
+were processed and published, how long each took to process, and how old the published
+poses were (by sensor timestamp) when they went out.
+
+usage: python3 pipeline_benchmark.py [seconds] [source rate Hz] [output rate Hz]
+"""
+# python standard library
+import json
+import sys
+import threading
+import time
+
+# pip installed packages
+import numpy as np
+
+try:
+    from pose_source import SimulatedPoseSource  # type: ignore
+    from vio_library import VIO, OutputDecimator  # type: ignore
+except ImportError:
+    from .pose_source import SimulatedPoseSource
+    from .vio_library import VIO, OutputDecimator
+
+
+class TimingClient(object):
+    """
+    Stands in for the paho client, noting how old each position update is when it goes out
+    """
+
+    def __init__(self):
+        self.ages = []
+
+    def publish(self, topic, payload, *args, **kwargs):
+        if topic.endswith("/position/ned"):
+            self.ages.append(time.time() - json.loads(payload)["timestamp"])
+
+
+class TimedVIO(VIO):
+    """
+    Records the processing time of every pose
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.process_times = []
+
+    def handle_pose(self, data, timestamp):
+        start = time.perf_counter()
+        super().handle_pose(data, timestamp)
+        self.process_times.append(time.perf_counter() - start)
+
+
+def run(mode, seconds, source_rate, output_rate):
+    client = TimingClient()
+    vio = TimedVIO(client, SimulatedPoseSource(rate=source_rate))
+    vio.SOURCE_MODE = mode
+    vio.decimator = OutputDecimator(output_rate)
+
+    thread = threading.Thread(target=vio.run, daemon=True)
+    thread.start()
+    time.sleep(seconds)
+    vio.t265.stop()
+
+    process_us = np.array(vio.process_times) * 1e6
+    ages_ms = np.array(client.ages) * 1000
+    print(
+        f"{mode:>8}: {vio.decimator.received / seconds:6.1f} poses/s processed, "
+        f"{vio.decimator.published / seconds:6.1f}/s published | "
+        f"process p50 {np.percentile(process_us, 50):6.1f} us p99 {np.percentile(process_us, 99):6.1f} us | "
+        f"published age p50 {np.percentile(ages_ms, 50):5.2f} ms p99 {np.percentile(ages_ms, 99):5.2f} ms"
+    )
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    source_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 200
+    output_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    print(f"source {source_rate:.0f} Hz, output {output_rate:.0f} Hz, {seconds:.0f} s")
+    run("callback", seconds, source_rate, output_rate)
+    run("blocking", seconds, source_rate, output_rate)
@@ -0,0 +1,106 @@
+"""
+Fault injection for the VIO publish path: runs the pose pipeline against the simulated
+source with a fake broker that is slow on every publish and stalls completely now and
+then, once publishing synchronously from the sensor thread (as VIO used to) and once
+through LatestValuePublisher. Reports how long the sensor thread spent per pose and the
+largest gap between poses it processed.
+
+usage: python3 publisher_benchmark.py [seconds] [source rate Hz] [publish delay ms] [stall ms]
+"""
+# python standard library
+import json
+import sys
+import threading
+import time
+
+# pip installed packages
+import numpy as np
+
+try:
+    from pose_source import SimulatedPoseSource  # type: ignore
+    from vio_library import VIO, LatestValuePublisher, OutputDecimator  # type: ignore
+except ImportError:
+    from .pose_source import SimulatedPoseSource
+    from .vio_library import VIO, LatestValuePublisher, OutputDecimator
+
+
+class SlowBroker(object):
+    """
+    Stands in for the paho client, taking 'delay' seconds per publish and blocking for
+    'stall' seconds once every 'stall_every' seconds
+    """
+
+    def __init__(self, delay, stall, stall_every=1.0):
+        self.delay = delay
+        self.stall = stall
+        self.stall_every = stall_every
+        self.next_stall = time.time() + stall_every
+
+    def publish(self, topic, payload, *args, **kwargs):
+        time.sleep(self.delay)
+        if time.time() >= self.next_stall:
+            time.sleep(self.stall)
+            self.next_stall = time.time() + self.stall_every
+
+
+class SynchronousPublisher(LatestValuePublisher):
+    """
+    Publishes straight from the caller's thread
+    """
+
+    def start(self):
+        pass
+
+    def put(self, topic, payload):
+        self.put_count += 1
+        self.mqtt_client.publish(topic, json.dumps(payload), retain=False, qos=0)
+        self.published += 1
+
+
+class TimedVIO(VIO):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.process_times = []
+        self.pose_times = []
+
+    def handle_pose(self, data, timestamp):
+        start = time.perf_counter()
+        super().handle_pose(data, timestamp)
+        self.process_times.append(time.perf_counter() - start)
+        self.pose_times.append(start)
+
+
+def run(label, publisher_class, seconds, source_rate, delay, stall):
+    broker = SlowBroker(delay, stall)
+    vio = TimedVIO(broker, SimulatedPoseSource(rate=source_rate))
+    vio.decimator = OutputDecimator(0)  # publish every pose, the worst case
+    vio.publisher = publisher_class(broker)
+
+    thread = threading.Thread(target=vio.run, daemon=True)
+    thread.start()
+    time.sleep(seconds)
+    vio.t265.stop()
+
+    process_ms = np.array(vio.process_times) * 1000
+    max_gap_ms = np.diff(vio.pose_times).max() * 1000
+    stats = vio.publisher.stats()
+    print(
+        f"{label:>12}: {len(process_ms) / seconds:6.1f} poses/s | "
+        f"per pose p50 {np.percentile(process_ms, 50):7.3f} ms p99 {np.percentile(process_ms, 99):7.3f} ms "
+        f"max {process_ms.max():7.1f} ms | largest gap {max_gap_ms:6.1f} ms | "
+        f"published {stats['published']}, superseded {stats['superseded']}"
+    )
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    source_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 200
+    delay = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.002
+    stall = float(sys.argv[4]) / 1000 if len(sys.argv) > 4 else 0.3
+
+    print(
+        f"source {source_rate:.0f} Hz, {delay * 1000:.1f} ms per publish, "
+        f"{stall * 1000:.0f} ms broker stall every second, {seconds:.0f} s"
+    )
+    run("synchronous", SynchronousPublisher, seconds, source_rate, delay, stall)
+    run("latest value", LatestValuePublisher, seconds, source_rate, delay, stall)
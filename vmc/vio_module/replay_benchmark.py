@@ -0,0 +1,99 @@
+"""
+Records simulated poses to a pose log through PoseRecorder, then replays the log as fast
+as possible through VIO with ReplayPoseSource. Checks every replayed pose transforms the
+same as the recorded one (to float32 precision) and reports the recording cost, replay
+rate and file size.
+
+usage: python3 replay_benchmark.py [records]
+"""
+# python standard library
+import os
+import sys
+import tempfile
+import time
+
+# pip installed packages
+import numpy as np
+
+try:
+    from pose_source import PoseRecorder, ReplayPoseSource, SimulatedPoseSource, open_pose_log  # type: ignore
+    from vio_library import VIO, OutputDecimator, T265CoordinateTransformation  # type: ignore
+except ImportError:
+    from .pose_source import PoseRecorder, ReplayPoseSource, SimulatedPoseSource, open_pose_log
+    from .vio_library import VIO, OutputDecimator, T265CoordinateTransformation
+
+
+class CollectingPublisher(object):
+    """
+    Keeps every published state record instead of sending it anywhere
+    """
+
+    def __init__(self):
+        self.states = []
+
+    def start(self):
+        pass
+
+    def put(self, topic, payload):
+        if topic.endswith("/state"):
+            self.states.append(payload)
+
+
+if __name__ == "__main__":
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    path = os.path.join(tempfile.mkdtemp(), "poses.bin")
+
+    # record: sample the simulated source at 200 Hz sensor time without waiting on it
+    source = SimulatedPoseSource(rate=200, pos_noise=0.01, vel_noise=0.01, yaw_noise=0.01, seed=0)
+    samples = [(source.sample(i / 200.0), i / 200.0) for i in range(records)]
+    recorder = PoseRecorder(path)
+    start = time.perf_counter()
+    for data, timestamp in samples:
+        recorder.record(data, timestamp)
+    recorder.close()
+    record_us = (time.perf_counter() - start) / records * 1e6
+
+    log = open_pose_log(path)
+    assert len(log) == records
+    print(
+        f"recorded {records} poses: {record_us:.2f} us/pose, "
+        f"{os.path.getsize(path) / 1e6:.1f} MB ({log.dtype.itemsize} bytes/pose, "
+        f"{log.dtype.itemsize * 200 * 3600 / 1e6:.0f} MB per hour at 200 Hz)"
+    )
+
+    # replay everything through VIO in blocking mode, publishing every pose
+    vio = VIO(None, ReplayPoseSource(path, speed=0))
+    vio.decimator = OutputDecimator(0)
+    vio.publisher = CollectingPublisher()
+    vio.PUBLISH_STATE = True
+    vio.LEGACY_TOPICS = set()
+    vio.t265.setup()
+    start = time.perf_counter()
+    while True:
+        sample = vio.t265.get_pose()
+        if sample is None:
+            break
+        vio.handle_pose(*sample)
+    replay_s = time.perf_counter() - start
+    states = vio.publisher.states
+    print(f"replayed {len(states)} poses in {replay_s:.2f} s: {len(states) / replay_s:.0f} poses/s")
+
+    # the replayed poses must transform like the originals did, up to the float32 storage
+    coord_trans = T265CoordinateTransformation()
+    worst_pos = worst_vel = 0.0
+    for (data, timestamp), state in zip(samples, states):
+        pos, vel, _ = coord_trans.transform_t265_to_global_ned(data)
+        assert state["timestamp"] == timestamp
+        worst_pos = max(worst_pos, np.abs(pos - [state["pos"]["n"], state["pos"]["e"], state["pos"]["d"]]).max())
+        worst_vel = max(worst_vel, np.abs(vel - [state["vel"]["n"], state["vel"]["e"], state["vel"]["d"]]).max())
+    print(f"max difference to the original poses: position {worst_pos:.2e} cm, velocity {worst_vel:.2e} cm/s")
+
+    # real time replay keeps to the recorded timing
+    replay = ReplayPoseSource(path, speed=1.0)
+    replay.setup()
+    start = time.time()
+    for _ in range(200):
+        replay.get_pose()
+    print(f"200 poses at 1x took {time.time() - start:.3f} s (recorded over {199 / 200:.3f} s)")
+
+    os.remove(path)
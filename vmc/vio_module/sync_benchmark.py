@@ -0,0 +1,146 @@
+"""
+Checks T265CoordinateTransformation.sync against the original decompose/compose version
+(kept below as reference_sync), times a resync that is applied, blended or skipped against
+it, then flies a simulated vehicle at 1 m/s while the sensor drifts and resyncs arrive once
+a second, comparing how far the velocity implied by the published positions strays from
+the true one when resyncs are stepped (SYNC_TIME_CONSTANT = 0) and when they are blended.
+
+usage: python3 sync_benchmark.py [samples]
+"""
+# python standard library
+import sys
+import time
+from math import cos, sin, pi
+from types import SimpleNamespace
+
+# pip installed packages
+import numpy as np
+import transforms3d as t3d
+
+try:
+    from vio_library import T265CoordinateTransformation  # type: ignore
+except ImportError:
+    from .vio_library import T265CoordinateTransformation
+
+
+def reference_sync(coord_trans, heading_ref, pos_ref):
+    """
+    H_aeroRefSync_aeroRef as sync used to compute it
+    """
+    H_T265Ref_aeroBody = t3d.affines.compose(coord_trans.T_T265Ref_aeroBody, coord_trans.R_T265Ref_aeroBody, [1, 1, 1])
+    H = coord_trans.tm["H_aeroRef_T265Ref"].dot(H_T265Ref_aeroBody)
+    T, R, Z, S = t3d.affines.decompose44(H)
+    heading = t3d.euler.mat2euler(R, axes="rxyz")[2]
+    if heading < 0:
+        heading += 2 * pi
+    heading_offset = heading_ref - heading * 180 / pi
+    H_rot_correction = t3d.affines.compose(
+        [0, 0, 0], t3d.axangles.axangle2mat([0, 0, 1], heading_offset * pi / 180), [1, 1, 1]
+    )
+    H = H_rot_correction.dot(H)
+    T, R, Z, S = t3d.affines.decompose44(H)
+    pos_offset = [pos_ref["n"] - T[0], pos_ref["e"] - T[1], pos_ref["d"] - T[2]]
+    return t3d.affines.compose(pos_offset, H_rot_correction[:3, :3], [1, 1, 1])
+
+
+def make_sample(quat, pos, vel):
+    return SimpleNamespace(
+        rotation=SimpleNamespace(w=quat[0], x=quat[1], y=quat[2], z=quat[3]),
+        translation=SimpleNamespace(x=pos[0], y=pos[1], z=pos[2]),
+        velocity=SimpleNamespace(x=vel[0], y=vel[1], z=vel[2]),
+    )
+
+
+def check(samples, rng):
+    worst = 0.0
+    for _ in range(samples):
+        coord_trans = T265CoordinateTransformation()
+        quat = rng.normal(size=4)
+        coord_trans.transform_t265_to_global_ned(make_sample(quat / np.linalg.norm(quat), rng.uniform(-20, 20, 3), (0, 0, 0)))
+        heading_ref = rng.uniform(0, 360)
+        pos_ref = dict(zip("ned", rng.uniform(-2000, 2000, 3)))
+        expected = reference_sync(coord_trans, heading_ref, pos_ref)
+        coord_trans.sync(heading_ref, pos_ref)
+        worst = max(worst, np.abs(coord_trans.tm["H_aeroRefSync_aeroRef"] - expected).max())
+    return worst
+
+
+def time_us(fn, count=2000):
+    start = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return (time.perf_counter() - start) / count * 1e6
+
+
+class FlightClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def fly(time_constant, seconds=20.0, rate=200):
+    """
+    Returns the largest and RMS error (cm/s) of the velocity implied by consecutive published
+    positions. The sensor's heading drifts 0.5 deg/s and its position 5 cm/s, so each resync
+    has a little to correct
+    """
+    coord_trans = T265CoordinateTransformation()
+    coord_trans.SYNC_TIME_CONSTANT = time_constant
+    clock = coord_trans.clock = FlightClock()
+
+    speed = 100.0  # cm/s north
+    errors = []
+    last = None
+    for i in range(int(seconds * rate)):
+        t = clock.now = i / rate
+        heading_drift = 0.5 * pi / 180 * t
+        # the vehicle faces north and flies north, the sensor sees both turned by the drift
+        # and its position pushed east by the drift
+        north = speed * t
+        sensed_north, sensed_east = north * cos(heading_drift), north * sin(heading_drift) + 5.0 * t
+        # aeroRef north/east/down -> T265Ref right/up/back, see H_aeroRef_T265Ref
+        yaw = -heading_drift
+        sample = make_sample(
+            (cos(yaw / 2), 0.0, sin(yaw / 2), 0.0),
+            (sensed_east / 100, 0.0, -sensed_north / 100),
+            (0.0, 0.0, -speed / 100),
+        )
+        pos, vel, rpy = coord_trans.transform_t265_to_global_ned(sample)
+        if last is not None:
+            implied = (pos[:2] - last) * rate
+            errors.append(np.hypot(implied[0] - speed, implied[1]))
+        last = pos[:2].copy()
+
+        if i % rate == rate - 1:
+            coord_trans.sync(0.0, {"n": north, "e": 0.0, "d": 0.0})
+    errors = np.array(errors[rate:])  # after the first, stepped, sync
+    return errors.max(), np.sqrt((errors ** 2).mean()), coord_trans
+
+
+if __name__ == "__main__":
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rng = np.random.default_rng(0)
+    print(f"first sync against the original, max abs difference: {check(samples, rng):.3e}")
+
+    coord_trans = T265CoordinateTransformation()
+    coord_trans.transform_t265_to_global_ned(make_sample((1, 0, 0, 0), (1.0, 2.0, 3.0), (0, 0, 0)))
+    pos_ref = {"n": 250.0, "e": -80.0, "d": -40.0}
+    reference_us = time_us(lambda: reference_sync(coord_trans, 123.0, pos_ref))
+    coord_trans.sync(123.0, pos_ref)
+    skipped_us = time_us(lambda: coord_trans.sync(123.1, pos_ref))
+    blend_us = time_us(lambda: (coord_trans.sync(130.0, pos_ref), coord_trans.sync(123.0, pos_ref)), 1000) / 2
+    coord_trans.sync_target = (1.0, 0.0, 0.0, 0.0)
+    step_us = time_us(lambda: coord_trans.advance_sync(time.monotonic()))
+    print(
+        f"resync: {reference_us:.1f} us the original way, {blend_us:.1f} us to set a blend target, "
+        f"{skipped_us:.1f} us when skipped within tolerance, {step_us:.1f} us per blended sample"
+    )
+
+    for label, time_constant in (("stepped", 0.0), ("blended 1 s", 1.0)):
+        worst, rms, coord_trans = fly(time_constant)
+        print(
+            f"{label:>12}: velocity implied by published positions off by up to {worst:6.1f} cm/s "
+            f"(RMS {rms:5.2f} cm/s), {coord_trans.resyncs} resyncs, {coord_trans.resyncs_skipped} skipped"
+        )
@@ -4,7 +4,12 @@ import subprocess
 from loguru import logger
 from colored import fore, back, style
 
-class T265(object):
+try:
+    from pose_source import PoseSource  # type: ignore
+except ImportError:
+    from .pose_source import PoseSource
+
+class T265(PoseSource):
     '''
     Realsense T265 Tracking Camera interface. Manages pulling data off of the camera for use by the transforms to get it in the correct reference frame.
     '''
@@ -26,7 +31,12 @@ class T265(object):
 
         return rs_devices
 
-    def setup(self) -> None:
+    def setup(self, callback=None) -> None:
+        """
+        Connects to the T265 and starts the pose stream. If 'callback' is given it's called
+        with (data, timestamp) for every pose from librealsense's thread, otherwise poses are
+        read with get_pose
+        """
         try:
             # Reference to a post showing how to use multiple camera: https://github.com/IntelRealSense/librealsense/issues/1735
             logger.debug("Obtaining connected RealSense devices...")
@@ -54,23 +64,36 @@ class T265(object):
             logger.debug("Enabling T265 stream")
             t265_config.enable_stream(rs.stream.pose)
             logger.debug("Starting RealSense pipeline")
-            self.pipe.start(t265_config)
+            if callback is None:
+                self.pipe.start(t265_config)
+            else:
+                self.pipe.start(t265_config, lambda frame: self.on_frame(frame, callback))
             logger.debug("T265 fully connected")
 
         except Exception as e:
             logger.exception(f"{fore.RED}T265: Error connecting to Realsense Camera: {e}{style.RESET}")
             raise e
 
-    def get_pipe_data(self) -> rs.pose:
+    def on_frame(self, frame: rs.frame, callback) -> None:
+        if frame.is_pose_frame():
+            pose = frame.as_pose_frame()
+            # librealsense timestamps are in ms
+            callback(pose.get_pose_data(), pose.get_timestamp() / 1000)
+
+    def get_pose(self):
         # Wait for the next set of frames from the camera
         frames = self.pipe.wait_for_frames()
 
         # # Fetch pose frame
         pose = frames.get_pose_frame()
-        
+
         if pose: # is not None
-            data = pose.get_pose_data()
-            return data
+            return pose.get_pose_data(), pose.get_timestamp() / 1000
+
+    def get_pipe_data(self) -> rs.pose:
+        sample = self.get_pose()
+        if sample is not None:
+            return sample[0]
     
     def stop(self) -> None:
         try:
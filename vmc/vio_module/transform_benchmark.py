@@ -0,0 +1,112 @@
+"""
+Checks T265CoordinateTransformation against the original matrix-chain implementation of
+transform_t265_to_global_ned (kept below as reference_transform) over random samples, before
+and after a resync, then times the per-sample and batch paths against it.
+
+usage: python3 transform_benchmark.py [samples]
+"""
+# python standard library
+import sys
+import time
+from types import SimpleNamespace
+
+# pip installed packages
+import numpy as np
+import transforms3d as t3d
+
+try:
+    from vio_library import T265CoordinateTransformation  # type: ignore
+except ImportError:
+    from .vio_library import T265CoordinateTransformation
+
+
+def reference_transform(tm, data):
+    """
+    The transform chain as it was before the static matrices were precomposed
+    """
+    quaternion = [data.rotation.w, data.rotation.x, data.rotation.y, data.rotation.z]
+    position = [data.translation.x * 100, data.translation.y * 100, data.translation.z * 100]
+    velocity = np.transpose(
+        [data.velocity.x * 100, data.velocity.y * 100, data.velocity.z * 100, 0]
+    )
+
+    H_T265Ref_T265Body = t3d.affines.compose(
+        position, t3d.quaternions.quat2mat(quaternion), [1, 1, 1]
+    )
+    H_aeroRef_aeroBody = tm["H_aeroRef_T265Ref"].dot(
+        H_T265Ref_T265Body.dot(tm["H_T265Body_aeroBody"])
+    )
+    H_aeroRefSync_aeroBody = tm["H_aeroRefSync_aeroRef"].dot(H_aeroRef_aeroBody)
+
+    T, R, Z, S = t3d.affines.decompose44(H_aeroRefSync_aeroBody)
+    eul = t3d.euler.mat2euler(R, axes="rxyz")
+
+    H_vel = tm["H_aeroRefSync_aeroRef"].dot(tm["H_aeroRef_T265Ref"])
+    vel = np.transpose(H_vel.dot(velocity))
+
+    return T, vel[:3], eul
+
+
+def make_sample(quat, pos, vel):
+    """
+    Builds an object shaped like the pyrealsense2 pose data
+    """
+    return SimpleNamespace(
+        rotation=SimpleNamespace(w=quat[0], x=quat[1], y=quat[2], z=quat[3]),
+        translation=SimpleNamespace(x=pos[0], y=pos[1], z=pos[2]),
+        velocity=SimpleNamespace(x=vel[0], y=vel[1], z=vel[2]),
+    )
+
+
+def check(coord_trans, quat, pos, vel):
+    """
+    Returns the largest difference to the reference over all the samples, for both the
+    per-sample and batch paths
+    """
+    worst = 0.0
+    batch = coord_trans.transform_batch(quat, pos, vel)
+    for i in range(len(quat)):
+        data = make_sample(quat[i], pos[i], vel[i])
+        expected = reference_transform(coord_trans.tm, data)
+        single = coord_trans.transform_t265_to_global_ned(data)
+        for e, s, b in zip(expected, single, batch):
+            worst = max(worst, np.abs(np.asarray(e) - s).max(), np.abs(np.asarray(e) - b[i]).max())
+    return worst
+
+
+if __name__ == "__main__":
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rng = np.random.default_rng(0)
+
+    quat = rng.normal(size=(samples, 4))
+    quat /= np.linalg.norm(quat, axis=1, keepdims=True)
+    pos = rng.uniform(-20, 20, (samples, 3))  # m
+    vel = rng.uniform(-5, 5, (samples, 3))  # m/s
+
+    coord_trans = T265CoordinateTransformation()
+    print(f"max abs difference, no sync:   {check(coord_trans, quat, pos, vel):.3e}")
+
+    coord_trans.transform_t265_to_global_ned(make_sample(quat[0], pos[0], vel[0]))
+    coord_trans.sync(123.0, {"n": 250.0, "e": -80.0, "d": -40.0})
+    print(f"max abs difference, after sync: {check(coord_trans, quat, pos, vel):.3e}")
+
+    data = [make_sample(quat[i], pos[i], vel[i]) for i in range(samples)]
+
+    start = time.perf_counter()
+    for d in data:
+        reference_transform(coord_trans.tm, d)
+    reference_us = (time.perf_counter() - start) / samples * 1e6
+
+    start = time.perf_counter()
+    for d in data:
+        coord_trans.transform_t265_to_global_ned(d)
+    single_us = (time.perf_counter() - start) / samples * 1e6
+
+    out = (np.empty((samples, 3)), np.empty((samples, 3)), np.empty((samples, 3)))
+    start = time.perf_counter()
+    coord_trans.transform_batch(quat, pos, vel, out=out)
+    batch_us = (time.perf_counter() - start) / samples * 1e6
+
+    print(f"reference:  {reference_us:7.2f} us/sample")
+    print(f"per sample: {single_us:7.2f} us/sample")
+    print(f"batch:      {batch_us:7.2f} us/sample ({samples} samples)")
@@ -35,7 +35,8 @@ class VIOModule(object):
         self.topic_prefix = "vrc"
 
         self.mqtt_topics: Dict[str, Callable[[dict], None]] = {
-            f"{self.topic_prefix}/vio/resync": self.vio.handle_resync
+            f"{self.topic_prefix}/vio/resync": self.vio.handle_resync,
+            f"{self.topic_prefix}/vio/request": self.vio.handle_request,
         }
 
         self.mqtt_finished_init = False
@@ -51,7 +52,7 @@ class VIOModule(object):
 
         # add signal handler for the T265
         def signal_handler(sig, frame):
-            self.vio.t265.stop()
+            self.vio.stop()
             sys.exit(0)
 
         signal.signal(signal.SIGTERM, signal_handler)
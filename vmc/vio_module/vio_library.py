@@ -1,7 +1,9 @@
 # python standard library
 import time
-from math import pi
+from math import pi, atan2, hypot, cos, sin, exp
 import json
+import os
+import threading
 
 # pip installed packages
 import numpy as np
@@ -10,9 +12,17 @@ from colored import fore, back, style
 from loguru import logger
 
 try:
-    from t265_library import T265 # type: ignore
+    from pose_source import PoseSource, pose_source_from_env, recorder_from_env # type: ignore
+    from loop_metrics import LoopMetrics  # type: ignore
 except ImportError:
-    from .t265_library import T265
+    from .pose_source import PoseSource, pose_source_from_env, recorder_from_env
+    from .loop_metrics import LoopMetrics
+
+EPS = np.finfo(np.float64).eps
+
+# the per-quantity topics published before vrc/vio/state existed
+LEGACY_TOPIC_NAMES = ["position", "orientation", "heading", "velocity", "confidence"]
+
 
 class T265CoordinateTransformation(object):
     """
@@ -62,52 +72,229 @@ class T265CoordinateTransformation(object):
         )
         self.tm["H_nwu_aeroRef"] = H_nwu_aeroRef
 
-    def sync(self, heading_ref, pos_ref):
+        # T265Ref <- aeroBody rotation and translation of the last transformed sample, for sync
+        self.R_T265Ref_aeroBody = np.eye(3)
+        self.T_T265Ref_aeroBody = np.zeros(3)
+
+        # resyncs after the first are blended in over SYNC_TIME_CONSTANT seconds (0 steps
+        # straight to them), and skipped when within the tolerances of the current target
+        self.SYNC_TIME_CONSTANT = 1.0  # s
+        self.SYNC_HEADING_TOLERANCE = 0.5 * pi / 180  # rad
+        self.SYNC_POS_TOLERANCE = 1.0  # cm
+        # (heading rad, n, e, d cm) of the correction in H_aeroRefSync_aeroRef, and the one
+        # being blended towards (None when there's nothing to blend)
+        self.sync_offset = (0.0, 0.0, 0.0, 0.0)
+        self.sync_target = None
+        # what the blend is timed by
+        self.clock = time.monotonic
+        self.sync_time = None
+        self.synced = False
+        self.resyncs = 0
+        self.resyncs_skipped = 0
+
+        self.update_static_transforms()
+
+    def update_static_transforms(self):
         """
-        Computes offsets between t265 ref and "global" frames, to align coord. systems
+        Precomposes the parts of the transform chain that don't change from sample to sample.
+        Has to be called whenever one of them (e.g. the sync correction) is updated.
+
+        H_aeroRefSync_aeroBody = H_sync_T265Ref . H_T265Ref_T265Body . H_T265Body_aeroBody
         """
-        rad2deg = 180 / pi
-        deg2rad = pi / 180
+        H_aeroRef_T265Ref = self.tm["H_aeroRef_T265Ref"]
+        self.R_aeroRef_T265Ref = np.ascontiguousarray(H_aeroRef_T265Ref[:3, :3])
+        self.T_aeroRef_T265Ref = np.ascontiguousarray(H_aeroRef_T265Ref[:3, 3])
+
+        H_sync_T265Ref = self.tm["H_aeroRefSync_aeroRef"].dot(self.tm["H_aeroRef_T265Ref"])
+        self.R_sync_T265Ref = np.ascontiguousarray(H_sync_T265Ref[:3, :3])
+        self.T_sync_T265Ref = np.ascontiguousarray(H_sync_T265Ref[:3, 3])
+
+        H_T265Body_aeroBody = self.tm["H_T265Body_aeroBody"]
+        self.R_T265Body_aeroBody = np.ascontiguousarray(H_T265Body_aeroBody[:3, :3])
+        self.T_T265Body_aeroBody = np.ascontiguousarray(H_T265Body_aeroBody[:3, 3])
+
+        # the same as plain floats for the per sample path, where numpy's call overhead on
+        # 3x3 matrices costs more than the math itself
+        self.static_floats = (
+            tuple(map(tuple, self.R_sync_T265Ref.tolist())),
+            tuple(self.T_sync_T265Ref.tolist()),
+            tuple(map(tuple, self.R_T265Body_aeroBody.tolist())),
+            tuple(self.T_T265Body_aeroBody.tolist()),
+        )
 
-        # get current readings on where the aeroBody is, according to the sensor
-        H = self.tm["H_aeroRef_aeroBody"]
-        T, R, Z, S = t3d.affines.decompose44(H)
-        eul = t3d.euler.mat2euler(R, axes="rxyz")
+    def sync(self, heading_ref, pos_ref):
+        """
+        Computes offsets between t265 ref and "global" frames, to align coord. systems.
 
-        ## Find the heading offset...
-        heading = eul[2]
+        'heading_ref' (degrees) and 'pos_ref' ({"n", "e", "d"} cm) are where the vehicle
+        really is, as of the last transformed sample. The first sync is applied straight
+        away. Later ones become the target the correction is blended towards, unless they
+        are within tolerance of the current target. Returns whether anything changed
+        """
+        # where the aeroBody is according to the sensor, before any correction, from the
+        # rotation and translation cached by the last transform
+        R_a = self.R_aeroRef_T265Ref
+        R = R_a.dot(self.R_T265Ref_aeroBody)
+        T = R_a.dot(self.T_T265Ref_aeroBody) + self.T_aeroRef_T265Ref
+
+        # heading as t3d.euler.mat2euler(R, axes="rxyz") would have it
+        if hypot(R[2, 2], R[1, 2]) > 4 * EPS:
+            heading = atan2(-R[0, 1], R[0, 0])
+        else:
+            heading = atan2(R[1, 0], R[1, 1])
+
+        # the difference between our global reference and what the sensor reads for heading,
+        # as a rotation about the global Z axis, then whatever position offset is left
+        heading_offset = heading_ref * pi / 180 - heading
+        c, s = cos(heading_offset), sin(heading_offset)
+        target = (
+            heading_offset,
+            pos_ref["n"] - (c * T[0] - s * T[1]),
+            pos_ref["e"] - (s * T[0] + c * T[1]),
+            pos_ref["d"] - T[2],
+        )
 
-        # wrap heading in (0, 2*pi)
-        if heading < 0:
-            heading += 2 * pi
+        if not self.synced or self.SYNC_TIME_CONSTANT <= 0:
+            logger.debug(
+                f"{fore.CYAN_2}T265: Resync: Heading Offset:{heading_offset * 180 / pi} Pos offset:{target[1:]}{style.RESET}"  # type: ignore
+            )
+            self.synced = True
+            self.resyncs += 1
+            self.sync_target = None
+            self.apply_sync_offset(target)
+            return True
+
+        current = self.sync_target if self.sync_target is not None else self.sync_offset
+        turn = (target[0] - current[0] + pi) % (2 * pi) - pi
+        moved = max(abs(target[i] - current[i]) for i in range(1, 4))
+        if abs(turn) < self.SYNC_HEADING_TOLERANCE and moved < self.SYNC_POS_TOLERANCE:
+            self.resyncs_skipped += 1
+            return False
 
-        # compute the difference between our global reference, and what our sensor is reading for heading
-        heading_offset = heading_ref - (heading * rad2deg)
         logger.debug(
-            f"{fore.CYAN_2}T265: Resync: Heading Offset:{heading_offset}{style.RESET}"  # type: ignore
+            f"{fore.CYAN_2}T265: Resync: blending to Heading Offset:{target[0] * 180 / pi} Pos offset:{target[1:]}{style.RESET}"  # type: ignore
         )
+        self.resyncs += 1
+        # keep the heading offset on the same turn as the current one, so the blend goes the short way
+        self.sync_target = (current[0] + turn,) + target[1:]
+        return True
 
-        # build a rotation matrix about the global Z axis to apply the heading offset we computed
-        H_rot_correction = t3d.affines.compose(
-            [0, 0, 0],
-            t3d.axangles.axangle2mat([0, 0, 1], heading_offset * deg2rad),
-            [1, 1, 1],
+    def advance_sync(self, now):
+        """
+        Moves the correction towards the sync target by how much of SYNC_TIME_CONSTANT has
+        passed since the last step, snapping to it once within a hundredth of the tolerances
+        """
+        target = self.sync_target
+        if self.sync_time is None:
+            self.sync_time = now
+            return
+        alpha = 1.0 - exp(-(now - self.sync_time) / self.SYNC_TIME_CONSTANT)
+        self.sync_time = now
+
+        offset = tuple(o + alpha * (t - o) for o, t in zip(self.sync_offset, target))
+        if (
+            abs(target[0] - offset[0]) < self.SYNC_HEADING_TOLERANCE / 100
+            and max(abs(target[i] - offset[i]) for i in range(1, 4)) < self.SYNC_POS_TOLERANCE / 100
+        ):
+            offset = target
+            if self.sync_target is target:
+                self.sync_target = None
+                self.sync_time = None
+        self.apply_sync_offset(offset)
+
+    def apply_sync_offset(self, offset):
+        """
+        Sets H_aeroRefSync_aeroRef to the (heading rad, n, e, d cm) correction
+        """
+        heading, n, e, d = offset
+        c, s = cos(heading), sin(heading)
+        self.tm["H_aeroRefSync_aeroRef"] = np.array(
+            [[c, -s, 0.0, n], [s, c, 0.0, e], [0.0, 0.0, 1.0, d], [0.0, 0.0, 0.0, 1.0]]
         )
+        self.sync_offset = offset
+        self.update_static_transforms()
 
-        # apply the heading correction to the position data the T265 is providing
-        H = H_rot_correction.dot(H)
-        T, R, Z, S = t3d.affines.decompose44(H)
-        eul = t3d.euler.mat2euler(R, axes="rxyz")
+    def transform_batch(self, quat, position, velocity, out=None):
+        """
+        Transforms N samples at once from the t265 frame to the "global" NED reference frame.
 
-        ## Find the position offset
-        pos_offset = [pos_ref["n"] - T[0], pos_ref["e"] - T[1], pos_ref["d"] - T[2]]
-        logger.debug(f"{fore.CYAN_2}T265: Resync: Pos offset:{pos_offset}{style.RESET}")  # type: ignore
+        Arguments:
+        --------------------------
+        quat : Nx4 array of T265 rotations [w, x, y, z]
+        position : Nx3 array of T265 translations in m
+        velocity : Nx3 array of T265 velocities in m/s
+        out : optional (pos, vel, rpy) tuple of Nx3 arrays to write the results into
 
-        # build a translation matrix that corrects the difference between where the sensor thinks we are and were our reference thinks we are
-        H_aeroRefSync_aeroRef = t3d.affines.compose(
-            pos_offset, H_rot_correction[:3, :3], [1, 1, 1]
-        )
-        self.tm["H_aeroRefSync_aeroRef"] = H_aeroRefSync_aeroRef
+        Returns:
+        --------------------------
+        pos, vel, rpy: Nx3 arrays of NED position in cm, NED velocity in cm/s, and the
+        euler attitude [roll, pitch, yaw] ("rxyz") in rad
+        """
+        if self.sync_target is not None:
+            self.advance_sync(self.clock())
+
+        n = len(quat)
+        if out is None:
+            out = (np.empty((n, 3)), np.empty((n, 3)), np.empty((n, 3)))
+        pos, vel, rpy = out
+
+        R = self.quat2mat(quat)
+
+        # H_T265Ref_aeroBody = H_T265Ref_T265Body . H_T265Body_aeroBody
+        T_body = np.matmul(R, self.T_T265Body_aeroBody) + position * 100  # cm
+        np.matmul(R, self.R_T265Body_aeroBody, out=R)
+
+        # kept for sync, which only ever needs the latest sample
+        self.R_T265Ref_aeroBody = R[-1].copy()
+        self.T_T265Ref_aeroBody = T_body[-1].copy()
+
+        # apply the precomposed H_aeroRefSync_T265Ref
+        np.matmul(T_body, self.R_sync_T265Ref.T, out=pos)
+        pos += self.T_sync_T265Ref
+        np.matmul(self.R_sync_T265Ref, R, out=R)
+        np.matmul(velocity * 100, self.R_sync_T265Ref.T, out=vel)  # cm/s
+
+        self.mat2euler(R, rpy)
+        return pos, vel, rpy
+
+    @staticmethod
+    def quat2mat(quat):
+        """
+        Vectorized t3d.quaternions.quat2mat for an Nx4 array of [w, x, y, z] quaternions
+        """
+        w, x, y, z = quat.T
+        Nq = np.einsum("ij,ij->i", quat, quat)
+        # t3d returns the identity for a zero quaternion
+        s = np.divide(2.0, Nq, out=np.zeros_like(Nq), where=Nq >= EPS)
+        X, Y, Z = x * s, y * s, z * s
+
+        M = np.empty((len(quat), 3, 3))
+        M[:, 0, 0] = 1.0 - (y * Y + z * Z)
+        M[:, 0, 1] = x * Y - w * Z
+        M[:, 0, 2] = x * Z + w * Y
+        M[:, 1, 0] = x * Y + w * Z
+        M[:, 1, 1] = 1.0 - (x * X + z * Z)
+        M[:, 1, 2] = y * Z - w * X
+        M[:, 2, 0] = x * Z - w * Y
+        M[:, 2, 1] = y * Z + w * X
+        M[:, 2, 2] = 1.0 - (x * X + y * Y)
+        return M
+
+    @staticmethod
+    def mat2euler(R, out):
+        """
+        Vectorized t3d.euler.mat2euler(R, axes="rxyz") for an Nx3x3 array of rotation matrices
+        """
+        cy = np.hypot(R[:, 2, 2], R[:, 1, 2])
+        locked = cy <= 4 * EPS
+        np.arctan2(-R[:, 1, 2], R[:, 2, 2], out=out[:, 0])
+        np.arctan2(R[:, 0, 2], cy, out=out[:, 1])
+        np.arctan2(-R[:, 0, 1], R[:, 0, 0], out=out[:, 2])
+        if locked.any():
+            # gimbal lock, all of the rotation about z is put in the yaw like t3d does
+            out[locked, 0] = 0.0
+            out[locked, 2] = np.arctan2(R[locked, 1, 0], R[locked, 1, 1])
+        return out
 
     def transform_t265_to_global_ned(self, data):
         """
@@ -128,61 +315,251 @@ class T265CoordinateTransformation(object):
             The euler representation of the vehicle attitude. A 3 unit list [roll, pitch, yaw]
 
         """
-        quaternion = [
-            data.rotation.w,
-            data.rotation.x,
-            data.rotation.y,
-            data.rotation.z,
-        ]
-        position = [
-            data.translation.x * 100,
-            data.translation.y * 100,
-            data.translation.z * 100,
-        ]  # cm
-        velocity = np.transpose(
-            [data.velocity.x * 100, data.velocity.y * 100, data.velocity.z * 100, 0]
-        )  # cm/s
-
-        H_T265Ref_T265Body = t3d.affines.compose(
-            position, t3d.quaternions.quat2mat(quaternion), [1, 1, 1]
+        if self.sync_target is not None:
+            self.advance_sync(self.clock())
+        R_s, T_s, R_b, T_b = self.static_floats
+
+        w, x, y, z = data.rotation.w, data.rotation.x, data.rotation.y, data.rotation.z
+        Nq = w * w + x * x + y * y + z * z
+        if Nq < EPS:
+            # t3d treats a zero quaternion as no rotation
+            w, x, y, z, Nq = 1.0, 0.0, 0.0, 0.0, 1.0
+        s = 2.0 / Nq
+        X, Y, Z = x * s, y * s, z * s
+        R_q = (
+            (1.0 - (y * Y + z * Z), x * Y - w * Z, x * Z + w * Y),
+            (x * Y + w * Z, 1.0 - (x * X + z * Z), y * Z - w * X),
+            (x * Z - w * Y, y * Z + w * X, 1.0 - (x * X + y * Y)),
         )
-        self.tm["H_T265Ref_T265Body"] = H_T265Ref_T265Body
-
-        H_aeroRef_aeroBody = self.tm["H_aeroRef_T265Ref"].dot(
-            self.tm["H_T265Ref_T265Body"].dot(self.tm["H_T265Body_aeroBody"])
+        p = (data.translation.x * 100, data.translation.y * 100, data.translation.z * 100)  # cm
+        v = (data.velocity.x * 100, data.velocity.y * 100, data.velocity.z * 100)  # cm/s
+
+        # H_T265Ref_aeroBody = H_T265Ref_T265Body . H_T265Body_aeroBody, written out since
+        # generator expressions cost more than the arithmetic here
+        (b00, b01, b02), (b10, b11, b12), (b20, b21, b22) = R_b
+        R_body = tuple(
+            (
+                r0 * b00 + r1 * b10 + r2 * b20,
+                r0 * b01 + r1 * b11 + r2 * b21,
+                r0 * b02 + r1 * b12 + r2 * b22,
+            )
+            for r0, r1, r2 in R_q
         )
-        self.tm["H_aeroRef_aeroBody"] = H_aeroRef_aeroBody
-
-        H_aeroRefSync_aeroBody = self.tm["H_aeroRefSync_aeroRef"].dot(
-            H_aeroRef_aeroBody
+        T_body = tuple(
+            [r0 * T_b[0] + r1 * T_b[1] + r2 * T_b[2] + p_i for (r0, r1, r2), p_i in zip(R_q, p)]
         )
-        self.tm["H_aeroRefSync_aeroBody"] = H_aeroRefSync_aeroBody
-
-        T, R, Z, S = t3d.affines.decompose44(H_aeroRefSync_aeroBody)
-        eul = t3d.euler.mat2euler(R, axes="rxyz")
+        self.R_T265Ref_aeroBody = R_body
+        self.T_T265Ref_aeroBody = T_body
+
+        # apply the precomposed H_aeroRefSync_T265Ref
+        (c00, c01, c02), (c10, c11, c12), (c20, c21, c22) = R_body
+        R = [
+            (
+                s0 * c00 + s1 * c10 + s2 * c20,
+                s0 * c01 + s1 * c11 + s2 * c21,
+                s0 * c02 + s1 * c12 + s2 * c22,
+            )
+            for s0, s1, s2 in R_s
+        ]
+        t0, t1, t2 = T_body
+        pos = np.array([s0 * t0 + s1 * t1 + s2 * t2 + T_s_i for (s0, s1, s2), T_s_i in zip(R_s, T_s)])
+        vel = np.array([s0 * v[0] + s1 * v[1] + s2 * v[2] for s0, s1, s2 in R_s])
 
-        H_vel = self.tm["H_aeroRefSync_aeroRef"].dot(self.tm["H_aeroRef_T265Ref"])
-        vel = np.transpose(H_vel.dot(velocity))
+        # t3d.euler.mat2euler(R, axes="rxyz")
+        cy = hypot(R[2][2], R[1][2])
+        if cy > 4 * EPS:
+            eul = (atan2(-R[1][2], R[2][2]), atan2(R[0][2], cy), atan2(-R[0][1], R[0][0]))
+        else:
+            eul = (0.0, atan2(R[0][2], cy), atan2(R[1][0], R[1][1]))
 
         # print("T265: N: {:.3f}\tE: {:.3f}\tD: {:.3f}\tR: {:.3f}\tP: {:.3f}\tY: {:.3f}\tVn: {:.3f}\tVe: {:.3f}\tVd: {:.3f}".format(
         #     translate[0], translate[1], translate[2], angles[0], angles[1], angles[2], vel[0], vel[1], vel[2]))
 
-        return T, vel, eul
+        return pos, vel, eul
 
 
-class VIO(object):
+class PoseSample(object):
+    """
+    One transformed pose, as handed to the output decimator
+    """
+
+    __slots__ = ["pos", "vel", "rpy", "tracker_confidence", "mapper_confidence", "timestamp"]
+
+    def __init__(self, pos, vel, rpy, tracker_confidence, mapper_confidence, timestamp):
+        self.pos = pos
+        self.vel = vel
+        self.rpy = rpy
+        self.tracker_confidence = tracker_confidence
+        self.mapper_confidence = mapper_confidence
+        self.timestamp = timestamp
+
+
+class OutputDecimator(object):
+    """
+    Chooses which of the incoming pose samples get published.
+
+    With a 'rate' (Hz) the freshest sample is published once per period of sensor time,
+    with a rate of 0 every sample is published, and with 'on_demand' nothing is published
+    until take() asks for the freshest sample.
+    """
+
+    def __init__(self, rate=0.0, on_demand=False):
+        self.period = 1.0 / rate if rate else 0.0
+        self.on_demand = on_demand
+
+        self.lock = threading.Lock()
+        self.latest = None
+        # whether 'latest' has already been handed out
+        self.latest_taken = False
+        self.next_time = None
+
+        self.received = 0
+        self.published = 0
+
+    def offer(self, sample: PoseSample):
+        """
+        Records a new sample, returns it if it should be published now, otherwise None
+        """
+        with self.lock:
+            self.received += 1
+            self.latest = sample
+            self.latest_taken = False
+            if self.on_demand:
+                return None
+
+            if self.next_time is not None and sample.timestamp < self.next_time:
+                return None
+
+            # keep to the period's phase unless we've fallen more than a period behind
+            if self.next_time is None or sample.timestamp - self.next_time >= self.period:
+                self.next_time = sample.timestamp + self.period
+            else:
+                self.next_time += self.period
+            self.latest_taken = True
+            self.published += 1
+            return sample
+
+    def take(self):
+        """
+        Returns the freshest sample if it hasn't been published yet, otherwise None
+        """
+        with self.lock:
+            if self.latest is None or self.latest_taken:
+                return None
+            self.latest_taken = True
+            self.published += 1
+            return self.latest
+
+
+class LatestValuePublisher(object):
+    """
+    Publishes to MQTT from its own thread so the sensor loop never waits on paho or the broker.
+
+    Each topic has a single slot holding its latest payload. put() replaces the slot's
+    payload and returns straight away; the publisher thread serializes and publishes
+    whatever is in the slots at its own pace. A payload that is replaced before it
+    could be published is counted as superseded.
+    """
+
     def __init__(self, mqtt_client):
+        self.mqtt_client = mqtt_client
+
+        # only held to swap the slots, never while publishing
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.pending = threading.Event()
+
+        self.put_count = 0
+        self.published = 0
+        self.superseded = 0
+
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.publish_loop, daemon=True, name="vio_publish_thread"
+            )
+            self.thread.start()
+
+    def put(self, topic: str, payload: dict):
+        with self.lock:
+            if topic in self.slots:
+                self.superseded += 1
+            self.slots[topic] = payload
+            self.put_count += 1
+        self.pending.set()
+
+    def publish_loop(self):
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            with self.lock:
+                slots, self.slots = self.slots, {}
+            for topic, payload in slots.items():
+                # one bad payload or a publish error must not take the thread down
+                try:
+                    self.mqtt_client.publish(topic, json.dumps(payload), retain=False, qos=0)
+                    self.published += 1
+                except Exception as e:
+                    logger.exception(f"VIO: error publishing to {topic}")
+
+    def stats(self):
+        return {"put": self.put_count, "published": self.published, "superseded": self.superseded}
+
 
-        self.init = False
+class VIO(object):
+    def __init__(self, mqtt_client, pose_source: PoseSource = None):
+
+        self.init_sync = False
         self.continuous_sync = True
 
-        self.t265 = T265()
-        self.T265_UPDATE_FREQ = 10
+        if pose_source is None:
+            # VIO_POSE_SOURCE=sim/replay swaps the T265 for a simulated sensor or a pose log
+            pose_source = pose_source_from_env()
+        if pose_source is None:
+            # pyrealsense2 is only needed when talking to the real sensor
+            try:
+                from t265_library import T265  # type: ignore
+            except ImportError:
+                from .t265_library import T265
+            pose_source = T265()
+        self.t265 = pose_source
+        # VIO_RECORD=<path> appends every raw pose to a pose log, for ReplayPoseSource
+        self.recorder = recorder_from_env()
+
+        # "callback" processes every pose on the source's own thread as it arrives,
+        # "blocking" reads them one at a time in run()
+        self.SOURCE_MODE = "callback"
+        # rate (Hz, by sensor time) the freshest pose is published at, 0 publishes every pose.
+        # with OUTPUT_ON_DEMAND poses are only published when requested on vrc/vio/request
+        self.OUTPUT_RATE = 50
+        self.OUTPUT_ON_DEMAND = False
+        self.decimator = OutputDecimator(self.OUTPUT_RATE, self.OUTPUT_ON_DEMAND)
+
+        # VIO_STATE=1 publishes each pose as one vrc/vio/state record. VIO_LEGACY_TOPICS is a
+        # comma separated subset of LEGACY_TOPIC_NAMES to keep publishing separately (all by default)
+        self.PUBLISH_STATE = os.environ.get("VIO_STATE") == "1"
+        self.LEGACY_TOPICS = set(
+            name
+            for name in os.environ.get("VIO_LEGACY_TOPICS", ",".join(LEGACY_TOPIC_NAMES)).split(",")
+            if name
+        )
+        # sequence number of the last published pose, so consumers can spot gaps
+        self.seq = 0
 
         self.coord_trans = T265CoordinateTransformation()
 
         self.mqtt_client = mqtt_client
         self.topic_prefix = "vrc/vio"
+        # everything is published through here, started by run()
+        self.publisher = LatestValuePublisher(mqtt_client)
+
+        # loop timings and counters, published to vrc/vio/stats every STATS_PERIOD seconds.
+        # poses dropped for NaNs are logged as a summary at most every NAN_LOG_PERIOD seconds
+        self.metrics = LoopMetrics()
+        self.STATS_PERIOD = 1.0
+        self.NAN_LOG_PERIOD = 10.0
 
     def handle_resync(self, msg: dict):
         # whenever new data is published to the t265 resync topic, we need to compute a new correction
@@ -194,99 +571,174 @@ class VIO(object):
             self.coord_trans.sync(heading_ref, pos_ref)
             self.init_sync = True
 
+    def handle_request(self, msg: dict):
+        """
+        Publishes the freshest pose right away, for OUTPUT_ON_DEMAND
+        """
+        sample = self.decimator.take()
+        if sample is not None:
+            self.publish_sample(sample)
+
+    def handle_pose(self, data, timestamp):
+        """
+        Transforms every pose from the source and publishes the ones the decimator picks
+        """
+        start = time.perf_counter()
+        self.metrics.pose(start, timestamp)
+
+        if self.recorder is not None:
+            self.recorder.record(data, timestamp)
+
+        # collect data from the sensor and transform it into "global" NED frame
+        ned_pos, ned_vel, rpy = self.coord_trans.transform_t265_to_global_ned(data)
+        transformed = time.perf_counter()
+        self.metrics.transform.record(transformed - start)
+
+        sample = self.decimator.offer(
+            PoseSample(
+                ned_pos,
+                ned_vel,
+                rpy,
+                data.tracker_confidence,
+                data.mapper_confidence,
+                timestamp,
+            )
+        )
+        if sample is not None:
+            self.publish_sample(sample)
+            self.metrics.publish.record(time.perf_counter() - transformed)
+
+    def publish_sample(self, sample: PoseSample):
+        self.publish_updates(
+            sample.pos,
+            sample.vel,
+            sample.rpy,
+            sample.tracker_confidence,
+            sample.mapper_confidence,
+            sample.timestamp,
+        )
+
     def publish_updates(
-        self, ned_pos, ned_vel, rpy, tracker_confidence, mapper_confidence
+        self, ned_pos, ned_vel, rpy, tracker_confidence, mapper_confidence, timestamp=None
     ):
-        try:
-
-            if not np.isnan(ned_pos).any():
-                n = float(ned_pos[0])
-                e = float(ned_pos[1])
-                d = float(ned_pos[2])
-                ned_update = {"n": n, "e": e, "d": d}  # cm  # cm  # cm
-                self.mqtt_client.publish(
-                    f"{self.topic_prefix}/position/ned",
-                    json.dumps(ned_update),
-                    retain=False,
-                    qos=0,
-                )
-            else:
-                raise ValueError("T265 has NaNs for position")
-
-            if not np.isnan(rpy).any():
-                deg = [rad * 180 / pi for rad in rpy]
-                eul_update = {"psi": rpy[0], "theta": rpy[1], "phi": rpy[2]}
-                self.mqtt_client.publish(
-                    f"{self.topic_prefix}/orientation/eul",
-                    json.dumps(eul_update),
-                    retain=False,
-                    qos=0,
-                )
-                # print(fore.CYAN_2 + "T265: Heading: {}".format(eul_update["eul"]["phi"]), style.RESET)
-
-                heading = rpy[2]
-                if heading < 0:
-                    heading += 2 * pi
-                heading = np.rad2deg(heading)
-                heading_update = {"degrees": heading}
-                self.mqtt_client.publish(
-                    f"{self.topic_prefix}/heading",
-                    json.dumps(heading_update),
-                    retain=False,
-                    qos=0,
-                )
-                # coord_trans.heading = rpy[2]
-            else:
-                raise ValueError("T265 has NaNs for orientation")
-
-            if not np.isnan(ned_vel).any():
-                vel_update = {"n": ned_vel[0], "e": ned_vel[1], "d": ned_vel[2]}
-                self.mqtt_client.publish(
-                    f"{self.topic_prefix}/velocity/ned",
-                    json.dumps(vel_update),
-                    retain=False,
-                    qos=0,
-                )
-            else:
-                raise ValueError("T265 has NaNs for velocity")
+        """
+        Publishes a pose as the combined vrc/vio/state record and/or the legacy per-quantity
+        topics, depending on PUBLISH_STATE and LEGACY_TOPICS. 'timestamp' is the sensor time
+        of the pose in seconds, included in each update if given.
 
-            mapper_tracker = {
-                "mapper": mapper_confidence,
-                "tracker": tracker_confidence,
+        A pose with NaNs in it is dropped entirely, and counted in the metrics.
+        """
+        dropped = False
+        if np.isnan(ned_pos).any():
+            self.metrics.count("nan_position")
+            dropped = True
+        if np.isnan(rpy).any():
+            self.metrics.count("nan_orientation")
+            dropped = True
+        if np.isnan(ned_vel).any():
+            self.metrics.count("nan_velocity")
+            dropped = True
+        if dropped:
+            return
+
+        self.seq += 1
+
+        ned_update = {"n": float(ned_pos[0]), "e": float(ned_pos[1]), "d": float(ned_pos[2])}  # cm
+        vel_update = {"n": float(ned_vel[0]), "e": float(ned_vel[1]), "d": float(ned_vel[2])}  # cm/s
+        eul_update = {"psi": rpy[0], "theta": rpy[1], "phi": rpy[2]}
+
+        heading = rpy[2]
+        if heading < 0:
+            heading += 2 * pi
+        heading = heading * 180 / pi
+
+        mapper_tracker = {
+            "mapper": mapper_confidence,
+            "tracker": tracker_confidence,
+        }
+
+        if self.PUBLISH_STATE:
+            state = {
+                "seq": self.seq,
+                "timestamp": timestamp,
+                "pos": ned_update,
+                "vel": vel_update,
+                "eul": eul_update,
+                "heading": heading,
+                "confidence": mapper_tracker,
             }
-            self.mqtt_client.publish(
-                f"{self.topic_prefix}/confidence",
-                json.dumps(mapper_tracker),
-                retain=False,
-                qos=0,
-            )
-        except ValueError as e:
-            logger.exception(str(e))
+            self.publish("state", state)
+
+        legacy = self.LEGACY_TOPICS
+        if not legacy:
+            return
+
+        stamp = {} if timestamp is None else {"timestamp": timestamp}
+        if "position" in legacy:
+            self.publish("position/ned", dict(ned_update, **stamp))
+        if "orientation" in legacy:
+            self.publish("orientation/eul", dict(eul_update, **stamp))
+        if "heading" in legacy:
+            self.publish("heading", dict({"degrees": heading}, **stamp))
+        if "velocity" in legacy:
+            self.publish("velocity/ned", dict(vel_update, **stamp))
+        if "confidence" in legacy:
+            self.publish("confidence", mapper_tracker)
+
+    def publish(self, topic: str, payload: dict):
+        self.publisher.put(f"{self.topic_prefix}/{topic}", payload)
+
+    def stop(self):
+        self.t265.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def stats_loop(self):
+        """
+        Publishes the loop metrics every STATS_PERIOD seconds and logs a summary of any
+        poses dropped for NaNs every NAN_LOG_PERIOD seconds
+        """
+        last = time.monotonic()
+        next_nan_log = last + self.NAN_LOG_PERIOD
+        while True:
+            time.sleep(self.STATS_PERIOD)
+            now = time.monotonic()
+            stats = self.metrics.take(now - last)
+            last = now
+            stats["decimator"] = {"received": self.decimator.received, "published": self.decimator.published}
+            stats["publisher"] = self.publisher.stats()
+            self.publish("stats", stats)
+
+            if now >= next_nan_log:
+                next_nan_log = now + self.NAN_LOG_PERIOD
+                nans = self.metrics.take_nans()
+                if any(nans.values()):
+                    logger.warning(
+                        f"{fore.YELLOW}T265: poses dropped for NaNs in the last {self.NAN_LOG_PERIOD:.0f} s: "  # type: ignore
+                        f"position {nans['nan_position']}, orientation {nans['nan_orientation']}, "
+                        f"velocity {nans['nan_velocity']}{style.RESET}"
+                    )
 
     def run(self):
+        # publishing happens on its own thread from here on
+        self.publisher.start()
+        threading.Thread(target=self.stats_loop, daemon=True, name="vio_stats_thread").start()
 
         #setup the t265
         logger.debug("Setting up T265")
+        if self.SOURCE_MODE == "callback":
+            self.t265.setup(self.handle_pose)
+            logger.debug("Processing poses from the source's callback")
+            while True:
+                time.sleep(1)
+
         self.t265.setup()
 
         #start the loop
         logger.debug("Beginning data loop")
         while True:
-            data = self.t265.get_pipe_data()
-            if data is not None:
-                # collect data from the sensor and transform it into "global" NED frame
-                ned_pos, ned_vel, rpy = self.coord_trans.transform_t265_to_global_ned(
-                    data
-                )
-
-                self.publish_updates(
-                    ned_pos,
-                    ned_vel,
-                    rpy,
-                    data.tracker_confidence,
-                    data.mapper_confidence,
-                )
+            sample = self.t265.get_pose()
+            if sample is not None:
+                self.handle_pose(*sample)
             else:
-                continue
-
-            time.sleep(1 / self.T265_UPDATE_FREQ)
+                self.metrics.count("none")